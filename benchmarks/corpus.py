@@ -0,0 +1,120 @@
+"""ベンチマーク用の合成メールコーパス
+サイズ・添付ファイル数・マルチパートのネストの深さ・文字コードを変えたメールを、
+シードを固定した乱数から生成する（同じ指定からは常に同じバイト列を生成する）。
+
+使用例（コーパスを .eml ファイルとして書き出す）:
+    python benchmarks/corpus.py --output-dir corpus --full
+"""
+import argparse
+import os
+import random
+from email.mime.application import MIMEApplication
+from email.mime.multipart import MIMEMultipart
+from email.mime.nonmultipart import MIMENonMultipart
+from email.mime.text import MIMEText
+from email.utils import formatdate
+
+# 本文の生成に使う文字（英数字・ひらがな・カタカナ・漢字）
+TEXT_CHARS = (
+    "abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ0123456789      "
+    "あいうえおかきくけこさしすせそたちつてとなにぬねのはひふへほまみむめもやゆよらりるれろわをん"
+    "アイウエオカキクケコサシスセソタチツテトナニヌネノ"
+    "日本語本文添付資料会議議事録確認連絡"
+)
+
+KB = 1024
+MB = 1024 * 1024
+
+# 既定のケース（name, 目標サイズ, 添付ファイル数, ネストの深さ, 文字コード）
+DEFAULT_CASES = [
+    (f"{charset}-{label}", size, attachments, depth, charset)
+    for charset in ("utf-8", "iso-2022-jp", "shift_jis", "undeclared")
+    for label, size, attachments, depth in (
+        ("1kb", 1 * KB, 0, 1),
+        ("100kb-2att", 100 * KB, 2, 2),
+        ("1mb-5att-nested", 1 * MB, 5, 4),
+        ("10mb-3att", 10 * MB, 3, 2),
+    )
+]
+
+# --full 指定時に追加するケース（SES の上限付近）
+FULL_CASES = [
+    ("utf-8-35mb-1att", 35 * MB, 1, 1, "utf-8"),
+    ("shift_jis-35mb-20att", 35 * MB, 20, 3, "shift_jis"),
+]
+
+def random_text(rng, length):
+    """指定した文字数のテキストを生成（80文字ごとに改行）"""
+    chars = rng.choices(TEXT_CHARS, k=length)
+    return "\n".join("".join(chars[i:i + 80]) for i in range(0, length, 80)) + "\n"
+
+def text_part(rng, length, charset):
+    """本文のパートを生成
+    undeclared の場合は charset を宣言せずに Shift_JIS のバイト列を 8bit で格納する（古い日本語メールを想定）。
+    """
+    text = random_text(rng, length)
+    if charset == "undeclared":
+        part = MIMENonMultipart("text", "plain")
+        part.set_payload(text.encode("shift_jis", errors="replace").decode("ascii", errors="surrogateescape"))
+        part["Content-Transfer-Encoding"] = "8bit"
+        return part
+    return MIMEText(text, "plain", charset)
+
+def generate_message(name, size, attachments, depth, charset, seed=0):
+    """合成メールを生成
+    本文を depth 段のマルチパートで包み、残りのサイズを添付ファイルに割り当てる。
+    * Input Value: ケース名、目標サイズ（バイト）、添付ファイル数、ネストの深さ、文字コード、乱数のシード
+    * Output Value: メールデータ（バイト列）
+    """
+    rng = random.Random(f"{name}:{seed}")
+    # 添付ファイルがない場合は本文で目標サイズを満たす（日本語は1文字あたり約2〜3バイト）
+    body_length = max(200, size // 3) if attachments == 0 else min(4 * KB, size // 4)
+
+    body = MIMEMultipart("alternative")
+    body.attach(text_part(rng, body_length, charset))
+    body.attach(text_part(rng, body_length // 2, charset))
+    for _ in range(max(0, depth - 1)):
+        wrapper = MIMEMultipart("related" if rng.random() < 0.5 else "mixed")
+        wrapper.attach(body)
+        body = wrapper
+
+    message = MIMEMultipart("mixed")
+    message["From"] = "Benchmark Sender <sender@example.com>"
+    message["To"] = "to@example.com"
+    message["Subject"] = f"benchmark {name}"
+    message["Date"] = formatdate(0)
+    message["Message-ID"] = f"<{name}.{seed}@example.com>"
+    message.attach(body)
+
+    # base64 で約 4/3 倍になるため、添付ファイルのデータは残りサイズの 3/4 とする
+    remaining = max(0, size - body_length * 3) * 3 // 4
+    for index in range(attachments):
+        data_size = remaining // attachments
+        attachment = MIMEApplication(rng.randbytes(data_size), "octet-stream")
+        attachment.add_header("Content-Disposition", "attachment", filename=f"attachment-{index}.bin")
+        message.attach(attachment)
+
+    return message.as_bytes()
+
+def iter_cases(full=False):
+    """ベンチマークのケースを列挙"""
+    yield from DEFAULT_CASES
+    if full:
+        yield from FULL_CASES
+
+def main():
+    parser = argparse.ArgumentParser(description="ベンチマーク用の合成メールを .eml ファイルとして書き出す")
+    parser.add_argument("--output-dir", required=True, help="出力先のディレクトリ")
+    parser.add_argument("--full", action="store_true", help="35MB のケースも生成する")
+    parser.add_argument("--seed", type=int, default=0, help="乱数のシード（既定値 0）")
+    args = parser.parse_args()
+
+    os.makedirs(args.output_dir, exist_ok=True)
+    for case in iter_cases(args.full):
+        data = generate_message(*case, seed=args.seed)
+        with open(os.path.join(args.output_dir, f"{case[0]}.eml"), "wb") as f:
+            f.write(data)
+        print(f"{case[0]}: {len(data)} bytes")
+
+if __name__ == "__main__":
+    main()
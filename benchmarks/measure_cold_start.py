@@ -0,0 +1,115 @@
+"""コールドスタートのコスト計測スクリプト
+新しい Python プロセスで lambda_function を読み込み、以下の時間を計測する。
+- import: モジュールの読み込み時間
+- clients: S3 / SES クライアントの生成時間
+- early_exit: 転送先が設定されていないメールの処理時間（AWSサービスを使わない経路）
+あわせて -X importtime の結果から、読み込み時間の大きいモジュールを集計する。
+計測結果は JSON 形式で出力する。
+
+使用例:
+    python benchmarks/measure_cold_start.py --runs 20 --output cold_start.json
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# 計測用の子プロセスで実行するコード
+PROBE = """
+import json, time
+t0 = time.perf_counter()
+import lambda_function
+t1 = time.perf_counter()
+lambda_function.lambda_handler({'Records': [{'ses': {
+    'mail': {'messageId': 'cold-start-probe'},
+    'receipt': {'recipients': ['unknown@example.com']}
+}}]}, None)
+t2 = time.perf_counter()
+lambda_function.get_s3_client()
+lambda_function.get_ses_client()
+t3 = time.perf_counter()
+print(json.dumps({'import': t1 - t0, 'early_exit': t2 - t1, 'clients': t3 - t2}))
+"""
+
+def probe_env():
+    """計測用の環境変数を作成
+    実際のAWSには接続しないため、ダミーの認証情報とリージョンを設定する。
+    * Input Value: なし
+    * Output Value: 環境変数（辞書型）
+    """
+    env = dict(os.environ)
+    env.update({
+        'AWS_DEFAULT_REGION': 'ap-northeast-1',
+        'AWS_ACCESS_KEY_ID': 'testing',
+        'AWS_SECRET_ACCESS_KEY': 'testing',
+        'MAIL_FORWARDS': '{}',
+        'PYTHONDONTWRITEBYTECODE': '1',
+    })
+    return env
+
+def run_probe():
+    """子プロセスで1回分の計測を実行
+    * Input Value: なし
+    * Output Value: 計測結果（秒、辞書型）
+    """
+    output = subprocess.run(
+        [sys.executable, '-c', PROBE], cwd=ROOT_DIR, env=probe_env(),
+        check=True, capture_output=True, text=True
+    ).stdout
+    return json.loads(output.strip().splitlines()[-1])
+
+def import_profile(top):
+    """-X importtime の結果から読み込み時間の大きいモジュールを集計
+    * Input Value: 出力するモジュール数
+    * Output Value: モジュール名と累積読み込み時間（ミリ秒）のリスト
+    """
+    stderr = subprocess.run(
+        [sys.executable, '-X', 'importtime', '-c', 'import lambda_function'], cwd=ROOT_DIR,
+        env=probe_env(), check=True, capture_output=True, text=True
+    ).stderr
+    modules = []
+    for line in stderr.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        _, cumulative, name = line[len('import time:'):].split('|')
+        modules.append({'module': name.strip(), 'cumulative_ms': int(cumulative) / 1000})
+    modules.sort(key=lambda module: module['cumulative_ms'], reverse=True)
+    return modules[:top]
+
+def summarize(samples):
+    """計測値の統計量を計算（ミリ秒）"""
+    samples_ms = [sample * 1000 for sample in samples]
+    return {
+        'median_ms': round(statistics.median(samples_ms), 3),
+        'min_ms': round(min(samples_ms), 3),
+        'max_ms': round(max(samples_ms), 3),
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description='lambda_function のコールドスタートのコストを計測する')
+    parser.add_argument('--runs', type=int, default=10, help='計測回数（既定値 10）')
+    parser.add_argument('--top', type=int, default=15, help='出力する読み込み時間上位のモジュール数（既定値 15）')
+    parser.add_argument('--output', help='計測結果の出力先ファイル（省略時は標準出力）')
+    args = parser.parse_args()
+
+    results = [run_probe() for _ in range(args.runs)]
+    report = {
+        'python': sys.version.split()[0],
+        'runs': args.runs,
+        'stages': {stage: summarize([result[stage] for result in results]) for stage in results[0]},
+        'imports': import_profile(args.top),
+    }
+
+    text = json.dumps(report, indent=2, ensure_ascii=False)
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            f.write(text + '\n')
+    else:
+        print(text)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,220 @@
+"""転送処理のステージ別ベンチマーク
+合成メールコーパス（benchmarks/corpus.py）の各ケースについて、moto でモック化した S3 / SES を使い、
+以下のステージごとの処理時間（中央値）と tracemalloc によるピークメモリを計測する。
+- fetch: S3からの取得（INGEST_MODE=string の場合は chardet による文字列化を含む）
+- parse: オリジナルメールのパース（INGEST_MODE=stream の場合は取得とパースを重ねて行うため fetch に含める）
+- build: 転送メールの作成（create_forwarded_message / decode_parts など、FORWARD_MODE に従う）
+- serialize: 転送メールのバイト列への出力
+- send: SESへの送信
+計測結果は JSON 形式で出力し、--baseline で指定した過去の結果と比較できる。
+
+使用例:
+    python benchmarks/run_benchmarks.py --output bench.json
+    python benchmarks/run_benchmarks.py --baseline bench.json --max-regression 1.2
+"""
+import argparse
+import json
+import os
+import statistics
+import sys
+import time
+import tracemalloc
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT_DIR)
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import corpus  # noqa: E402
+
+STAGES = ["fetch", "parse", "build", "serialize", "send"]
+
+# 比較時に処理時間の悪化とみなさない下限（ミリ秒）
+NOISE_FLOOR_MS = 1.0
+
+def setup_environment():
+    """ベンチマーク用の環境変数を設定（既に設定されている値は上書きしない）"""
+    for name, value in {
+        "AWS_DEFAULT_REGION": "ap-northeast-1",
+        "AWS_ACCESS_KEY_ID": "testing",
+        "AWS_SECRET_ACCESS_KEY": "testing",
+        "S3_BUCKET": "benchmark-bucket",
+        "S3_PATH": "benchmark",
+        "SENDER_EMAIL": "no-reply@example.com",
+        "MAX_MESSAGE_SIZE": "0",
+    }.items():
+        os.environ.setdefault(name, value)
+
+def run_pipeline(lambda_function, key, measure):
+    """転送処理を1回実行し、ステージごとに measure(ステージ名, 処理) を呼び出す
+    * Input Value: lambda_function モジュール、S3のキー、計測関数
+    * Output Value: 転送メールのサイズ（バイト）
+    """
+    from email import message_from_bytes, message_from_string
+
+    bucket = os.environ["S3_BUCKET"]
+    ingest_mode = os.environ.get("INGEST_MODE", "bytes").lower()
+    if ingest_mode == "stream":
+        original_message = measure("fetch", lambda: lambda_function.stream_message_from_s3(bucket, key))
+        data = measure("parse", lambda: None)
+    elif ingest_mode == "string":
+        data = measure("fetch", lambda: lambda_function.get_message_from_s3(bucket, key))
+        original_message = measure("parse", lambda: message_from_string(data))
+    else:
+        data = measure("fetch", lambda: lambda_function.get_raw_message_from_s3(bucket, key))
+        original_message = measure("parse", lambda: message_from_bytes(data))
+    del data
+
+    forwarded_message = measure("build", lambda: lambda_function.build_forwarded_message(
+        original_message, "to@example.com", "forward-to@example.com"
+    ))
+
+    def serialize():
+        with lambda_function.serialized_message(forwarded_message) as (_, size):
+            return size
+
+    size = measure("serialize", serialize)
+
+    # 送信の計測には出力を含めないため、あらためて出力したものを送信する
+    with lambda_function.serialized_message(forwarded_message) as (raw, _):
+        measure("send", lambda: lambda_function.send_raw_message(forwarded_message["From"], raw))
+    lambda_function.close_spools(original_message)
+    return size
+
+def benchmark_case(lambda_function, case, repeat, seed):
+    """1ケース分の計測
+    処理時間は tracemalloc を無効にした状態で repeat 回計測した中央値、
+    ピークメモリは別途1回実行して、ステージ開始時点からの増分の最大値を計測する。
+    * Input Value: lambda_function モジュール、ケース、繰り返し回数、乱数のシード
+    * Output Value: 計測結果（辞書型）
+    """
+    import boto3
+
+    name = case[0]
+    data = corpus.generate_message(*case, seed=seed)
+    key = f"{os.environ['S3_PATH']}/{name}"
+    boto3.client("s3").put_object(Bucket=os.environ["S3_BUCKET"], Key=key, Body=data)
+    del data
+
+    timings = {stage: [] for stage in STAGES}
+
+    def measure_time(stage, func):
+        started = time.perf_counter()
+        result = func()
+        timings[stage].append((time.perf_counter() - started) * 1000)
+        return result
+
+    for _ in range(repeat):
+        output_size = run_pipeline(lambda_function, key, measure_time)
+
+    peaks = {}
+
+    def measure_memory(stage, func):
+        current, _ = tracemalloc.get_traced_memory()
+        tracemalloc.reset_peak()
+        result = func()
+        peaks[stage] = (tracemalloc.get_traced_memory()[1] - current) / 1024
+        return result
+
+    tracemalloc.start()
+    try:
+        run_pipeline(lambda_function, key, measure_memory)
+    finally:
+        tracemalloc.stop()
+
+    input_size = boto3.client("s3").head_object(Bucket=os.environ["S3_BUCKET"], Key=key)["ContentLength"]
+    return {
+        "input_bytes": input_size,
+        "output_bytes": output_size,
+        "attachments": case[2],
+        "depth": case[3],
+        "charset": case[4],
+        "stages": {
+            stage: {
+                "time_ms": round(statistics.median(timings[stage]), 3),
+                "peak_kb": round(peaks[stage], 1),
+            }
+            for stage in STAGES
+        },
+    }
+
+def compare(report, baseline, max_regression):
+    """過去の計測結果と比較して表示
+    * Input Value: 今回の計測結果、過去の計測結果、悪化とみなす処理時間の比率
+    * Output Value: 悪化したステージの一覧
+    """
+    regressions = []
+    print(f"{'case':32} {'stage':10} {'baseline':>12} {'current':>12} {'ratio':>7}")
+    for name, case in report["cases"].items():
+        base_case = baseline.get("cases", {}).get(name)
+        if base_case is None:
+            continue
+        for stage in STAGES:
+            current = case["stages"][stage]["time_ms"]
+            base = base_case["stages"][stage]["time_ms"]
+            ratio = current / base if base else float("inf")
+            mark = ""
+            if ratio > max_regression and current - base > NOISE_FLOOR_MS:
+                regressions.append((name, stage, ratio))
+                mark = " !"
+            print(f"{name:32} {stage:10} {base:10.3f}ms {current:10.3f}ms {ratio:6.2f}x{mark}")
+    return regressions
+
+def main():
+    parser = argparse.ArgumentParser(description="転送処理のステージ別ベンチマーク")
+    parser.add_argument("--full", action="store_true", help="35MB のケースも計測する")
+    parser.add_argument("--cases", help="計測するケース名（カンマ区切り、部分一致）")
+    parser.add_argument("--repeat", type=int, default=3, help="処理時間の計測回数（既定値 3）")
+    parser.add_argument("--seed", type=int, default=0, help="コーパス生成の乱数のシード（既定値 0）")
+    parser.add_argument("--output", help="計測結果の出力先ファイル（省略時は標準出力）")
+    parser.add_argument("--baseline", help="比較する過去の計測結果のファイル")
+    parser.add_argument("--max-regression", type=float, default=1.2,
+                        help="処理時間がこの比率を超えて悪化した場合に終了コード 1 とする（既定値 1.2）")
+    args = parser.parse_args()
+
+    setup_environment()
+    from moto import mock_aws
+
+    cases = list(corpus.iter_cases(args.full))
+    if args.cases:
+        patterns = [pattern.strip() for pattern in args.cases.split(",")]
+        cases = [case for case in cases if any(pattern in case[0] for pattern in patterns)]
+
+    with mock_aws():
+        import boto3
+        import lambda_function
+
+        region = os.environ["AWS_DEFAULT_REGION"]
+        boto3.client("s3").create_bucket(
+            Bucket=os.environ["S3_BUCKET"], CreateBucketConfiguration={"LocationConstraint": region}
+        )
+        boto3.client("ses").verify_email_identity(EmailAddress=os.environ["SENDER_EMAIL"])
+
+        report = {
+            "python": sys.version.split()[0],
+            "ingest_mode": os.environ.get("INGEST_MODE", "bytes"),
+            "forward_mode": os.environ.get("FORWARD_MODE", "rebuild"),
+            "repeat": args.repeat,
+            "seed": args.seed,
+            "cases": {},
+        }
+        for case in cases:
+            report["cases"][case[0]] = benchmark_case(lambda_function, case, args.repeat, args.seed)
+            stages = report["cases"][case[0]]["stages"]
+            print(f"{case[0]}: " + ", ".join(f"{stage} {stages[stage]['time_ms']:.1f}ms" for stage in STAGES),
+                  file=sys.stderr)
+
+    text = json.dumps(report, indent=2, ensure_ascii=False)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            f.write(text + "\n")
+    elif not args.baseline:
+        print(text)
+
+    if args.baseline:
+        with open(args.baseline, encoding="utf-8") as f:
+            regressions = compare(report, json.load(f), args.max_regression)
+        if regressions:
+            sys.exit(1)
+
+if __name__ == "__main__":
+    main()
@@ -1,27 +1,221 @@
+import copy
 import json
+import mmap
 import os
-import boto3
-import chardet
-import email
-from email.mime.multipart import MIMEMultipart
-from email.mime.text import MIMEText
-from email.mime.message import MIMEMessage
+import re
+import tempfile
+import threading
+import time
 from email.header import decode_header
 from email.header import Header
 from email.utils import formataddr
 from email import message_from_bytes, message_from_string
+from email.feedparser import BufferedSubFile, BytesFeedParser, NeedMoreData, NLCRE_eol, EMPTYSTRING
 from email.message import Message
 from email.errors import MessageParseError
-from botocore.exceptions import ClientError
+from email.parser import BytesParser
+from botocore.exceptions import ClientError, HTTPClientError
+from botocore.exceptions import ConnectionError as BotoConnectionError
+from concurrent.futures import ThreadPoolExecutor
+from collections import OrderedDict
+from contextlib import contextmanager
 import logging
 
 # ロガーの設定
 logger = logging.getLogger()
 logger.setLevel(logging.INFO)
 
-# AWS サービスのクライアント初期化
-s3_client = boto3.client('s3')
-ses_client = boto3.client('ses')
+# AWS サービスのクライアント（初回使用時に生成し、ウォームコンテナ間で再利用）
+_clients = {}
+_clients_lock = threading.Lock()
+
+# SES送信のレート制限（環境変数 SES_MAX_SEND_RATE が設定されている場合のみ使用）
+_send_rate_limiter = None
+
+# 送信方式（SEND_TRANSPORT）ごとの送信処理（SMTP の接続はウォームコンテナ間で再利用）
+_send_transport = None
+
+# コンパイル済み転送設定のキャッシュ（ウォームコンテナ間で再利用）
+_routing_cache = {}
+_routing_lock = threading.Lock()
+
+# コンパイル済みの受信判定ポリシー（ウォームコンテナ間で再利用）
+_verdict_policy_cache = {}
+
+# 冪等性ストア（送信済みの転送を記録し、リトライ時の再送信を防ぐ）
+_idempotency_store = None
+_idempotency_lock = threading.Lock()
+
+# デコード用のワーカープロセス（環境変数 DECODE_WORKERS が設定されている場合のみ使用）
+_decode_pool = None
+_decode_pool_lock = threading.Lock()
+
+# 送信者ドメインごとの文字コードの判定結果（ウォームコンテナ間で再利用）
+_charset_cache = OrderedDict()
+_charset_cache_lock = threading.Lock()
+
+class InvocationMetrics:
+    """呼び出し単位のメトリクス
+    処理中に記録した値をメトリクス名ごとに保持し、CloudWatch Embedded Metric Format（EMF）の
+    JSON として標準出力に書き出す。複数のスレッドから記録できる。
+    """
+
+    def __init__(self, properties=None):
+        self.properties = properties or {}
+        self._values = {}
+        self._units = {}
+        self._lock = threading.Lock()
+
+    def add(self, name, value, unit='Count'):
+        """メトリクスの値を記録"""
+        with self._lock:
+            self._values.setdefault(name, []).append(value)
+            self._units[name] = unit
+
+    def to_emf(self):
+        """EMF 形式の辞書型に変換"""
+        namespace = os.environ.get('METRICS_NAMESPACE', 'SESTransferEmail')
+        function_name = os.environ.get('AWS_LAMBDA_FUNCTION_NAME', 'local')
+        with self._lock:
+            document = {
+                '_aws': {
+                    'Timestamp': int(time.time() * 1000),
+                    'CloudWatchMetrics': [{
+                        'Namespace': namespace,
+                        'Dimensions': [['FunctionName']],
+                        'Metrics': [{'Name': name, 'Unit': self._units[name]} for name in self._values],
+                    }],
+                },
+                'FunctionName': function_name,
+            }
+            document.update(self.properties)
+            for name, values in self._values.items():
+                document[name] = values[0] if len(values) == 1 else values
+        return document
+
+    def emit(self):
+        """メトリクスを標準出力に書き出す（記録した値がない場合は何もしない）"""
+        if self._values:
+            print(json.dumps(self.to_emf(), ensure_ascii=False), flush=True)
+
+# 処理中の呼び出しのメトリクス（Lambda のコンテナは同時に1件の呼び出しのみを処理する）
+_current_metrics = None
+
+def record_metric(name, value, unit='Count'):
+    """処理中の呼び出しのメトリクスに値を記録（メトリクスが無効な場合は何もしない）"""
+    metrics = _current_metrics
+    if metrics is not None:
+        metrics.add(name, value, unit)
+
+@contextmanager
+def stage_timer(name):
+    """with 文で囲んだ処理の時間をミリ秒単位のメトリクスとして記録"""
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        record_metric(name, (time.perf_counter() - started) * 1000, 'Milliseconds')
+
+# 処理中の呼び出しの残り時間（lambda_handler / sqs_handler の実行中のみ設定）
+_current_deadline = None
+
+# ステージごとの処理時間の推定値（秒、ウォームコンテナ間で学習を引き継ぐ）
+DEFAULT_STAGE_COSTS = {
+    'load': 0.5,
+    'build:rebuild': 1.0,
+    'build:passthrough': 0.2,
+    'build:attach': 0.2,
+    'send': 0.5,
+}
+# 推定値を上回った場合は速く、下回った場合はゆっくり追従させる
+STAGE_COST_ALPHA_UP = 0.5
+STAGE_COST_ALPHA_DOWN = 0.2
+_stage_costs = {}
+_stage_costs_lock = threading.Lock()
+
+def observe_stage_cost(stage, seconds):
+    """ステージの処理時間を記録し、推定値（指数加重移動平均）を更新"""
+    with _stage_costs_lock:
+        estimate = _stage_costs.get(stage)
+        if estimate is None:
+            _stage_costs[stage] = seconds
+        else:
+            alpha = STAGE_COST_ALPHA_UP if seconds > estimate else STAGE_COST_ALPHA_DOWN
+            _stage_costs[stage] = estimate + alpha * (seconds - estimate)
+
+def estimate_stage_cost(stage):
+    """ステージの処理時間の推定値（秒）を取得（未計測の場合は既定値）"""
+    return _stage_costs.get(stage, DEFAULT_STAGE_COSTS.get(stage, 0.0))
+
+class Deadline:
+    """Lambda の残り実行時間
+    context.get_remaining_time_in_millis() から安全マージン（環境変数 DEADLINE_SAFETY_MARGIN_MS、既定値 1000）を
+    差し引いた時間を残り時間とする。context がない場合（ローカル実行など）は時間の制限なしとする。
+    """
+
+    def __init__(self, context=None):
+        self._get_remaining_time = getattr(context, 'get_remaining_time_in_millis', None)
+        self.margin = int(os.environ.get('DEADLINE_SAFETY_MARGIN_MS', '1000')) / 1000
+
+    def remaining(self):
+        """残り時間（秒）"""
+        if self._get_remaining_time is None:
+            return float('inf')
+        return self._get_remaining_time() / 1000 - self.margin
+
+    def allows(self, *stages):
+        """指定したステージの処理時間の推定値の合計が、残り時間に収まるかを判定"""
+        return self.remaining() >= sum(estimate_stage_cost(stage) for stage in stages)
+
+def get_current_deadline():
+    """処理中の呼び出しの残り時間を取得（ハンドラー外の呼び出しでは時間の制限なし）"""
+    return _current_deadline or Deadline()
+
+class ForwardingFailedError(Exception):
+    """再試行可能な失敗をしたレコードがある場合のエラー
+    SES からの非同期呼び出しのリトライで処理し直させるため、全レコードの処理後に送出する。
+    レコードごとの処理結果は response に保持する。
+    """
+
+    def __init__(self, message, response=None):
+        super().__init__(message)
+        self.response = response
+
+class DeadlineExceededError(ForwardingFailedError):
+    """残り時間が足りないため、転送を次の呼び出しに持ち越した場合のエラー"""
+
+# 時間をおいて再試行すれば成功する可能性がある AWS のエラーコード
+RETRYABLE_ERROR_CODES = {
+    'Throttling', 'ThrottlingException', 'TooManyRequestsException', 'RequestLimitExceeded',
+    'ProvisionedThroughputExceededException', 'SlowDown', 'ServiceUnavailable',
+    'InternalError', 'InternalFailure', 'RequestTimeout', 'RequestTimeoutException',
+}
+
+def is_retryable_error(error):
+    """転送時に発生したエラーが一時的なもの（リトライで成功する可能性がある）かを判定
+    AWS のスロットリング・5xx・通信エラーと、SMTP の 4xx 応答・接続エラーを一時的なエラーとする。
+    メールが存在しない・サイズ超過・SES による拒否などは、リトライしても成功しないため恒久的なエラーとする。
+    * Input Value: 例外
+    * Output Value: 一時的なエラーの場合は True
+    """
+    import smtplib
+
+    if isinstance(error, ClientError):
+        code = error.response.get('Error', {}).get('Code')
+        status = error.response.get('ResponseMetadata', {}).get('HTTPStatusCode') or 0
+        return code in RETRYABLE_ERROR_CODES or status == 429 or status >= 500
+    if isinstance(error, (BotoConnectionError, HTTPClientError)):
+        return True
+    if isinstance(error, smtplib.SMTPRecipientsRefused):
+        return all(400 <= code < 500 for code, _ in error.recipients.values())
+    if isinstance(error, smtplib.SMTPResponseException):
+        return 400 <= error.smtp_code < 500
+    return isinstance(error, (smtplib.SMTPServerDisconnected, ConnectionError, TimeoutError))
+
+def count_throttling(response=None, **kwargs):
+    """SESの送信レート超過（Throttling）によるリトライを数える（botocore の needs-retry イベントハンドラー）"""
+    if response is not None and response[1].get('Error', {}).get('Code') == 'Throttling':
+        record_metric('SESThrottleCount', 1)
 
 def get_email_forwards():
     """環境変数からメール転送設定を取得
@@ -37,21 +231,1031 @@ def get_email_forwards():
         logger.error("MAIL_FORWARDS環境変数の解析に失敗しました")
         return {}
 
+def build_client_config(service_name):
+    """AWSサービスのクライアント設定を作成
+    並行処理するスレッド数（MAX_WORKERS）に合わせてコネクションプールを確保し、TCP keep-alive を有効にする。
+    SES では送信レート超過（Throttling）を吸収するため、adaptive モードのリトライを使用する
+    （最大試行回数は環境変数 SES_MAX_ATTEMPTS、既定値 8）。
+    * Input Value: サービス名
+    * Output Value: botocore の Config オブジェクト
+    """
+    from botocore.config import Config
+
+    options = {
+        'max_pool_connections': max(10, int(os.environ.get('MAX_WORKERS', '4')) * 2),
+        'tcp_keepalive': True,
+    }
+    if service_name == 'ses':
+        options['retries'] = {
+            'mode': 'adaptive',
+            'max_attempts': int(os.environ.get('SES_MAX_ATTEMPTS', '8')),
+        }
+    return Config(**options)
+
+def get_aws_client(service_name):
+    """AWSサービスのクライアントを取得
+    初回呼び出し時にクライアントを生成してキャッシュする。
+    転送先が設定されていないメールなど、AWSサービスを使わない呼び出しでは boto3 の読み込み自体を行わない。
+    * Input Value: サービス名
+    * Output Value: boto3 クライアント
+    """
+    client = _clients.get(service_name)
+    if client is None:
+        with _clients_lock:
+            client = _clients.get(service_name)
+            if client is None:
+                import boto3
+                client = boto3.client(service_name, config=build_client_config(service_name))
+                if service_name == 'ses':
+                    client.meta.events.register('needs-retry.ses.SendRawEmail', count_throttling)
+                _clients[service_name] = client
+    return client
+
+def get_s3_client():
+    """S3クライアントを取得"""
+    return get_aws_client('s3')
+
+def get_ses_client():
+    """SESクライアントを取得"""
+    return get_aws_client('ses')
+
+class TokenBucket:
+    """トークンバケット方式のレート制限
+    1秒あたり rate 個のトークンを補充し、最大 capacity 個まで蓄積する。
+    スレッドセーフで、トークンが不足している場合は補充されるまで待機する。
+    """
+
+    def __init__(self, rate, capacity=None):
+        self.rate = float(rate)
+        self.capacity = float(capacity or max(1.0, self.rate))
+        self._tokens = self.capacity
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self, tokens=1):
+        """トークンを取得
+        capacity を超えるトークン数を要求された場合は、バケットが満杯になった時点で取得し、
+        不足分は後続の取得を待機させることで帳尻を合わせる。
+        * Input Value: 取得するトークン数
+        * Output Value: 待機した時間（秒）
+        """
+        waited = 0.0
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+                self._updated = now
+                required = min(tokens, self.capacity)
+                if self._tokens >= required:
+                    self._tokens -= tokens
+                    return waited
+                wait = (required - self._tokens) / self.rate
+            time.sleep(wait)
+            waited += wait
+
+def get_send_rate_limiter():
+    """SES送信のレート制限を取得
+    環境変数 SES_MAX_SEND_RATE（1秒あたりの送信数、SESの送信クォータに合わせる）が設定されている場合に、
+    トークンバケットを生成してキャッシュする。バースト時の上限は SES_SEND_BURST（省略時は SES_MAX_SEND_RATE）。
+    * Input Value: 環境変数 SES_MAX_SEND_RATE、SES_SEND_BURST
+    * Output Value: TokenBucket オブジェクト（レート制限しない場合は None）
+    """
+    rate = float(os.environ.get('SES_MAX_SEND_RATE', '0') or 0)
+    if rate <= 0:
+        return None
+    global _send_rate_limiter
+    capacity = float(os.environ.get('SES_SEND_BURST', '0') or 0) or max(1.0, rate)
+    with _clients_lock:
+        limiter = _send_rate_limiter
+        if limiter is None or (limiter.rate, limiter.capacity) != (rate, capacity):
+            limiter = _send_rate_limiter = TokenBucket(rate, capacity)
+    return limiter
+
+class SesTransport:
+    """SES API（SendRawEmail）による送信"""
+
+    def send(self, source, data, destinations=None):
+        """メールを送信
+        送信先アドレスを指定しない場合は、SES がメールのヘッダー（To / Cc / Bcc）から送信先を決める。
+        * Input Value: 送信元アドレス、MIMEメッセージ（バイト列 または mmap）、送信先アドレスのリスト
+        * Output Value: SESのレスポンス
+        """
+        params = {'Source': source, 'RawMessage': {'Data': data}}
+        if destinations:
+            params['Destinations'] = destinations
+        with stage_timer('SESLatency'):
+            return get_ses_client().send_raw_email(**params)
+
+    def close(self):
+        """SES API では切断する接続はない"""
+
+def get_envelope_recipients(data):
+    """MIMEメッセージのヘッダー（To / Cc / Bcc）から送信先アドレスを取得"""
+    from email.parser import BytesHeaderParser
+    from email.utils import getaddresses
+
+    end = data.find(b'\r\n\r\n')
+    if end < 0:
+        end = data.find(b'\n\n')
+    headers = BytesHeaderParser().parsebytes(bytes(data[:end if end >= 0 else len(data)]))
+    values = [str(value) for name in ('To', 'Cc', 'Bcc') for value in headers.get_all(name, [])]
+    return [address for _, address in getaddresses(values) if address]
+
+# SMTP で送信する際に CRLF に揃える改行
+SMTP_NEWLINE_RE = re.compile(rb'\r\n|\n|\r(?!\n)')
+
+class SmtpTransport:
+    """SMTP による送信
+    SES の SMTP エンドポイントや社内のリレーサーバーへの接続を、認証済みのままプールしてウォームコンテナ間で再利用する。
+    1つの接続で複数のメールを送信し、サーバーが PIPELINING に対応している場合は MAIL FROM と RCPT TO をまとめて送る。
+    """
+
+    def __init__(self, host, port=587, security='starttls', username=None, password=None,
+                 timeout=30.0, pool_size=4, max_messages=100, idle_timeout=60.0):
+        self.host = host
+        self.port = port
+        self.security = security
+        self.username = username
+        self.password = password
+        self.timeout = timeout
+        self.pool_size = pool_size
+        self.max_messages = max_messages
+        self.idle_timeout = idle_timeout
+        # 空いている接続（接続, 送信数, 最終使用時刻）。最後に使用したものから再利用する
+        self._idle = []
+        self._lock = threading.Lock()
+
+    def connect(self):
+        """SMTPサーバーに接続し、必要に応じて STARTTLS と認証を行う"""
+        import smtplib
+        import ssl
+
+        if self.security == 'ssl':
+            connection = smtplib.SMTP_SSL(self.host, self.port, timeout=self.timeout,
+                                          context=ssl.create_default_context())
+        else:
+            connection = smtplib.SMTP(self.host, self.port, timeout=self.timeout)
+        try:
+            connection.ehlo()
+            if self.security == 'starttls':
+                connection.starttls(context=ssl.create_default_context())
+                connection.ehlo()
+            if self.username:
+                connection.login(self.username, self.password or '')
+        except Exception:
+            connection.close()
+            raise
+        record_metric('SMTPConnectCount', 1)
+        return connection
+
+    def acquire(self):
+        """プールから接続を取得（空いている接続がない場合は新たに接続する）
+        * Output Value: (接続, 送信数, 再利用した接続か) のタプル
+        """
+        now = time.monotonic()
+        stale = []
+        acquired = None
+        with self._lock:
+            while self._idle:
+                connection, sent, last_used = self._idle.pop()
+                if self.idle_timeout and now - last_used > self.idle_timeout:
+                    stale.append(connection)
+                    continue
+                acquired = (connection, sent, True)
+                break
+        for connection in stale:
+            self.discard(connection)
+        return acquired or (self.connect(), 0, False)
+
+    def release(self, connection, sent):
+        """送信を終えた接続をプールに戻す（送信数の上限に達した場合やプールが満杯の場合は切断する）"""
+        if not (self.max_messages and sent >= self.max_messages):
+            with self._lock:
+                if len(self._idle) < self.pool_size:
+                    self._idle.append((connection, sent, time.monotonic()))
+                    return
+        self.discard(connection, quit=True)
+
+    def discard(self, connection, quit=False):
+        """接続を切断する（切断時のエラーは無視する）"""
+        try:
+            if quit:
+                connection.quit()
+            else:
+                connection.close()
+        except Exception:
+            connection.close()
+
+    def transfer(self, connection, source, data, recipients):
+        """1つの接続でメールを1通送信
+        * Input Value: 接続、送信元アドレス、MIMEメッセージ、送信先アドレスのリスト
+        * Output Value: DATA の応答
+        """
+        import smtplib
+
+        options = f' SIZE={len(data)}' if connection.has_extn('size') else ''
+        if connection.has_extn('pipelining'):
+            # MAIL FROM と RCPT TO をまとめて送信し、応答をまとめて受け取る
+            commands = [f'MAIL FROM:{smtplib.quoteaddr(source)}{options}']
+            commands += [f'RCPT TO:{smtplib.quoteaddr(recipient)}' for recipient in recipients]
+            connection.send(''.join(f'{command}\r\n' for command in commands))
+            replies = [connection.getreply() for _ in commands]
+        else:
+            replies = [connection.mail(source, [options.strip()] if options else [])]
+            if replies[0][0] == 250:
+                replies += [connection.rcpt(recipient) for recipient in recipients]
+        code, message = replies[0]
+        if code != 250:
+            connection.rset()
+            raise smtplib.SMTPSenderRefused(code, message, source)
+        refused = {recipient: reply for recipient, reply in zip(recipients, replies[1:]) if reply[0] not in (250, 251)}
+        if len(refused) == len(recipients):
+            connection.rset()
+            raise smtplib.SMTPRecipientsRefused(refused)
+        if refused:
+            logger.warning(f"SMTPサーバーが一部の送信先を拒否しました: {', '.join(refused)}")
+        code, message = connection.data(data)
+        if code != 250:
+            connection.rset()
+            raise smtplib.SMTPDataError(code, message)
+        return message
+
+    def send(self, source, data, destinations=None):
+        """メールを送信
+        送信先アドレスを指定しない場合は、SES API と同様にメールのヘッダー（To / Cc / Bcc）から送信先を決める。
+        再利用した接続がサーバー側で切断されていた場合は、新しい接続で1回だけ送信し直す。
+        * Input Value: 送信元アドレス、MIMEメッセージ（バイト列 または mmap）、送信先アドレスのリスト
+        * Output Value: SES API と同じ形式のレスポンス（MessageId には DATA の応答の最後の語を設定）
+        """
+        import smtplib
+
+        recipients = destinations or get_envelope_recipients(data)
+        if not recipients:
+            raise ValueError("送信先アドレスがありません")
+        # SMTP では改行を CRLF に揃える（転送メールの出力は LF のため）
+        data = SMTP_NEWLINE_RE.sub(b'\r\n', data)
+        with stage_timer('SMTPLatency'):
+            connection, sent, reused = self.acquire()
+            try:
+                reply = self.transfer(connection, source, data, recipients)
+            except (smtplib.SMTPResponseException, smtplib.SMTPRecipientsRefused):
+                # 応答によるエラーは RSET 済みのため、接続はそのまま再利用する
+                self.release(connection, sent)
+                raise
+            except OSError as e:
+                # smtplib の切断やタイムアウトなど（SMTPException も OSError のサブクラス）
+                self.discard(connection)
+                if not reused:
+                    raise
+                logger.info(f"SMTPの接続が切断されていたため再接続します: {str(e)}")
+                connection, sent = self.connect(), 0
+                try:
+                    reply = self.transfer(connection, source, data, recipients)
+                except Exception:
+                    self.discard(connection)
+                    raise
+            except Exception:
+                self.discard(connection)
+                raise
+            self.release(connection, sent + 1)
+        words = reply.decode('utf-8', errors='replace').split()
+        return {'MessageId': words[-1] if words else ''}
+
+    def close(self):
+        """プールの接続をすべて切断する"""
+        with self._lock:
+            idle, self._idle = self._idle, []
+        for connection, _, _ in idle:
+            self.discard(connection, quit=True)
+
+def get_transport_config():
+    """環境変数から送信方式の設定を取得
+    * Input Value: 環境変数 SEND_TRANSPORT、SMTP_HOST など
+    * Output Value: 設定のタプル（設定が変わった場合に送信処理を作り直すためのキー）
+    """
+    name = os.environ.get('SEND_TRANSPORT', 'ses').lower()
+    if name != 'smtp':
+        return (name,)
+    security = os.environ.get('SMTP_SECURITY', 'starttls').lower()
+    return (
+        name,
+        os.environ.get('SMTP_HOST', f"email-smtp.{os.environ.get('AWS_REGION') or os.environ.get('AWS_DEFAULT_REGION', 'us-east-1')}.amazonaws.com"),
+        int(os.environ.get('SMTP_PORT', '465' if security == 'ssl' else '587')),
+        security,
+        os.environ.get('SMTP_USERNAME'),
+        os.environ.get('SMTP_PASSWORD'),
+        float(os.environ.get('SMTP_TIMEOUT', '30')),
+        int(os.environ.get('SMTP_POOL_SIZE', os.environ.get('MAX_WORKERS', '4'))),
+        int(os.environ.get('SMTP_MAX_MESSAGES_PER_CONNECTION', '100')),
+        float(os.environ.get('SMTP_IDLE_TIMEOUT', '60')),
+    )
+
+def get_send_transport():
+    """送信処理を取得
+    環境変数 SEND_TRANSPORT が smtp の場合は SmtpTransport、それ以外は SesTransport を生成してキャッシュする。
+    設定が変わった場合は、以前の接続を切断して作り直す。
+    * Input Value: 環境変数 SEND_TRANSPORT、SMTP_*
+    * Output Value: SesTransport または SmtpTransport オブジェクト
+    """
+    global _send_transport
+    config = get_transport_config()
+    with _clients_lock:
+        current = _send_transport
+        if current is not None and current[0] == config:
+            return current[1]
+        transport = SmtpTransport(*config[1:]) if config[0] == 'smtp' else SesTransport()
+        _send_transport = (config, transport)
+    if current is not None:
+        current[1].close()
+    return transport
+
+def send_raw_message(source, data, recipient_count=1, destinations=None):
+    """転送メールを送信
+    送信は SEND_TRANSPORT で指定した送信処理（SES API または SMTP）で行う。
+    レート制限が設定されている場合は、SESの送信レートが受信者数単位であることに合わせて
+    受信者数分のトークンを取得してから送信する。送信レート超過時のリトライはクライアントの adaptive リトライに任せる。
+    * Input Value: 送信元アドレス、MIMEメッセージ（バイト列 または mmap）、受信者数、送信先アドレスのリスト
+    * Output Value: SESのレスポンス（SMTP の場合も MessageId を含む辞書型）
+    """
+    limiter = get_send_rate_limiter()
+    if limiter is not None:
+        waited = limiter.acquire(recipient_count)
+        if waited:
+            logger.info(f"SES送信レート制限により {waited:.3f} 秒待機しました")
+            record_metric('SendRateLimitWait', waited * 1000, 'Milliseconds')
+
+    return get_send_transport().send(source, data, destinations)
+
+def compile_routing_table(forwards):
+    """転送設定を検索用の構造にコンパイル
+    転送設定のkeyの書式に応じて、以下の3種類のルールに振り分ける。
+    - 'user@example.com': 完全一致（大文字小文字は区別しない）
+    - '*@example.com': ドメイン単位のキャッチオール
+    - '/正規表現/': 正規表現（設定の記述順に評価、アドレス全体に一致させる）
+    不正な正規表現はエラーログを出力して無視する。
+    * Input Value: 転送設定（辞書型）
+    * Output Value: ルーティングテーブル（辞書型）
+    """
+    table = {'exact': {}, 'domain': {}, 'patterns': []}
+    for key, forward_to in forwards.items():
+        if len(key) > 2 and key.startswith('/') and key.endswith('/'):
+            try:
+                table['patterns'].append((re.compile(key[1:-1], re.IGNORECASE), forward_to))
+            except re.error as e:
+                logger.error(f"転送設定の正規表現が不正です: {key}: {str(e)}")
+        elif key.startswith('*@'):
+            table['domain'][key[2:].lower()] = forward_to
+        else:
+            table['exact'][key.lower()] = forward_to
+    return table
+
+def resolve_forward(table, recipient):
+    """ルーティングテーブルから受信者アドレスの転送先を検索
+    完全一致 → サブアドレス（'+' 以降）を除いた完全一致 → ドメイン → 正規表現 の順に評価する。
+    サブアドレスの除去は環境変数 STRIP_PLUS_ADDRESS で無効化できる（既定値 true）。
+    * Input Value: ルーティングテーブル、受信者アドレス
+    * Output Value: 転送先アドレス（見つからない場合は None）
+    """
+    address = recipient.strip().lower()
+    local, _, domain = address.rpartition('@')
+
+    forward_to = table['exact'].get(address)
+    if forward_to is None and '+' in local and os.environ.get('STRIP_PLUS_ADDRESS', 'true').lower() == 'true':
+        forward_to = table['exact'].get(f"{local.split('+', 1)[0]}@{domain}")
+    if forward_to is None:
+        forward_to = table['domain'].get(domain)
+    if forward_to is None:
+        for pattern, pattern_forward_to in table['patterns']:
+            if pattern.fullmatch(address):
+                forward_to = pattern_forward_to
+                break
+    return forward_to
+
+# SES の受信判定（receipt に含まれる判定結果の名前）
+VERDICT_NAMES = ['spamVerdict', 'virusVerdict', 'spfVerdict', 'dkimVerdict', 'dmarcVerdict']
+# 受信判定ポリシーのアクション（影響の小さい順）
+VERDICT_ACTIONS = ['forward', 'flag', 'tag', 'drop']
+
+def get_verdict_policy():
+    """受信判定ポリシーを取得
+    環境変数 VERDICT_POLICY の JSON を、転送設定と同じ書式のkey（完全一致・'*@domain'・'/正規表現/'）で
+    検索できるようにコンパイルする。key '*' のルールはどの key にも一致しない受信者に適用する。
+    ウォームコンテナ間でキャッシュし、設定が変わった場合のみコンパイルし直す。
+    * Input Value: 環境変数 VERDICT_POLICY
+    * Output Value: {'table': ルーティングテーブル, 'default': 既定のルール}（未設定の場合は None）
+    """
+    source = os.environ.get('VERDICT_POLICY', '')
+    with _routing_lock:
+        if _verdict_policy_cache.get('source') != source:
+            policy = None
+            if source:
+                try:
+                    rules = json.loads(source)
+                    policy = {'default': rules.pop('*', None), 'table': compile_routing_table(rules)}
+                except (json.JSONDecodeError, AttributeError):
+                    logger.error("VERDICT_POLICY環境変数の解析に失敗しました")
+            _verdict_policy_cache.update(source=source, policy=policy)
+        return _verdict_policy_cache['policy']
+
+def evaluate_verdicts(rules, receipt):
+    """受信判定ポリシーのルールを SES の判定結果に適用
+    ルールは判定の名前ごとに、判定結果（PASS / FAIL / GRAY / PROCESSING_FAILED）とアクションを対応付ける
+    （例：{"virusVerdict": {"FAIL": "drop"}}）。複数のルールに一致した場合は最も影響の大きいアクションとする。
+    * Input Value: ルール（辞書型）、SESイベントの receipt
+    * Output Value: (アクション, 一致した判定（'spamVerdict=FAIL' など）のリスト) のタプル
+    """
+    action = 'forward'
+    reasons = []
+    for name in VERDICT_NAMES:
+        status = receipt.get(name, {}).get('status')
+        rule_action = (rules.get(name) or {}).get(status)
+        if rule_action is None or rule_action == 'forward':
+            continue
+        if rule_action not in VERDICT_ACTIONS:
+            logger.warning(f"受信判定ポリシーのアクションが不正です: {name}: {rule_action}")
+            continue
+        reasons.append(f'{name}={status}')
+        if VERDICT_ACTIONS.index(rule_action) > VERDICT_ACTIONS.index(action):
+            action = rule_action
+    return action, reasons
+
+def screen_recipients(recipients, receipt):
+    """受信者ごとに受信判定ポリシーを評価
+    S3 からメールを取得する前に、SESイベントの receipt に含まれる判定結果のみで評価する。
+    * Input Value: 受信者アドレスのリスト、SESイベントの receipt
+    * Output Value: 受信者アドレスをkey、(アクション, 一致した判定のリスト) をvalueとする辞書型
+    """
+    policy = get_verdict_policy()
+    verdicts = {}
+    for recipient in recipients:
+        rules = None
+        if policy is not None:
+            rules = resolve_forward(policy['table'], recipient)
+            if rules is None:
+                rules = policy['default']
+        verdicts[recipient] = evaluate_verdicts(rules, receipt) if rules else ('forward', [])
+    return verdicts
+
+def apply_verdict_tag(msg, verdict):
+    """受信判定ポリシーによるマークを転送メールに付与
+    flag の場合は X-Forward-Verdict ヘッダーのみ、tag の場合は件名の先頭にも
+    環境変数 VERDICT_SUBJECT_PREFIX（既定値 '[SUSPECTED SPAM] '）を付与する。
+    * Input Value: 転送メール、(アクション, 一致した判定のリスト) のタプル
+    * Output Value: なし（転送メールを直接更新）
+    """
+    action, reasons = verdict
+    if action not in ('flag', 'tag'):
+        return
+    msg['X-Forward-Verdict'] = f"{action}; {', '.join(reasons)}"
+    if action == 'tag':
+        subject = f"{os.environ.get('VERDICT_SUBJECT_PREFIX', '[SUSPECTED SPAM] ')}{header_to_str(msg['Subject'])}"
+        if 'Subject' in msg:
+            msg.replace_header('Subject', subject)
+        else:
+            msg['Subject'] = subject
+
+def load_forwards_from_s3(uri, etag=None):
+    """S3に保存された転送設定を取得
+    ETag を指定した場合は条件付きGET（If-None-Match）を行い、変更がなければ None を返す。
+    * Input Value: 転送設定のS3 URI（s3://bucket/key）、前回取得時の ETag
+    * Output Value: (転送設定（辞書型）または None, ETag) のタプル
+    """
+    bucket, _, key = uri[len('s3://'):].partition('/')
+    params = {'Bucket': bucket, 'Key': key}
+    if etag:
+        params['IfNoneMatch'] = etag
+    try:
+        response = get_s3_client().get_object(**params)
+    except ClientError as e:
+        if e.response['Error']['Code'] in ('304', 'NotModified'):
+            return None, etag
+        raise
+    return json.loads(response['Body'].read()), response['ETag']
+
+def get_routing_table():
+    """コンパイル済みのルーティングテーブルを取得
+    ウォームコンテナ間でキャッシュし、設定が変わった場合のみコンパイルし直す。
+    環境変数 MAIL_FORWARDS_S3_URI が設定されている場合はS3の転送設定を使用し、
+    MAIL_FORWARDS_TTL 秒（既定値 300）ごとに ETag による条件付きGETで更新を確認する。
+    S3からの取得に失敗した場合は、前回の設定（初回は環境変数 MAIL_FORWARDS）を使用する。
+    * Input Value: 環境変数 MAIL_FORWARDS、MAIL_FORWARDS_S3_URI、MAIL_FORWARDS_TTL
+    * Output Value: ルーティングテーブル（辞書型）
+    """
+    uri = os.environ.get('MAIL_FORWARDS_S3_URI')
+    with _routing_lock:
+        if not uri:
+            source = os.environ.get('MAIL_FORWARDS', '{}')
+            if _routing_cache.get('source') != source:
+                _routing_cache.clear()
+                _routing_cache.update(source=source, table=compile_routing_table(get_email_forwards()))
+            return _routing_cache['table']
+
+        now = time.monotonic()
+        if _routing_cache.get('source') == uri and now < _routing_cache['expires_at']:
+            return _routing_cache['table']
+
+        cached = _routing_cache.get('source') == uri
+        try:
+            forwards, etag = load_forwards_from_s3(uri, _routing_cache.get('etag') if cached else None)
+            if forwards is not None:
+                _routing_cache.update(source=uri, table=compile_routing_table(forwards), etag=etag)
+        except (ClientError, ValueError) as e:
+            logger.error(f"S3からの転送設定の取得に失敗: {str(e)}")
+            if not cached:
+                _routing_cache.update(source=uri, table=compile_routing_table(get_email_forwards()), etag=None)
+        _routing_cache['expires_at'] = now + float(os.environ.get('MAIL_FORWARDS_TTL', '300'))
+        return _routing_cache['table']
+
+class MemoryIdempotencyStore:
+    """ウォームコンテナ内で送信済みの転送を記録する冪等性ストア（LRU）"""
+
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        """送信済みであれば SES のメッセージIDを返す（未送信の場合は None）"""
+        with self._lock:
+            ses_message_id = self._entries.get(key)
+            if ses_message_id is not None:
+                self._entries.move_to_end(key)
+            return ses_message_id
+
+    def put(self, key, ses_message_id):
+        """送信済みとして記録"""
+        with self._lock:
+            self._entries[key] = ses_message_id
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+class DynamoDBIdempotencyStore:
+    """DynamoDB のテーブルに送信済みの転送を記録する冪等性ストア
+    テーブルのパーティションキーは文字列型の idempotencyKey とし、expiresAt（エポック秒）を TTL 属性として設定する。
+    読み込んだ結果や書き込んだ結果はウォームコンテナ内の LRU にも保持し、同じキーへの問い合わせを省略する。
+    """
+
+    def __init__(self, table_name, ttl, local_cache):
+        self.table_name = table_name
+        self.ttl = ttl
+        self.local_cache = local_cache
+
+    def get(self, key):
+        """送信済みであれば SES のメッセージIDを返す（未送信の場合は None）"""
+        ses_message_id = self.local_cache.get(key)
+        if ses_message_id is not None:
+            return ses_message_id
+        response = get_aws_client('dynamodb').get_item(
+            TableName=self.table_name,
+            Key={'idempotencyKey': {'S': key}},
+            ConsistentRead=True
+        )
+        item = response.get('Item')
+        if item is None or int(item['expiresAt']['N']) < time.time():
+            return None
+        ses_message_id = item['sesMessageId']['S']
+        self.local_cache.put(key, ses_message_id)
+        return ses_message_id
+
+    def put(self, key, ses_message_id):
+        """送信済みとして記録"""
+        self.local_cache.put(key, ses_message_id)
+        get_aws_client('dynamodb').put_item(
+            TableName=self.table_name,
+            Item={
+                'idempotencyKey': {'S': key},
+                'sesMessageId': {'S': ses_message_id},
+                'expiresAt': {'N': str(int(time.time() + self.ttl))}
+            }
+        )
+
+def get_idempotency_store():
+    """冪等性ストアを取得
+    環境変数 IDEMPOTENCY_TABLE が設定されている場合は DynamoDB、それ以外はウォームコンテナ内の LRU を使用する。
+    IDEMPOTENCY_CACHE_SIZE（既定値 1024）が 0 かつ IDEMPOTENCY_TABLE が未設定の場合は None（冪等性チェックなし）。
+    * Input Value: 環境変数 IDEMPOTENCY_TABLE、IDEMPOTENCY_TTL、IDEMPOTENCY_CACHE_SIZE
+    * Output Value: 冪等性ストア、または None
+    """
+    global _idempotency_store
+    if _idempotency_store is None:
+        with _idempotency_lock:
+            if _idempotency_store is None:
+                cache_size = int(os.environ.get('IDEMPOTENCY_CACHE_SIZE', '1024'))
+                table_name = os.environ.get('IDEMPOTENCY_TABLE')
+                if table_name:
+                    _idempotency_store = DynamoDBIdempotencyStore(
+                        table_name,
+                        int(os.environ.get('IDEMPOTENCY_TTL', '86400')),
+                        MemoryIdempotencyStore(max(cache_size, 1))
+                    )
+                elif cache_size > 0:
+                    _idempotency_store = MemoryIdempotencyStore(cache_size)
+                else:
+                    return None
+    return _idempotency_store
+
+def get_idempotency_key(message_id, forward_to):
+    """冪等性ストアのキー（メッセージIDと転送先）を作成"""
+    return f'{message_id}#{forward_to.lower()}'
+
+def get_raw_message_from_s3(bucket, key):
+    """S3からメールデータをバイト列のまま取得
+    S3クライアントを使用して指定されたバケットとキーからオブジェクトを取得する。
+    文字コードの判定や変換は行わない。
+    エラーハンドリングとして、ClientError をキャッチし、エラーログを出力する。
+    * Input Value: バケット名、キー
+    * Output Value: メールデータ（バイト列）
+    """
+    try:
+        with stage_timer('S3FetchLatency'):
+            response = get_s3_client().get_object(Bucket=bucket, Key=key)
+            raw_data = response['Body'].read()
+        record_metric('ObjectBytes', len(raw_data), 'Bytes')
+        return raw_data
+    except ClientError as e:
+        logger.error(f"S3からのメール取得に失敗: {str(e)}")
+        raise
+
 def get_message_from_s3(bucket, key):
     """S3からメールデータを取得
-    S3クライアントを使用して指定されたバケットとキーからオブジェクトを取得し、文字列に変換する。
-    エラーハンドリングとして、ClientError をキャッチし、エラーログを出力する。
+    S3からオブジェクトを取得し、chardet で判定した文字コードで文字列に変換する。
+    INGEST_MODE=string の場合に使用する従来の取り込み経路。
     * Input Value: バケット名、キー
     * Output Value: メールデータ（文字列）
     """
+    import chardet  # 文字列での取り込み時のみ必要なため遅延インポート
+
+    raw_data = get_raw_message_from_s3(bucket, key)
+    # 文字コードの判定はメール全体ではなく先頭の一部のみで行う
+    detected_encoding = chardet.detect(raw_data[:get_charset_sample_size()])['encoding'] or 'utf-8'
+    return raw_data.decode(detected_encoding, errors='replace')
+
+class SpoolBudget:
+    """ストリーミングでの取り込み時にパートの本文をメモリ上に保持できる量
+    1パートが閾値を超えた場合や、全体で予算を使い切った場合は一時ファイルへ退避する。
+    """
+    def __init__(self, threshold, budget):
+        self.threshold = threshold
+        self.remaining = budget
+
+    def reserve(self, size):
+        """メモリ上に保持する分を予算から差し引く（予算が足りない場合は False）"""
+        if size > self.remaining:
+            return False
+        self.remaining -= size
+        return True
+
+    def release(self, size):
+        """一時ファイルへ退避した分を予算に戻す"""
+        self.remaining += size
+
+class SpooledMessage(Message):
+    """本文を一時ファイルへ退避できる Message
+    退避した本文は元のバイト列のまま一時ファイルに保持し、ペイロードが参照されるたびに読み込む。
+    一時ファイルは複製したメッセージ間で共有する（書き込みはパース中のみ）。
+    """
+    def __init__(self, policy=None):
+        self._spool = None
+        self._spool_size = 0
+        self._sealed = True
+        self._captured = False
+        self._inline_payload = None
+        if policy is None:
+            super().__init__()
+        else:
+            super().__init__(policy)
+
+    @property
+    def _payload(self):
+        if not self._sealed:
+            # パース中は参照させない（境界の直前の改行は取り込み時に除いている）
+            return ''
+        if self._spool is None:
+            return self._inline_payload
+        return os.pread(self._spool.fileno(), self._spool_size, 0).decode('ascii', 'surrogateescape')
+
+    @_payload.setter
+    def _payload(self, value):
+        if self._captured:
+            # 本文の取り込み後にフィードパーサーが設定する空のペイロードは無視する
+            self._captured = False
+            if value == '':
+                return
+        self._spool = None
+        self._inline_payload = value
+
+    def set_captured_body(self, body=None, spool=None, size=0):
+        """取り込んだ本文（文字列、または一時ファイルとそのサイズ）を設定"""
+        self._spool = spool
+        self._spool_size = size
+        self._inline_payload = body
+        self._sealed = False
+        self._captured = True
+
+    def seal(self):
+        """パースの完了後に呼び出し、取り込んだ本文を参照できるようにする"""
+        self._sealed = True
+
+    def is_multipart(self):
+        # 退避した本文は読み込まずに判定する
+        return self._spool is None and isinstance(self._inline_payload, list)
+
+    def payload_size(self):
+        """退避した本文のサイズ（退避していない場合は None）"""
+        return self._spool_size if self._spool is not None else None
+
+    def __deepcopy__(self, memo):
+        # 一時ファイルは共有し、本文を読み込まずに複製する
+        clone = copy.copy(self)
+        memo[id(self)] = clone
+        clone._headers = copy.deepcopy(self._headers, memo)
+        clone._inline_payload = copy.deepcopy(self._inline_payload, memo)
+        return clone
+
+class SpoolingInput(BufferedSubFile):
+    """リーフパートの本文をフィードパーサーに渡さずに取り込む入力バッファ
+    本文の行はメモリ上に蓄え、SpoolBudget の範囲を超えた時点で一時ファイルへ書き出す。
+    """
+    def __init__(self, budget):
+        super().__init__()
+        self.budget = budget
+        self._target = None
+
+    def capture(self, message):
+        """次の行から message の本文として取り込む"""
+        self._target = message
+        self._buffer = []
+        self._buffered = 0
+        self._spool = None
+        self._spool_size = 0
+        self._last_line = None
+
+    def readline(self):
+        if self._target is None:
+            return super().readline()
+        while self._lines:
+            line = self._lines.popleft()
+            for ateof in reversed(self._eofstack):
+                if ateof(line):
+                    # 境界行は通常どおりフィードパーサーに返す
+                    self._lines.appendleft(line)
+                    return self._finish_capture()
+            if self._last_line is not None:
+                self._append(self._last_line)
+            self._last_line = line
+        if self._closed:
+            return self._finish_capture()
+        return NeedMoreData
+
+    def _append(self, line):
+        if self._spool is None:
+            if self._buffered + len(line) <= self.budget.threshold and self.budget.reserve(len(line)):
+                self._buffer.append(line)
+                self._buffered += len(line)
+                return
+            self.budget.release(self._buffered)
+            self._spool = tempfile.TemporaryFile(dir=os.environ.get('INGEST_SPOOL_DIR'))
+            self._buffer.append(line)
+            line = EMPTYSTRING.join(self._buffer)
+            self._buffer = []
+        data = line.encode('ascii', 'surrogateescape')
+        self._spool.write(data)
+        self._spool_size += len(data)
+
+    def _finish_capture(self):
+        if self._last_line is not None:
+            line = self._last_line
+            if self._eofstack:
+                # 境界の直前の改行は境界の一部のため除く
+                line = NLCRE_eol.sub('', line)
+            self._append(line)
+        if self._spool is not None:
+            self._spool.flush()
+            self._target.set_captured_body(spool=self._spool, size=self._spool_size)
+        else:
+            self._target.set_captured_body(body=EMPTYSTRING.join(self._buffer))
+        self._target = None
+        self._buffer = []
+        return ''
+
+class SpoolingFeedParser(BytesFeedParser):
+    """リーフパートの本文を SpoolingInput で取り込むフィードパーサー"""
+    def __init__(self, budget):
+        super().__init__(_factory=SpooledMessage)
+        self._input = SpoolingInput(budget)
+
+    def _parse_headers(self, lines):
+        super()._parse_headers(lines)
+        if self._cur.get_content_maintype() not in ('multipart', 'message'):
+            self._input.capture(self._cur)
+
+    def close(self):
+        root = super().close()
+        for part, _ in iter_mime_parts(root):
+            if isinstance(part, SpooledMessage):
+                part.seal()
+        return root
+
+def get_payload_size(message):
+    """シングルパートのエンコードされたままのペイロードの長さ（一時ファイルに退避したものは読み込まずに取得）"""
+    if isinstance(message, SpooledMessage):
+        size = message.payload_size()
+        if size is not None:
+            return size
+    payload = message.get_payload()
+    return len(payload) if isinstance(payload, (str, bytes)) else 0
+
+def close_spools(message):
+    """パース時に本文を退避した一時ファイルをすべて閉じる
+    一時ファイルは複製したメッセージと共有しているため、すべての転送先への送信を終えた後に呼び出す。
+    * Input Value: メールメッセージ
+    * Output Value: なし
+    """
+    for part, _ in iter_mime_parts(message):
+        if isinstance(part, SpooledMessage) and part._spool is not None:
+            part._spool.close()
+
+def restore_raw_payloads(message):
+    """文字列からパースしたメールのペイロードを、バイト列からパースした場合と同じ形式に戻す
+    8bit の本文は各パートで宣言された charset（宣言がない・変換できない場合は UTF-8）でバイト列に戻し、
+    surrogateescape の文字列として保持する。BytesGenerator での出力やデコードはこの形式を前提とする。
+    * Input Value: メールメッセージ
+    * Output Value: なし（各パートを直接更新）
+    """
+    for part, _ in iter_mime_parts(message):
+        payload = part._payload
+        if part.is_multipart() or not isinstance(payload, str) or payload.isascii():
+            continue
+        try:
+            data = payload.encode(part.get_content_charset() or 'utf-8')
+        except (LookupError, UnicodeEncodeError):
+            data = payload.encode('utf-8', 'surrogateescape')
+        part._payload = data.decode('ascii', 'surrogateescape')
+
+def iter_mime_parts(message):
+    """MIME ツリーのすべてのパートを再帰せずに列挙
+    Message.walk() はネストの深さだけ再帰するため、深くネストしたメールでも使えるよう明示的なスタックで走査する。
+    * Input Value: メールメッセージ
+    * Output Value: (パート, ネストの深さ) を順に返すイテレーター
+    """
+    stack = [(message, 0)]
+    while stack:
+        part, depth = stack.pop()
+        yield part, depth
+        if part.is_multipart():
+            stack.extend((child, depth + 1) for child in reversed(part.get_payload()))
+
+def measure_mime_tree(message):
+    """MIME ツリーのネストの深さ・パート数・ペイロードの合計サイズを取得
+    * Input Value: メールメッセージ
+    * Output Value: (ネストの深さ, パート数, エンコードされたままのペイロードの合計バイト数) のタプル
+    """
+    max_depth = parts = size = 0
+    for part, depth in iter_mime_parts(message):
+        max_depth = max(max_depth, depth)
+        parts += 1
+        if not part.is_multipart():
+            size += get_payload_size(part)
+    return max_depth, parts, size
+
+def stream_message_from_s3(bucket, key):
+    """S3からメールを取得しながらパース
+    StreamingBody を INGEST_CHUNK_SIZE（バイト、既定値 65536）ずつ読み込んで BytesFeedParser に渡し、
+    転送とパースを重ねて行う。INGEST_SPOOL_THRESHOLD（バイト、既定値 262144）を超えるペイロードと、
+    合計が INGEST_MEMORY_BUDGET（バイト、既定値 16MB）を超えた後のペイロードは一時ファイルへ退避するため、
+    メモリ使用量はメールのサイズではなく予算で抑えられる。
+    * Input Value: バケット名、キー
+    * Output Value: オリジナルメール（SpooledMessage オブジェクト）
+    """
+    chunk_size = int(os.environ.get('INGEST_CHUNK_SIZE', '65536'))
+    budget = SpoolBudget(
+        int(os.environ.get('INGEST_SPOOL_THRESHOLD', str(256 * 1024))),
+        int(os.environ.get('INGEST_MEMORY_BUDGET', str(16 * 1024 * 1024)))
+    )
+    parser = SpoolingFeedParser(budget)
+    object_bytes = 0
+    parse_seconds = 0.0
+    started = time.perf_counter()
     try:
-        response = s3_client.get_object(Bucket=bucket, Key=key)
-        raw_data = response['Body'].read()
-        detected_encoding = chardet.detect(raw_data)['encoding']
-        return raw_data.decode(detected_encoding, errors='replace')
+        response = get_s3_client().get_object(Bucket=bucket, Key=key)
+        for chunk in response['Body'].iter_chunks(chunk_size):
+            object_bytes += len(chunk)
+            parse_started = time.perf_counter()
+            parser.feed(chunk)
+            parse_seconds += time.perf_counter() - parse_started
     except ClientError as e:
         logger.error(f"S3からのメール取得に失敗: {str(e)}")
         raise
+    parse_started = time.perf_counter()
+    message = parser.close()
+    parse_seconds += time.perf_counter() - parse_started
+    # 取得とパースは重なっているため、取得時間はパースに要した時間を除いたものとする
+    record_metric('S3FetchLatency', (time.perf_counter() - started - parse_seconds) * 1000, 'Milliseconds')
+    record_metric('ParseTime', parse_seconds * 1000, 'Milliseconds')
+    record_metric('ObjectBytes', object_bytes, 'Bytes')
+    return message
+
+def load_original_message(bucket, key):
+    """S3からメールを取得してパース
+    既定（INGEST_MODE=bytes）ではバイト列のまま message_from_bytes でパースし、
+    文字コードの処理は各パートで宣言された charset に任せる。
+    INGEST_MODE=string の場合は従来どおり全体を文字列化してからパースする。
+    INGEST_MODE=stream の場合は取得しながらパースし、大きいペイロードは一時ファイルへ退避する。
+    * Input Value: バケット名、キー
+    * Output Value: オリジナルメール（Messageオブジェクト）
+    """
+    mode = os.environ.get('INGEST_MODE', 'bytes').lower()
+    email_data = None
+    try:
+        if mode == 'stream':
+            message = stream_message_from_s3(bucket, key)
+        elif mode == 'string':
+            email_data = get_message_from_s3(bucket, key)
+            with stage_timer('ParseTime'):
+                message = message_from_string(email_data)
+                restore_raw_payloads(message)
+        else:
+            email_data = get_raw_message_from_s3(bucket, key)
+            with stage_timer('ParseTime'):
+                message = message_from_bytes(email_data)
+    except RecursionError:
+        # パーサーはネストの深さだけ再帰するため、深すぎるメールはヘッダーのみをパースし、本文は分解せずに扱う
+        logger.warning("MIME のネストが深すぎるため、本文を分解せずに転送します")
+        record_metric('DegradedParts', 1)
+        if not isinstance(email_data, bytes):
+            # ストリーミング・文字列でのパースではバイト列を保持していないため改めて取得する
+            email_data = get_raw_message_from_s3(bucket, key)
+        message = BytesParser().parsebytes(email_data, headersonly=True)
+    if _current_metrics is not None:
+        record_metric('PartCount', measure_mime_tree(message)[1])
+    return message
+
+# chardet の判定結果と、より広い文字集合を持つ互換の文字コードの対応
+CHARSET_SUPERSETS = {
+    'shift_jis': 'cp932',
+    'windows-31j': 'cp932',
+    'euc-jp': 'euc_jis_2004',
+    'gb2312': 'gb18030',
+    'ascii': 'us-ascii',
+}
+
+def get_charset_sample_size():
+    """文字コードの判定に使うデータの最大バイト数（環境変数 CHARSET_SAMPLE_BYTES、既定値 65536）"""
+    return int(os.environ.get('CHARSET_SAMPLE_BYTES', '65536'))
+
+def _try_decode(payload, charset):
+    """指定した文字コードで厳密にデコードできるかを判定"""
+    try:
+        payload.decode(charset)
+        return True
+    except (UnicodeDecodeError, LookupError):
+        return False
+
+def resolve_charset(payload, sender_domain=None):
+    """charset が宣言されていないパートの文字コードを判定
+    コストの低い順に以下を試す。
+    1. ISO-2022-JP のエスケープシーケンスの有無
+    2. ASCII / UTF-8 として厳密にデコードできるか
+    3. 同じ送信者ドメインで前回判定した文字コードで厳密にデコードできるか
+    4. 先頭の CHARSET_SAMPLE_BYTES バイトのみを chardet で判定
+    4 の判定結果は送信者ドメインごとに記憶し（LRU、最大 CHARSET_CACHE_SIZE 件）、ウォームコンテナ間で再利用する。
+    * Input Value: パートのデータ（バイト列）、送信者のドメイン
+    * Output Value: 文字コード
+    """
+    if b'\x1b$B' in payload or b'\x1b$@' in payload or b'\x1b(J' in payload:
+        return 'iso-2022-jp'
+    if payload.isascii():
+        return 'us-ascii'
+    if _try_decode(payload, 'utf-8'):
+        return 'utf-8'
+
+    if sender_domain:
+        with _charset_cache_lock:
+            cached = _charset_cache.get(sender_domain)
+            if cached is not None:
+                _charset_cache.move_to_end(sender_domain)
+        if cached is not None and _try_decode(payload, cached):
+            return cached
+
+    import chardet  # 判定が必要な場合のみ読み込む
+
+    detected = (chardet.detect(payload[:get_charset_sample_size()])['encoding'] or 'utf-8').lower()
+    charset = CHARSET_SUPERSETS.get(detected, detected)
+    if sender_domain:
+        with _charset_cache_lock:
+            _charset_cache[sender_domain] = charset
+            _charset_cache.move_to_end(sender_domain)
+            while len(_charset_cache) > int(os.environ.get('CHARSET_CACHE_SIZE', '256')):
+                _charset_cache.popitem(last=False)
+    return charset
+
+def get_sender_domain(message):
+    """送信者（From）のドメインを取得（取得できない場合は None）"""
+    from email.utils import parseaddr
+
+    address = parseaddr(decode_email_header(message['From']))[1]
+    return address.rpartition('@')[2].lower() or None
 
 def decode_email_header(header_value):
     """メールヘッダーをデコード
@@ -67,119 +1271,756 @@ def decode_email_header(header_value):
     for fragment, encoding in decoded_fragments:
         if isinstance(fragment, bytes):
             # バイナリの場合、指定されたエンコーディングでデコード（デフォルトはUTF-8）
-            decoded_string += fragment.decode(encoding or 'utf-8', errors='replace')
+            try:
+                decoded_string += fragment.decode(encoding or 'utf-8', errors='replace')
+            except LookupError:
+                # 生の8bitヘッダー（unknown-8bit）や未知の文字コードは判定した文字コードでデコード
+                decoded_string += fragment.decode(resolve_charset(fragment), errors='replace')
         else:
             # すでに文字列型ならそのまま結合
             decoded_string += fragment
     return decoded_string
 
-def decode_parts(parent, message):
-    """メッセージを再帰的に処理
-    multipartメッセージと添付ファイル（message/rfc822）を処理し、
-    メッセージを分解してMIMEMultipartオブジェクトに組み込む。
-    * Input Value: 親MIMEMessageオブジェクト、メールメッセージ
-    * Output Value: 処理されたMIMEMessageオブジェクト
+def header_to_str(header_value):
+    """ヘッダー値を文字列に正規化
+    バイト列からパースしたメールでは、8bitの生ヘッダーが Header オブジェクトとして返るため、
+    デコードした文字列に変換する。それ以外の値はそのまま返す。
+    * Input Value: ヘッダー値（文字列 または Header オブジェクト）
+    * Output Value: ヘッダー値（文字列）
     """
-    if message.get_content_type() == "message/rfc822":
-        # 添付ファイルの場合
-        logger.debug(f"添付メッセージ: {message.get_content_type()} / {message.get_content_subtype()}")
-        try:
-            # logger.debug(f"message: {message}")
-            payload = message.get_payload(decode=False)  # 生データを取得
-            # logger.debug(f"payload: {payload}")
-            if not isinstance(payload, list):
-                payload = [payload]
-
-            for part in payload:
-                if isinstance(part, bytes):
-                    # バイナリデータをパース
-                    # logger.debug(f"binary part: {part}")
-                    inner_message = message_from_bytes(part)
-                elif isinstance(part, str):
-                    # 文字列データをパース
-                    # logger.debug(f"string part: {part}")
-                    inner_message = message_from_string(part)
-                elif isinstance(part, Message):
-                    # すでに Message オブジェクトの場合
-                    # logger.debug(f"message part: {part}")
-                    inner_message = part
-                else:
-                    # 未対応の型
-                    logger.warning(f"Unsupported part type: {type(part)}")
-                    continue
+    if isinstance(header_value, Header):
+        return decode_email_header(header_value)
+    return header_value
+
+# マルチパートの境界行などに要するサイズの見積もり（バイト）
+MULTIPART_OVERHEAD = 100
+
+class MessageTooLargeError(Exception):
+    """転送メールのサイズが上限を超えた場合の例外"""
+
+    def __init__(self, size, max_size):
+        super().__init__(f"転送メールのサイズが上限を超えました: {size} > {max_size} バイト")
+        self.size = size
+        self.max_size = max_size
+
+class BuildContext:
+    """転送メール作成時の状態
+    作成中の転送メールのエンコード後のサイズを積算し、上限を超えた時点で MessageTooLargeError を送出する。
+    skipped_parts に含まれるパート（id）は転送メールに含めない。
+    """
+
+    def __init__(self, max_size=None, skipped_parts=None):
+        self.max_size = max_size
+        self.size = 0
+        self.skipped_parts = skipped_parts or set()
+        self.offload_threshold = int(os.environ.get('ATTACHMENT_OFFLOAD_THRESHOLD', '0') or 0)
+        self.sender_domain = None
+        # MIME の処理上限（0 の場合は上限なし）
+        self.max_depth = int(os.environ.get('MIME_MAX_DEPTH', '20'))
+        self.max_parts = int(os.environ.get('MIME_MAX_PARTS', '500'))
+        self.max_total_bytes = int(os.environ.get('MIME_MAX_TOTAL_BYTES', '0'))
+        self.max_part_bytes = int(os.environ.get('MIME_MAX_PART_BYTES', '0'))
+        self.part_count = 0
+        self.total_bytes = 0
+        self.exhausted = None
+        self.degraded_reasons = set()
 
-                # logger.debug(f"inner_message: {inner_message}")
-                attachment = MIMEMessage(inner_message)
-                # logger.debug(f"attachment: {attachment}")
+    def add_size(self, size):
+        """エンコード後のサイズを積算し、上限を超えた場合は MessageTooLargeError を送出"""
+        self.size += size
+        if self.max_size and self.size > self.max_size:
+            raise MessageTooLargeError(self.size, self.max_size)
 
-                # ヘッダーの設定
-                filename = decode_email_header(message.get_param('filename') or message.get_param('name') or 'attached_message.eml')
-                attachment.add_header('Content-Disposition', 'attachment', filename=filename)
-                # logger.debug(f"attachment: {attachment}")
+    def check_remaining(self, size):
+        """積算する前に、サイズが上限の残りに収まるかを確認し、収まらない場合は MessageTooLargeError を送出
+        デコードとエンコードし直しを行う前に、エンコードされたままのペイロードの長さで判定するために使用する。
+        """
+        if self.max_size and size > self.max_size - self.size:
+            raise MessageTooLargeError(self.size + size, self.max_size)
+
+    def check_budget(self, message, depth):
+        """パートを処理する前に MIME の処理上限を確認
+        パート数または合計サイズの上限を超えた場合は、以降のすべてのパートを上限超過とする。
+        サイズはデコード前の（エンコードされたままの）ペイロードの長さで判定し、デコード後のサイズの上限とみなす。
+        * Input Value: パート、ネストの深さ
+        * Output Value: 上限を超えた場合はその理由、上限内の場合は None
+        """
+        if self.exhausted:
+            return self.exhausted
+        self.part_count += 1
+        if self.max_parts and self.part_count > self.max_parts:
+            self.exhausted = 'MIME_MAX_PARTS'
+            return self.exhausted
+        if self.max_depth and depth > self.max_depth:
+            return 'MIME_MAX_DEPTH'
+        if message.is_multipart():
+            # 添付されたメールはそのまま組み込むため、内部のネストを含めて深さを判定する
+            if (self.max_depth and message.get_content_type() == 'message/rfc822'
+                    and depth + measure_mime_tree(message)[0] > self.max_depth):
+                return 'MIME_MAX_DEPTH'
+            return None
+        part_bytes = get_payload_size(message)
+        if self.max_part_bytes and part_bytes > self.max_part_bytes:
+            return 'MIME_MAX_PART_BYTES'
+        self.total_bytes += part_bytes
+        if self.max_total_bytes and self.total_bytes > self.max_total_bytes:
+            self.exhausted = 'MIME_MAX_TOTAL_BYTES'
+            return self.exhausted
+        return None
+
+def get_max_message_size():
+    """転送メールのサイズ上限を取得
+    環境変数 MAX_MESSAGE_SIZE（バイト）から取得する。既定値はSESの上限である 40MB、0 の場合は上限なし。
+    * Input Value: 環境変数 MAX_MESSAGE_SIZE
+    * Output Value: サイズ上限（バイト）
+    """
+    return int(os.environ.get('MAX_MESSAGE_SIZE', str(40 * 1024 * 1024)))
+
+def estimate_header_size(message):
+    """ヘッダーのサイズを見積もる"""
+    return sum(len(key) + len(str(value)) + 4 for key, value in message.items()) + 2
+
+def estimate_message_size(message):
+    """メッセージのサイズを見積もる
+    ペイロードのデコードや出力は行わず、パース済みの（エンコードされたままの）ペイロードの長さを合計する。
+    * Input Value: メールメッセージ
+    * Output Value: 見積もりサイズ（バイト）
+    """
+    size = 0
+    stack = [message]
+    while stack:
+        part = stack.pop()
+        size += estimate_header_size(part)
+        if part.is_multipart():
+            payload = part.get_payload()
+            size += MULTIPART_OVERHEAD * (len(payload) + 1)
+            stack.extend(payload)
+        else:
+            size += get_payload_size(part)
+    return size
 
-                parent.attach(attachment)
+def check_message_size(size):
+    """サイズが上限を超えている場合は MessageTooLargeError を送出"""
+    max_size = get_max_message_size()
+    if max_size and size > max_size:
+        raise MessageTooLargeError(size, max_size)
+
+def find_attachments(message):
+    """添付ファイルとして扱うパートを列挙
+    Content-Disposition が attachment のパート、ファイル名を持つパート、message/rfc822 のパートを対象とする。
+    message/rfc822 の内側のパートは対象としない。
+    * Input Value: メールメッセージ
+    * Output Value: (パート, ファイル名, 見積もりサイズ) のタプルのリスト
+    """
+    attachments = []
+    stack = [message]
+    while stack:
+        part = stack.pop()
+        if part is not message and (
+            part.get_content_type() == 'message/rfc822'
+            or part.get_content_disposition() == 'attachment'
+            or part.get_filename()
+        ):
+            filename = decode_email_header(part.get_filename() or part.get_param('name') or 'attachment')
+            attachments.append((part, filename, estimate_message_size(part)))
+        elif part.is_multipart():
+            stack.extend(part.get_payload())
+    return attachments
+
+def is_offload_candidate(message, threshold):
+    """S3へ退避する添付ファイルかどうかを判定
+    本文（ファイル名のない text/plain・text/html）以外のパートのうち、
+    デコード後のサイズの見積もりが閾値を超えるものを対象とする。
+    * Input Value: メールメッセージ（シングルパート）、閾値（バイト、0 の場合は退避しない）
+    * Output Value: 退避する場合は True
+    """
+    if not threshold:
+        return False
+    if message.get_content_type() in ('text/plain', 'text/html') and not message.get_filename():
+        return False
+    if message.is_multipart():
+        return False
+    payload_size = get_payload_size(message)
+    encoding = str(message.get('Content-Transfer-Encoding', '')).strip().lower()
+    estimated_size = payload_size * 3 // 4 if encoding == 'base64' else payload_size
+    return estimated_size > threshold
+
+def offload_attachment(message):
+    """添付ファイルをS3へ退避し、署名付きURLを記載したパートを作成
+    パースしたパートからデコードしたデータをそのままS3へアップロードする。
+    オブジェクトのキーは内容のハッシュから決めるため、同じ添付ファイルは再送時や複数の転送先でも1回だけアップロードする。
+    退避先は環境変数 ATTACHMENT_OFFLOAD_BUCKET（省略時は S3_BUCKET）と ATTACHMENT_OFFLOAD_PREFIX（省略時は attachments）、
+    URLの有効期限は ATTACHMENT_URL_EXPIRES（秒、既定値 604800）。
+    * Input Value: メールメッセージ（シングルパート）
+    * Output Value: 署名付きURLを記載したパート（MIMETextオブジェクト）
+    """
+    import hashlib
+    from datetime import datetime, timedelta, timezone
+    from urllib.parse import quote
+    from email.mime.text import MIMEText
+
+    payload = message.get_payload(decode=True) or b''
+    filename = decode_email_header(message.get_filename() or message.get_param('name') or 'attachment')
+    bucket = os.environ.get('ATTACHMENT_OFFLOAD_BUCKET') or os.environ.get('S3_BUCKET')
+    prefix = os.environ.get('ATTACHMENT_OFFLOAD_PREFIX', 'attachments').strip('/')
+    key = f"{prefix}/{hashlib.sha256(payload).hexdigest()}/{filename.replace('/', '_')}"
+
+    s3_client = get_s3_client()
+    try:
+        s3_client.head_object(Bucket=bucket, Key=key)
+    except ClientError:
+        s3_client.put_object(
+            Bucket=bucket, Key=key, Body=payload,
+            ContentType=message.get_content_type(),
+            ContentDisposition=f"attachment; filename*=UTF-8''{quote(filename)}"
+        )
+
+    expires = int(os.environ.get('ATTACHMENT_URL_EXPIRES', '604800'))
+    url = s3_client.generate_presigned_url(
+        'get_object', Params={'Bucket': bucket, 'Key': key}, ExpiresIn=expires
+    )
+    logger.info(f"添付ファイルをS3へ退避: s3://{bucket}/{key} ({len(payload)} bytes)")
+
+    expires_at = (datetime.now(timezone.utc) + timedelta(seconds=expires)).strftime('%Y-%m-%d %H:%M UTC')
+    stub_text = f"""The attachment "{filename}" ({len(payload)} bytes) was too large to forward and has been stored.
+Download (expires at {expires_at}):
+{url}
+"""
+    stub = MIMEText(stub_text, 'plain', 'utf-8')
+    stub.add_header('Content-Disposition', 'inline')
+    return stub
 
-        except (MessageParseError, TypeError) as e:
-            logger(f"Failed to process message/rfc822 attachment: {e}")
+def attach_embedded_message(parent, message, context):
+    """添付されたメール（message/rfc822）をデコードせずにそのまま添付"""
+    from email.mime.message import MIMEMessage
 
-    elif message.is_multipart():
-        # マルチパートの場合
-        logger.debug(f"マルチパートメッセージ: {message.get_content_type()} / {message.get_content_subtype()}")
-        new_part = MIMEMultipart(message.get_content_subtype())
-        for part in message.get_payload():
-            decode_parts(new_part, part)  # 再帰的に添付
-        parent.attach(new_part)
+    try:
+        # logger.debug("message: %s", message)
+        payload = message.get_payload(decode=False)  # 生データを取得
+        # logger.debug("payload: %s", payload)
+        if not isinstance(payload, list):
+            payload = [payload]
+
+        for part in payload:
+            if isinstance(part, bytes):
+                # バイナリデータをパース
+                # logger.debug("binary part: %s", part)
+                inner_message = message_from_bytes(part)
+            elif isinstance(part, str):
+                # 文字列データをパース
+                # logger.debug("string part: %s", part)
+                inner_message = message_from_string(part)
+            elif isinstance(part, Message):
+                # すでに Message オブジェクトの場合
+                # logger.debug("message part: %s", part)
+                inner_message = part
+            else:
+                # 未対応の型
+                logger.warning(f"Unsupported part type: {type(part)}")
+                continue
+
+            # logger.debug("inner_message: %s", inner_message)
+            attachment = MIMEMessage(inner_message)
+            # logger.debug("attachment: %s", attachment)
+
+            # ヘッダーの設定
+            filename = decode_email_header(message.get_param('filename') or message.get_param('name') or 'attached_message.eml')
+            attachment.add_header('Content-Disposition', 'attachment', filename=filename)
+            # logger.debug("attachment: %s", attachment)
+            context.add_size(estimate_message_size(attachment))
+
+            parent.attach(attachment)
+
+    except (MessageParseError, TypeError) as e:
+        logger.error(f"Failed to process message/rfc822 attachment: {e}")
+
+# charset を宣言する際の名前（判定に使った互換の文字コードから、メールで一般的な名前に戻す）
+DECLARED_CHARSET_NAMES = {
+    'cp932': 'Shift_JIS',
+    'euc_jis_2004': 'EUC-JP',
+    'gb18030': 'GB18030',
+}
+# quoted-printable でエスケープ不要なバイト（'=' 以外の印字可能な ASCII、空白、改行）
+QP_SAFE_BYTES = bytes(range(33, 61)) + bytes(range(62, 127)) + b' \t\r\n'
+# RFC 5322 の1行の最大長（改行を除く）
+MAX_LINE_LENGTH = 998
+
+def fits_line_length(body):
+    """すべての行が RFC 5322 の最大長以内かを判定"""
+    return all(len(line) <= MAX_LINE_LENGTH for line in body.splitlines())
+
+def allows_8bit_transfer():
+    """8bit の Content-Transfer-Encoding を使用するか（環境変数 ALLOW_8BIT_TRANSFER、既定値 false）
+    SES は 7bit ASCII の範囲外の内容をエンコードして送信することを推奨しているため、既定では使用しない。
+    """
+    return os.environ.get('ALLOW_8BIT_TRANSFER', 'false').lower() == 'true'
+
+def choose_transfer_encoding(body, is_text=True):
+    """パートの内容から、エンコード後のサイズが最小となる Content-Transfer-Encoding を選択
+    ASCII のみで行の長さが上限以内なら 7bit、8bit 文字を含むテキストは 8bit（ALLOW_8BIT_TRANSFER が true の場合のみ）、
+    それ以外は quoted-printable と base64 のエンコード後のサイズを見積もり、小さい方を選択する。
+    テキスト以外のパートは改行の変換が許されないため、7bit または base64 とする。
+    * Input Value: デコード済みのパートの内容（バイト列）、テキストかどうか
+    * Output Value: Content-Transfer-Encoding（'7bit' / '8bit' / 'quoted-printable' / 'base64'）
+    """
+    if b'\0' not in body and fits_line_length(body):
+        if body.isascii():
+            return '7bit'
+        if is_text and allows_8bit_transfer():
+            return '8bit'
+    if not is_text:
+        return 'base64'
+    # quoted-printable はエスケープする1バイトが3バイトになり、76文字ごとにソフト改行（'=' と改行）が入る
+    escaped = len(body.translate(None, QP_SAFE_BYTES))
+    qp_size = len(body) + 2 * escaped
+    qp_size += qp_size // 75 * 2
+    base64_size = (len(body) + 2) // 3 * 4
+    base64_size += base64_size // 76
+    return 'quoted-printable' if qp_size < base64_size else 'base64'
+
+def encode_body(body, encoding):
+    """パートの内容を指定した Content-Transfer-Encoding でエンコード
+    * Input Value: デコード済みのパートの内容（バイト列）、Content-Transfer-Encoding
+    * Output Value: エンコード後のペイロード（文字列）
+    """
+    if encoding == '7bit':
+        return body.decode('ascii')
+    if encoding == '8bit':
+        # compat32 の Message と同様に surrogateescape で保持し、BytesGenerator で元のバイト列のまま出力する
+        return body.decode('ascii', 'surrogateescape')
+    if encoding == 'quoted-printable':
+        import quopri
+        return quopri.encodestring(body).decode('ascii')
+    import base64
+    return base64.encodebytes(body).decode('ascii')
+
+def is_known_charset(charset):
+    """Python で扱える文字コードかを判定"""
+    import codecs
+
+    try:
+        codecs.lookup(charset or '')
+        return True
+    except LookupError:
+        return False
+
+def has_legal_transfer_encoding(message):
+    """パートの現在の Content-Transfer-Encoding がそのまま送信できるものかを判定"""
+    encoding = str(message.get('Content-Transfer-Encoding', '7bit')).strip().lower()
+    if encoding in ('base64', 'quoted-printable'):
+        return True
+    if encoding not in ('7bit', '8bit') or (encoding == '8bit' and not allows_8bit_transfer()):
+        # binary や x-uuencode など（8bit を使用しない場合は 8bit も）はエンコードし直す
+        return False
+    payload = message.get_payload()
+    if not isinstance(payload, str):
+        return False
+    if encoding == '7bit' and not payload.isascii():
+        return False
+    return '\0' not in payload and all(len(line) <= MAX_LINE_LENGTH for line in payload.splitlines())
+
+def requires_decoding(message):
+    """転送メールに組み込む前にデコードして内容を確認する必要があるパートかを判定
+    テキストのパートと、Content-Transfer-Encoding をそのまま送信できないパートが対象。
+    * Input Value: シングルパート
+    * Output Value: デコードが必要な場合は True
+    """
+    return message.get_content_maintype() == 'text' or not has_legal_transfer_encoding(message)
+
+# ワーカープロセスでのデコードに渡すヘッダー（小文字）
+TRANSCODE_HEADER_KEYS = {'content-type', 'content-transfer-encoding'}
+
+def get_transcode_task(message, context):
+    """transcode_part に渡す引数（ヘッダー、エンコードされたままのペイロード、送信者ドメイン）を作成"""
+    headers = [(key, str(value)) for key, value in message.items() if key.lower() in TRANSCODE_HEADER_KEYS]
+    # get_payload() は 8bit の内容を charset で文字列化してしまうため、パースしたままのペイロードを渡す
+    return headers, message._payload, context.sender_domain
+
+def transcode_part(headers, payload, sender_domain=None):
+    """シングルパートのデコードとエンコードし直し
+    ワーカープロセスでも実行できるよう、Content-Type / Content-Transfer-Encoding ヘッダーと
+    エンコードされたままのペイロードのみを受け取り、転送メールに組み込む方法を返す。
+    内容が変わらない場合（宣言された charset で正しくデコードできるテキストや、テキスト以外のパート）で、
+    送信できる Content-Transfer-Encoding であればオリジナルのエンコードのまま（keep）とする。
+    charset が宣言されていないテキストは内容から判定し、charset の宣言のみを追加する。
+    デコードできない文字を含むテキストは UTF-8 に変換し、サイズが最小となる Content-Transfer-Encoding でエンコードし直す（rebuild）。
+    * Input Value: ヘッダーの (名前, 値) のリスト、ペイロード（文字列）、送信者ドメイン
+    * Output Value: ('keep', 追加で宣言する charset または None)
+      または ('rebuild', charset, Content-Transfer-Encoding, エンコードした本文) のタプル
+    """
+    message = Message()
+    for key, value in headers:
+        message[key] = value
+    message.set_payload(payload)
+
+    is_text = message.get_content_maintype() == 'text'
+    if not requires_decoding(message):
+        # テキスト以外で送信できるエンコードのパートは内容を確認する必要がないため、デコードせずにそのまま添付する
+        return ('keep', None)
+    payload = message.get_payload(decode=True) or b''
+    charset = message.get_content_charset()
+    declared = charset is not None
+    if is_text and payload and charset is None:
+        # charset が宣言されていないテキストは内容から判定する
+        charset = resolve_charset(payload, sender_domain)
+    text = None
+    if is_text and payload:
+        try:
+            payload.decode(charset or 'us-ascii')
+        except (UnicodeDecodeError, LookupError):
+            text = payload.decode(charset if is_known_charset(charset) else 'utf-8', errors='replace')
+
+    if text is None and has_legal_transfer_encoding(message):
+        # 内容は変わらないため、オリジナルのエンコードのまま添付する
+        if is_text and payload and not declared:
+            return ('keep', DECLARED_CHARSET_NAMES.get(charset, charset))
+        return ('keep', None)
+
+    if text is not None:
+        # デコードできない文字を置き換えたため、UTF-8 で作り直す
+        body = text.encode('utf-8')
+        charset = 'utf-8'
     else:
-        # シングルパートの場合
-        logger.debug(f"シングルパートメッセージ: {message.get_content_type()} / {message.get_content_subtype()}")
+        body = payload
+    if is_text:
+        # テキストの改行は CRLF / LF の違いを区別しない（出力時に CRLF に揃える）
+        body = body.replace(b'\r\n', b'\n')
+    encoding = choose_transfer_encoding(body, is_text)
+    if is_text and encoding == 'base64':
+        body = body.replace(b'\n', b'\r\n')
+    charset = DECLARED_CHARSET_NAMES.get(charset, charset) if is_text and charset else None
+    return ('rebuild', charset, encoding, encode_body(body, encoding))
+
+def build_transcoded_part(message, plan):
+    """transcode_part の結果から転送メールに組み込むパートを作成
+    * Input Value: オリジナルのパート、transcode_part の結果（デコードに失敗した場合は None）
+    * Output Value: 転送メールに組み込むパート
+    """
+    if plan is None:
+        # デコードできないパートはオリジナルのまま添付する
+        return message
+    if plan[0] == 'keep':
+        if plan[1] is None:
+            return message
+        part = copy.deepcopy(message)
+        part.set_param('charset', plan[1])
+        return part
+
+    _, charset, encoding, body = plan
+    # Content-Transfer-Encoding 以外のヘッダーはオリジナルのパートから引き継ぐ
+    part = Message()
+    for key, value in message.items():
+        if key.lower() != 'content-transfer-encoding':
+            part[key] = value
+    if 'Content-Type' not in part:
+        part['Content-Type'] = message.get_content_type()
+    if charset:
+        part.set_param('charset', charset)
+    part['Content-Transfer-Encoding'] = encoding
+    part.set_payload(body)
+    return part
+
+def decode_single_part(parent, message, context, debug_enabled=False):
+    """シングルパートをデコードして転送メールに組み込む（処理の内容は transcode_part を参照）"""
+    if debug_enabled:
+        logger.debug("シングルパートメッセージ: %s / %s", message.get_content_type(), message.get_content_subtype())
+    # 上限を超えることが分かっているパートはデコードしない
+    context.check_remaining(get_payload_size(message))
+    try:
+        plan = transcode_part(*get_transcode_task(message, context))
+    except Exception as e:
+        logger.error(f"パートのデコード中にエラーが発生: {str(e)}")
+        plan = None
+    part = build_transcoded_part(message, plan)
+    context.add_size(estimate_message_size(part))
+    parent.attach(part)
+
+def pack_transcode_task(task):
+    """ワーカープロセスに渡す引数のペイロードをバイト列に戻す
+    8bit の内容をサロゲートとして含む文字列は pickle の復元が遅いため、パース前のバイト列にして渡す
+    （transcode_part の set_payload で文字列に戻る）。
+    """
+    headers, payload, sender_domain = task
+    if isinstance(payload, str):
         try:
-            payload = message.get_payload(decode=True)
-            charset = message.get_content_charset() or 'utf-8'
-            subtype = message.get_content_subtype()
-            if payload:
-                decoded_payload = payload.decode(charset, errors='replace')
-            else:
-                decoded_payload = ""
-        except Exception as e:
-            logger.error(f"パートのデコード中にエラーが発生: {str(e)}")
-            decoded_payload = ""
+            payload = payload.encode('ascii', 'surrogateescape')
+        except UnicodeEncodeError:
+            pass
+    return headers, payload, sender_domain
 
-        decoded_part = MIMEText(decoded_payload, _subtype=subtype, _charset=charset)
-        for key, value in message.items():
-            decoded_part[key] = value
+def _run_transcode_task(task):
+    """transcode_part を実行し、(結果, エラーメッセージ) のタプルを返す"""
+    try:
+        return transcode_part(*task), None
+    except Exception as e:
+        return None, str(e)
 
-        parent.attach(decoded_part)
+def _decode_worker(connection):
+    """ワーカープロセスの処理（Pipe で受け取った transcode_part の引数を順に処理して結果を返す）"""
+    while True:
+        try:
+            task = connection.recv()
+        except EOFError:
+            return
+        if task is None:
+            return
+        connection.send(_run_transcode_task(task))
 
-def create_forwarded_message(original_message, original_recipient, forward_to):
-    """転送用の新規メールメッセージを作成
-    オリジナルメッセージの情報と転送先アドレスを受け取り、転送メールを作成する。
-    オリジナルメッセージのヘッダーの一部を転送メールにコピーする。
-    * Input Value: オリジナルメッセージ、受信者アドレス、転送先アドレス
-    * Output Value: 転送メール（MIMEMultipartオブジェクト）
+class DecodeWorkerPool:
+    """transcode_part を実行するワーカープロセスのプール
+    Lambda には /dev/shm がなく、セマフォを使う multiprocessing.Pool や ProcessPoolExecutor は動作しないため、
+    ワーカーごとの Pipe で引数と結果を受け渡す。ワーカーはウォームコンテナ間で再利用する。
     """
-    msg = MIMEMultipart()
 
-    # 基本ヘッダーの設定
-    msg['Subject'] = f"Fw: {original_message['Subject']}"
+    def __init__(self, size):
+        import multiprocessing
+
+        # スレッドを使用中のプロセスから fork しないよう、spawn でワーカーを起動する
+        context = multiprocessing.get_context('spawn')
+        self.size = size
+        self.workers = []
+        self._lock = threading.Lock()
+        for _ in range(size):
+            connection, child_connection = context.Pipe()
+            process = context.Process(target=_decode_worker, args=(child_connection,), daemon=True)
+            process.start()
+            child_connection.close()
+            self.workers.append((process, connection))
+
+    def map(self, tasks):
+        """tasks を空いているワーカーに順に割り当てて実行し、tasks の順に結果を返す
+        * Input Value: transcode_part の引数のリスト
+        * Output Value: (結果, エラーメッセージ) のタプルのリスト
+        """
+        from multiprocessing.connection import wait
+
+        results = [None] * len(tasks)
+        pending = list(reversed(list(enumerate(tasks))))
+        with self._lock:
+            running = {}
+            for _, connection in self.workers:
+                if not pending:
+                    break
+                index, task = pending.pop()
+                connection.send(task)
+                running[connection] = index
+            while running:
+                for connection in wait(list(running)):
+                    results[running.pop(connection)] = connection.recv()
+                    if pending:
+                        index, task = pending.pop()
+                        connection.send(task)
+                        running[connection] = index
+        return results
+
+    def close(self):
+        """ワーカープロセスを終了する"""
+        for process, connection in self.workers:
+            try:
+                connection.send(None)
+            except OSError:
+                pass
+            connection.close()
+        for process, _ in self.workers:
+            process.join(timeout=1)
+            if process.is_alive():
+                process.terminate()
+
+def get_decode_pool():
+    """デコード用のワーカープロセスのプールを取得
+    環境変数 DECODE_WORKERS（既定値 0）が 1 以上の場合に、その数のワーカーを起動してキャッシュする。
+    * Input Value: 環境変数 DECODE_WORKERS
+    * Output Value: DecodeWorkerPool オブジェクト（ワーカーを使用しない場合は None）
+    """
+    global _decode_pool
+    size = int(os.environ.get('DECODE_WORKERS', '0'))
+    with _decode_pool_lock:
+        pool = _decode_pool
+        if pool is not None and pool.size == size:
+            return pool
+        _decode_pool = DecodeWorkerPool(size) if size > 0 else None
+    if pool is not None:
+        pool.close()
+    return _decode_pool
+
+def close_decode_pool():
+    """デコード用のワーカープロセスを終了する（次に使用する際に起動し直す）"""
+    global _decode_pool
+    with _decode_pool_lock:
+        pool, _decode_pool = _decode_pool, None
+    if pool is not None:
+        pool.close()
+
+def get_parallel_decode_threshold():
+    """ワーカープロセスでデコードするパートのサイズ（エンコードされたままのバイト数、環境変数 PARALLEL_DECODE_THRESHOLD、既定値 262144）"""
+    return int(os.environ.get('PARALLEL_DECODE_THRESHOLD', str(256 * 1024)))
+
+def transcode_deferred_parts(deferred, context):
+    """大きいシングルパートをまとめてデコードし、仮に置いたオリジナルのパートと置き換える
+    2件以上ある場合はワーカープロセスで並行して処理し、ワーカーが異常終了した場合はこのプロセスで処理し直す。
+    * Input Value: (親パート, 親パート内の位置, オリジナルのパート) のリスト、BuildContext
+    * Output Value: なし（親パートを更新する）
+    """
+    # 上限を超えることが分かっている場合はワーカープロセスに渡さない
+    context.check_remaining(sum(get_payload_size(message) for _, _, message in deferred))
+    tasks = [get_transcode_task(message, context) for _, _, message in deferred]
+    results = None
+    pool = get_decode_pool() if len(tasks) > 1 else None
+    if pool is not None:
+        try:
+            results = pool.map([pack_transcode_task(task) for task in tasks])
+            record_metric('ParallelDecodeParts', len(tasks))
+        except (OSError, EOFError) as e:
+            logger.error(f"ワーカープロセスでのデコードに失敗したため、このプロセスで処理します: {str(e)}")
+            close_decode_pool()
+    if results is None:
+        results = [_run_transcode_task(task) for task in tasks]
+
+    for (parent, index, message), (plan, error) in zip(deferred, results):
+        if error is not None:
+            logger.error(f"パートのデコード中にエラーが発生: {error}")
+        part = build_transcoded_part(message, plan)
+        context.add_size(estimate_message_size(part))
+        parent.get_payload()[index] = part
+
+def build_omitted_part(message, reason):
+    """転送メールに含めない MIME サブツリーの代わりに添付するテキストパートを作成
+    * Input Value: 省略するパート、省略の理由
+    * Output Value: 省略したパートの情報を記載したテキストパート（MIMEText）
+    """
+    from email.mime.text import MIMEText
+
+    depth, parts, size = measure_mime_tree(message)
+    return MIMEText(f"""--- Omitted MIME Part ({reason} exceeded) ---
+Content-Type: {message.get_content_type()}
+Parts: {parts}
+Depth: {depth}
+Size: {size} bytes
+""", 'plain')
+
+def attach_raw_part(parent, message, context, reason, depth=0):
+    """予算を超えたパートをデコードせずにそのまま添付
+    出力時の再帰が MIME_MAX_DEPTH を超える深さになるサブツリーは、そのまま添付せずに省略した旨のテキストパートに置き換える。
+    """
+    if reason not in context.degraded_reasons:
+        logger.warning(f"MIME の処理上限（{reason}）を超えたため、以降の該当パートはデコードせずに添付します")
+    context.degraded_reasons.add(reason)
+    if message.is_multipart() and context.max_depth and (
+            reason == 'MIME_MAX_DEPTH' or depth + measure_mime_tree(message)[0] > context.max_depth):
+        message = build_omitted_part(message, reason)
+    context.add_size(estimate_message_size(message))
+    record_metric('DegradedParts', 1)
+    parent.attach(message)
+
+def decode_parts(parent, message, context=None):
+    """メッセージを分解して転送メールに組み込む
+    明示的なスタックで MIME ツリーを走査し、multipart は MIMEMultipart として組み直し、
+    シングルパートはデコードして、添付ファイル（message/rfc822）はそのまま組み込む。
+    作成中の転送メールのサイズを context に積算し、上限を超えた時点で MessageTooLargeError を送出する。
+    context の予算（ネストの深さ・パート数・合計サイズ・パートごとのサイズ）を超えたパートは、
+    デコードせずにオリジナルのパートをそのまま添付する（深さを超えたサブツリーは省略した旨のテキストパートに置き換える）。
+    * Input Value: 親MIMEMessageオブジェクト、メールメッセージ、BuildContext
+    * Output Value: なし（parent に組み込む）
+    """
+    # 転送メールの作成時のみ必要なため遅延インポート
+    from email.mime.multipart import MIMEMultipart
+
+    if context is None:
+        context = BuildContext()
+    # DEBUG ログが無効な場合はログ出力用の値も作らない
+    debug_enabled = logger.isEnabledFor(logging.DEBUG)
+    # 大きいシングルパートは走査の後にワーカープロセスでまとめて処理する
+    # （cProfile はワーカープロセスを計測しないため、プロファイルの取得中はこのプロセスで処理する）
+    deferred = [] if int(os.environ.get('DECODE_WORKERS', '0')) > 0 and not _profiling else None
+    threshold = get_parallel_decode_threshold()
+
+    stack = [(parent, message, 0)]
+    while stack:
+        parent, message, depth = stack.pop()
+        if id(message) in context.skipped_parts:
+            # サイズ超過のため省略するパート
+            continue
+
+        reason = context.check_budget(message, depth)
+        if reason is not None:
+            attach_raw_part(parent, message, context, reason, depth)
+        elif message.get_content_type() == "message/rfc822":
+            # 添付ファイルの場合
+            if debug_enabled:
+                logger.debug("添付メッセージ: %s / %s", message.get_content_type(), message.get_content_subtype())
+            attach_embedded_message(parent, message, context)
+        elif message.is_multipart():
+            # マルチパートの場合（子パートは元の順序で処理されるよう逆順に積む）
+            if debug_enabled:
+                logger.debug("マルチパートメッセージ: %s / %s", message.get_content_type(), message.get_content_subtype())
+            new_part = MIMEMultipart(message.get_content_subtype())
+            parts = message.get_payload()
+            context.add_size(MULTIPART_OVERHEAD * (len(parts) + 1))
+            parent.attach(new_part)
+            stack.extend((new_part, part, depth + 1) for part in reversed(parts))
+        elif is_offload_candidate(message, context.offload_threshold):
+            # 大きい添付ファイルはS3へ退避し、署名付きURLに置き換える
+            stub = offload_attachment(message)
+            context.add_size(estimate_message_size(stub))
+            parent.attach(stub)
+        elif deferred is not None and get_payload_size(message) >= threshold and requires_decoding(message):
+            # デコードが必要な大きいシングルパートは、処理するまでオリジナルのパートを元の位置に置いておく
+            parent.attach(message)
+            deferred.append((parent, len(parent.get_payload()) - 1, message))
+        else:
+            # シングルパートの場合
+            decode_single_part(parent, message, context, debug_enabled)
+
+    if deferred:
+        transcode_deferred_parts(deferred, context)
+
+# 転送メールの本文・X-Original-* ヘッダーに引き継ぐオリジナルメールのヘッダー
+IMPORTANT_HEADER_KEYS = ['Date', 'Subject', 'From', 'Reply-To', 'To', 'Cc', 'Bcc']
+
+# パススルー転送でオリジナルメールから引き継がないヘッダー（小文字）
+# 宛先系ヘッダーを残すと SES がオリジナルの宛先へ再送してしまうため、X-Original-* に退避する
+PASSTHROUGH_DROP_HEADERS = {
+    'subject', 'from', 'reply-to', 'to', 'cc', 'bcc',
+    'return-path', 'sender', 'message-id', 'dkim-signature',
+}
+
+def set_forward_headers(msg, original_message, forward_to):
+    """転送メールの基本ヘッダーを設定
+    Subject / From / Reply-To / To を転送用に書き換え、
+    オリジナルメールの重要なヘッダーを X-Original-* として付与する。
+    * Input Value: 転送メール、オリジナルメッセージ、転送先アドレス
+    * Output Value: なし（転送メールを直接更新）
+    """
+    msg['Subject'] = f"Fw: {header_to_str(original_message['Subject'])}"
     msg['From'] = formataddr((
         str(Header(decode_email_header(original_message['From']), 'utf-8')),
         os.environ.get('SENDER_EMAIL', 'no-reply@example.com')
     ))
-    msg['Reply-To'] = original_message['From']
+    msg['Reply-To'] = header_to_str(original_message['From'])
     msg['To'] = forward_to
 
+    # 重要なヘッダーの転送
+    for header in IMPORTANT_HEADER_KEYS + ['Message-ID']:
+        if header in original_message:
+            msg[f'X-Original-{header}'] = header_to_str(original_message[header])
+
+def build_info_text(original_message, original_recipient, forward_to, dropped_attachments=None):
+    """転送情報の本文を作成
+    受信者アドレス・転送先アドレスと、オリジナルメールの重要なヘッダーを列挙したテキストを作成する。
+    サイズ超過のため省略した添付ファイルがある場合は、その一覧も追記する。
+    * Input Value: オリジナルメッセージ、受信者アドレス、転送先アドレス、省略した添付ファイルのリスト
+    * Output Value: 転送情報のテキスト（文字列）
+    """
     # オリジナルメールのヘッダー情報を取得
-    important_header_keys = ['Date', 'Subject', 'From', 'Reply-To', 'To', 'Cc', 'Bcc']
     important_headers = "\n".join(
         f"{header}: {decode_email_header(original_message[header])}"
-        for header in important_header_keys if header in original_message
+        for header in IMPORTANT_HEADER_KEYS if header in original_message
     )
     # original_headers = "\n".join(
     #     f"{header}: {decode_email_header(original_message[header])}"
-    #     for header in original_message.keys() if header not in important_header_keys
+    #     for header in original_message.keys() if header not in IMPORTANT_HEADER_KEYS
     # )
 
-    # 転送用本文の作成
     info_text = f"""
 Original Recipient: {original_recipient}
 Forwarded To: {forward_to}
@@ -188,74 +2029,747 @@ Forwarded To: {forward_to}
 {important_headers}
 
 """
-    msg.attach(MIMEText(info_text, 'plain'))
+    if dropped_attachments:
+        dropped = "\n".join(f"{filename} ({size} bytes)" for _, filename, size in dropped_attachments)
+        info_text += f"""--- Dropped Attachments (message size limit exceeded) ---
+{dropped}
 
-    # 重要なヘッダーの転送
-    important_header_keys.append('Message-ID')
-    for header in important_header_keys:
-        if header in original_message:
-            msg[f'X-Original-{header}'] = original_message[header]
+"""
+    return info_text
+
+def create_forwarded_message(original_message, original_recipient, forward_to):
+    """転送用の新規メールメッセージを作成
+    オリジナルメッセージの情報と転送先アドレスを受け取り、転送メールを作成する。
+    オリジナルメッセージのヘッダーの一部を転送メールにコピーする。
+    作成中にサイズ上限（MAX_MESSAGE_SIZE）を超えた場合は、その時点で作成を打ち切る。
+    OVERSIZE_POLICY=drop_attachments の場合は、大きい添付ファイルから順に省略して作成し直す。
+    * Input Value: オリジナルメッセージ、受信者アドレス、転送先アドレス
+    * Output Value: 転送メール（MIMEMultipartオブジェクト）
+    """
+    max_size = get_max_message_size()
+    try:
+        return _create_rebuilt_message(original_message, original_recipient, forward_to, BuildContext(max_size))
+    except MessageTooLargeError as e:
+        if os.environ.get('OVERSIZE_POLICY', 'error').lower() != 'drop_attachments':
+            raise
+        logger.warning(f"{str(e)}（大きい添付ファイルを省略して転送します）")
 
-    decode_parts(msg, original_message)
+    # 見積もりサイズが上限に収まるまで、大きい添付ファイルから順に省略する
+    candidates = sorted(find_attachments(original_message), key=lambda attachment: attachment[2], reverse=True)
+    estimated_size = estimate_message_size(original_message)
+    dropped = []
+    while candidates and (not dropped or estimated_size > max_size):
+        attachment = candidates.pop(0)
+        dropped.append(attachment)
+        estimated_size -= attachment[2]
+
+    while True:
+        context = BuildContext(max_size, skipped_parts={id(part) for part, _, _ in dropped})
+        try:
+            return _create_rebuilt_message(original_message, original_recipient, forward_to, context, dropped)
+        except MessageTooLargeError:
+            # 見積もりより大きくなった場合は、さらに添付ファイルを省略する
+            if not candidates:
+                raise
+            dropped.append(candidates.pop(0))
+
+def _create_rebuilt_message(original_message, original_recipient, forward_to, context, dropped_attachments=None):
+    """各パートを再構築して転送メールを作成（create_forwarded_message の本体）"""
+    from email.mime.multipart import MIMEMultipart
+    from email.mime.text import MIMEText
+
+    msg = MIMEMultipart()
+    context.sender_domain = get_sender_domain(original_message)
+
+    # 基本ヘッダーの設定
+    set_forward_headers(msg, original_message, forward_to)
+
+    # 転送用本文の作成
+    info_part = MIMEText(build_info_text(original_message, original_recipient, forward_to, dropped_attachments), 'plain')
+    msg.attach(info_part)
+    context.add_size(estimate_header_size(msg) + estimate_message_size(info_part) + MULTIPART_OVERHEAD * 2)
+
+    decode_parts(msg, original_message, context)
 
     return msg
 
+def create_passthrough_message(original_message, original_recipient, forward_to):
+    """本文を再構築せずに転送メールを作成
+    オリジナルメールのMIME本文（ペイロード）をそのまま引き継ぎ、ヘッダーのみを転送用に書き換える。
+    バイト列からパースしたメールを as_bytes() で出力すると、本文はオリジナルと同一のバイト列になる。
+    * Input Value: オリジナルメッセージ、受信者アドレス、転送先アドレス
+    * Output Value: 転送メール（Messageオブジェクト）
+    """
+    msg = Message()
+    for key, value in original_message.items():
+        if key.lower() not in PASSTHROUGH_DROP_HEADERS:
+            msg[key] = header_to_str(value)
+    set_forward_headers(msg, original_message, forward_to)
+
+    # ペイロードはコピーせず、オリジナルのオブジェクトをそのまま参照する
+    # （get_payload() は 8bit の内容を charset で文字列化してしまうため、パースしたままのペイロードを引き継ぐ）
+    msg._payload = original_message._payload
+    msg._charset = original_message._charset
+    msg.preamble = original_message.preamble
+    msg.epilogue = original_message.epilogue
+
+    check_message_size(estimate_message_size(msg))
+    return msg
+
+def create_attached_message(original_message, original_recipient, forward_to):
+    """オリジナルメールを添付した転送メールを作成
+    転送情報の本文に、オリジナルメールを加工せずに message/rfc822 として添付する。
+    * Input Value: オリジナルメッセージ、受信者アドレス、転送先アドレス
+    * Output Value: 転送メール（MIMEMultipartオブジェクト）
+    """
+    from email.mime.multipart import MIMEMultipart
+    from email.mime.text import MIMEText
+    from email.mime.message import MIMEMessage
+
+    msg = MIMEMultipart()
+    set_forward_headers(msg, original_message, forward_to)
+    msg.attach(MIMEText(build_info_text(original_message, original_recipient, forward_to), 'plain'))
+
+    attachment = MIMEMessage(original_message)
+    attachment.add_header('Content-Disposition', 'attachment', filename='original_message.eml')
+    msg.attach(attachment)
+
+    check_message_size(estimate_message_size(msg))
+    return msg
+
+# 転送モードと転送メール作成関数の対応
+FORWARD_MODES = {
+    'rebuild': create_forwarded_message,
+    'passthrough': create_passthrough_message,
+    'attach': create_attached_message,
+}
+
+def resolve_forward_mode(mode=None):
+    """転送モードを決定
+    モードが指定されていない場合は環境変数 FORWARD_MODE を使用する（省略時は rebuild）。
+    未知のモードが指定された場合は警告を出力し、rebuild とする。
+    * Input Value: 転送モード
+    * Output Value: 転送モード（FORWARD_MODES のキー）
+    """
+    mode = (mode or os.environ.get('FORWARD_MODE', 'rebuild')).lower()
+    if mode not in FORWARD_MODES:
+        logger.warning(f"未知の転送モード: {mode}（rebuild で転送します）")
+        mode = 'rebuild'
+    return mode
+
+def plan_forward_mode(deadline, mode=None):
+    """残り時間に応じて転送モードを選択
+    設定された転送モードでの作成と送信が残り時間に収まらない場合は、最も軽い passthrough に切り替える。
+    * Input Value: 残り時間（Deadline）、転送モード
+    * Output Value: 転送モード。passthrough でも残り時間に収まらない場合は None
+    """
+    mode = resolve_forward_mode(mode)
+    if deadline.allows(f'build:{mode}', 'send'):
+        return mode
+    if mode != 'passthrough' and deadline.allows('build:passthrough', 'send'):
+        logger.warning(f"残り時間が少ないため passthrough で転送します（{mode} の推定処理時間を超過）")
+        record_metric('DeadlineDowngradeCount', 1)
+        return 'passthrough'
+    return None
+
+def build_forwarded_message(original_message, original_recipient, forward_to, mode=None):
+    """転送モードに応じて転送メールを作成
+    モードが指定されていない場合は環境変数 FORWARD_MODE を使用する（省略時は rebuild）。
+    未知のモードが指定された場合は警告を出力し、rebuild で作成する。
+    * Input Value: オリジナルメッセージ、受信者アドレス、転送先アドレス、転送モード
+    * Output Value: 転送メール（Messageオブジェクト）
+    """
+    mode = resolve_forward_mode(mode)
+    try:
+        return FORWARD_MODES[mode](original_message, original_recipient, forward_to)
+    except MessageTooLargeError as e:
+        # passthrough / attach では添付ファイルを省略できないため、rebuild で作成し直す
+        if mode == 'rebuild' or os.environ.get('OVERSIZE_POLICY', 'error').lower() != 'drop_attachments':
+            raise
+        logger.warning(f"{str(e)}（{mode} の代わりに rebuild で転送します）")
+        return create_forwarded_message(original_message, original_recipient, forward_to)
+
+def map_concurrently(func, items, max_workers=None):
+    """要素ごとの処理をスレッドプールで並行実行
+    処理結果は入力と同じ順序で返す。各要素の例外は送出せず、結果と一緒に返す。
+    要素が1件の場合とプロファイルの取得中は、スレッドプールを使わずにそのまま実行する。
+    * Input Value: 処理関数、要素のリスト、最大並列数（省略時は環境変数 MAX_WORKERS、既定値 4）
+    * Output Value: (処理結果, 例外) のタプルのリスト
+    """
+    items = list(items)
+    if max_workers is None:
+        max_workers = int(os.environ.get('MAX_WORKERS', '4'))
+    if _profiling:
+        # cProfile は呼び出し元のスレッドしか計測しないため、プロファイル取得中は逐次実行する
+        max_workers = 1
+    max_workers = max(1, min(max_workers, len(items)))
+
+    def call(item):
+        try:
+            return func(item), None
+        except Exception as e:
+            return None, e
+
+    if max_workers == 1:
+        return [call(item) for item in items]
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        return list(executor.map(call, items))
+
+def resolve_forward_targets(recipients, routing_table):
+    """受信者アドレスの一覧から転送先を解決
+    転送先が見つかった受信者のみを対象とし、同じ転送先に解決される受信者はひとつにまとめる。
+    転送先はカンマ区切りのアドレスを正規化して比較するため、表記の違い（空白・大文字小文字）は同一とみなす。
+    * Input Value: 受信者アドレスのリスト、ルーティングテーブル
+    * Output Value: 転送先アドレスをkey、受信者アドレスのリストをvalueとする辞書型（受信順）
+    """
+    targets = {}
+    normalized_targets = {}
+    for recipient in recipients:
+        forward_to = resolve_forward(routing_table, recipient)
+        if forward_to is None:
+            logger.warning(f"転送先が設定されていないアドレス: {recipient}")
+            continue
+        normalized = tuple(sorted(addr.strip().lower() for addr in forward_to.split(',') if addr.strip()))
+        forward_to = normalized_targets.setdefault(normalized, forward_to)
+        targets.setdefault(forward_to, [])
+        if recipient not in targets[forward_to]:
+            targets[forward_to].append(recipient)
+    return targets
+
+@contextmanager
+def serialized_message(message):
+    """転送メールをバイト列に出力
+    as_string() で文字列全体を作らず、BytesGenerator で SpooledTemporaryFile に直接書き出す。
+    出力サイズが SPOOL_MAX_MEMORY（バイト、既定値 8MB、0 の場合は常にメモリ上）を超えた場合は /tmp のファイルに退避し、
+    そのファイルを mmap したものを返すことで、送信時にメッセージ全体をメモリ上に複製しないようにする。
+    * Input Value: 転送メール
+    * Output Value: (MIMEメッセージ（バイト列 または mmap）, サイズ) のタプル（with 文で使用）
+    """
+    from email.generator import BytesGenerator
+
+    max_memory = int(os.environ.get('SPOOL_MAX_MEMORY', str(8 * 1024 * 1024)))
+    with tempfile.SpooledTemporaryFile(max_size=max_memory) as spool:
+        BytesGenerator(spool, mangle_from_=False).flatten(message)
+        size = spool.tell()
+        if max_memory and size > max_memory:
+            # max_size を超えた時点でファイルに書き出し済み
+            with mmap.mmap(spool.fileno(), 0, access=mmap.ACCESS_READ) as data:
+                yield data, size
+        else:
+            spool.seek(0)
+            yield spool.read(), size
+
+def chunk_destinations(forward_to):
+    """転送先アドレスを SES の1回の送信で指定できる受信者数ごとに分割
+    カンマ区切りの転送先をアドレスのリストに変換し（大文字小文字の違いによる重複は除く）、
+    環境変数 SES_MAX_RECIPIENTS（既定値 50）件ずつに分割する。
+    * Input Value: 転送先アドレス（カンマ区切り）
+    * Output Value: 送信先アドレスのリストのリスト
+    """
+    from email.utils import getaddresses
+
+    addresses = []
+    seen = set()
+    for _, address in getaddresses([forward_to]):
+        if address and address.lower() not in seen:
+            seen.add(address.lower())
+            addresses.append(address)
+    chunk_size = max(1, int(os.environ.get('SES_MAX_RECIPIENTS', '50')))
+    return [addresses[index:index + chunk_size] for index in range(0, len(addresses), chunk_size)]
+
+def send_forwarded_message(original_message, original_recipient, forward_to, mode=None, chunks=None, verdict=None):
+    """転送メールを作成してSESで送信
+    転送メールの作成と出力は1回のみ行い、送信先（Destinations）のみを変えてチャンクごとに送信する。
+    チャンクごとの送信エラーは送出せず、チャンクごとの結果として返す。
+    作成から出力まで、送信の各処理時間を記録し、残り時間の判定に使う推定値を更新する。
+    * Input Value: オリジナルメッセージ、受信者アドレス、転送先アドレス、転送モード（省略時は FORWARD_MODE）、
+      送信先アドレスのチャンク（省略時は転送先アドレスを chunk_destinations で分割）、受信判定ポリシーの評価結果
+    * Output Value: チャンクごとの送信結果（destinations / status / sesMessageId または error）のリスト
+    """
+    all_chunks = chunk_destinations(forward_to)
+    if chunks is None:
+        chunks = all_chunks
+    if not chunks:
+        raise ValueError(f"転送先アドレスがありません: {forward_to}")
+    # 1回で送信できる場合は従来どおり MIMEヘッダ 'To' の宛先に送信し、分割する場合のみ Destinations を指定する
+    use_destinations = len(all_chunks) > 1
+    mode = resolve_forward_mode(mode)
+    started = time.perf_counter()
+
+    # 転送用メールを作成
+    with stage_timer('BuildTime'):
+        forwarded_message = build_forwarded_message(original_message, original_recipient, forward_to, mode)
+    if verdict is not None:
+        apply_verdict_tag(forwarded_message, verdict)
+
+    results = []
+    with serialized_message(forwarded_message) as (data, size):
+        record_metric('OutputBytes', size, 'Bytes')
+        check_message_size(size)
+        observe_stage_cost(f'build:{mode}', time.perf_counter() - started)
+
+        # SESでメールを送信
+        # MIMEヘッダ 'To' には転送先アドレスをそのまま設定し、分割する場合の送信先は Destinations でチャンクごとに指定する
+        for destinations in chunks:
+            started = time.perf_counter()
+            try:
+                response = send_raw_message(
+                    forwarded_message['From'],
+                    data,
+                    recipient_count=len(destinations),
+                    destinations=destinations if use_destinations else None,
+                )
+            except Exception as e:
+                logger.error(f"メール転送中にエラーが発生: {', '.join(destinations)}: {str(e)}")
+                results.append({'destinations': destinations, 'status': 'failed', 'error': str(e),
+                                'retryable': is_retryable_error(e)})
+                continue
+            observe_stage_cost('send', time.perf_counter() - started)
+            logger.info(f"メール転送成功: {response['MessageId']}")
+            results.append({'destinations': destinations, 'status': 'forwarded', 'sesMessageId': response['MessageId']})
+    return results
+
+def defer_forward(result, message_id):
+    """残り時間が足りない転送先を、再試行可能な失敗として次の呼び出しに持ち越す"""
+    logger.warning(f"残り時間が少ないため転送を持ち越します: {message_id} -> {result['forwardTo']}")
+    record_metric('DeadlineDeferCount', 1)
+    result.update(status='failed', error='Insufficient remaining time', retryable=True, deferred=True)
+
+def lookup_sent(store, key):
+    """冪等性ストアから送信済みの SES メッセージIDを取得（参照に失敗した場合は未送信とみなす）"""
+    if store is None:
+        return None
+    try:
+        return store.get(key)
+    except ClientError as e:
+        logger.error(f"冪等性ストアの参照に失敗: {str(e)}")
+        return None
+
+def record_sent(store, key, ses_message_id):
+    """冪等性ストアに送信済みとして記録（記録に失敗した場合はログのみ出力）"""
+    if store is None:
+        return
+    try:
+        store.put(key, ses_message_id)
+    except ClientError as e:
+        logger.error(f"冪等性ストアへの記録に失敗: {str(e)}")
+
+def send_to_target(original_message, result, message_id, store, mode, verdict=None):
+    """転送先1件に転送メールを送信し、結果を result に設定
+    送信先が複数のチャンクに分かれる場合は、チャンクごとに送信済みかを記録し、
+    一部のチャンクのみ失敗した場合のリトライでは失敗したチャンクのみを送信する。
+    * Input Value: オリジナルメッセージ、転送先ごとの処理結果（辞書型）、メッセージID、冪等性ストア、転送モード、
+      受信判定ポリシーの評価結果
+    * Output Value: なし（result を更新）
+    """
+    forward_to = result['forwardTo']
+    key = get_idempotency_key(message_id, forward_to)
+    chunks = chunk_destinations(forward_to)
+    chunk_results = [None] * len(chunks)
+    if len(chunks) > 1:
+        for index, destinations in enumerate(chunks):
+            ses_message_id = lookup_sent(store, f'{key}#{index}')
+            if ses_message_id is not None:
+                chunk_results[index] = {'destinations': destinations, 'status': 'forwarded',
+                                        'sesMessageId': ses_message_id, 'duplicate': True}
+
+    unsent = [index for index, chunk_result in enumerate(chunk_results) if chunk_result is None]
+    try:
+        sent = send_forwarded_message(original_message, ', '.join(result['recipients']), forward_to, mode,
+                                      [chunks[index] for index in unsent], verdict)
+    except Exception as e:
+        logger.error(f"メール転送中にエラーが発生: {forward_to}: {str(e)}")
+        result.update(status='failed', error=str(e), retryable=is_retryable_error(e))
+        return
+    for index, chunk_result in zip(unsent, sent):
+        chunk_results[index] = chunk_result
+        if len(chunks) > 1 and chunk_result['status'] == 'forwarded':
+            record_sent(store, f'{key}#{index}', chunk_result['sesMessageId'])
+
+    if len(chunks) > 1:
+        result['chunks'] = chunk_results
+    failed = [chunk_result for chunk_result in chunk_results if chunk_result['status'] == 'failed']
+    if failed:
+        # 一時的なエラーで失敗した送信がある場合は、リトライで失敗した送信のみを送り直す
+        result.update(status='failed', error=failed[0]['error'],
+                      retryable=any(chunk_result['retryable'] for chunk_result in failed))
+        return
+    result.update(status='forwarded', sesMessageId=chunk_results[0]['sesMessageId'])
+    record_sent(store, key, result['sesMessageId'])
+
+def deliver_forwards(message_id, targets, load_message, verdicts=None):
+    """解決済みの転送先ごとに転送メールを送信
+    冪等性ストアに送信済みとして記録されている転送先は再送信せず、すべて送信済みの場合はメールの取得も行わない。
+    Lambda の残り時間が各ステージの推定処理時間に足りない場合は、passthrough に切り替えるか、
+    再試行可能な失敗（retryable）として持ち越す。
+    * Input Value: メッセージID、転送先ごとの受信者アドレス（辞書型）、オリジナルメールを取得する関数、
+      転送先ごとの受信判定ポリシーの評価結果（辞書型）
+    * Output Value: 処理結果（辞書型）
+    """
+    verdicts = verdicts or {}
+    # 送信済みの転送先はリトライ時に再送信しない
+    store = get_idempotency_store()
+    forwards = []
+    pending = []
+    for forward_to, recipients in targets.items():
+        result = {'forwardTo': forward_to, 'recipients': recipients}
+        ses_message_id = lookup_sent(store, get_idempotency_key(message_id, forward_to))
+        if ses_message_id is not None:
+            logger.info(f"送信済みのためスキップ: {message_id} -> {forward_to}")
+            result.update(status='forwarded', sesMessageId=ses_message_id, duplicate=True)
+            record_metric('DuplicateSkipCount', 1)
+        else:
+            pending.append(result)
+        forwards.append(result)
+
+    # 残り時間で取得から送信まで終えられない場合は、取得せずに次の呼び出しへ持ち越す
+    deadline = get_current_deadline()
+    if pending and not deadline.allows('load', 'build:passthrough', 'send'):
+        for result in pending:
+            defer_forward(result, message_id)
+        pending = []
+
+    if pending:
+        started = time.perf_counter()
+        original_message = load_message()
+        observe_stage_cost('load', time.perf_counter() - started)
+        try:
+            # 転送先ごとに転送メールを作成して送信
+            for result in pending:
+                mode = plan_forward_mode(deadline)
+                if mode is None:
+                    defer_forward(result, message_id)
+                    continue
+                send_to_target(original_message, result, message_id, store, mode, verdicts.get(result['forwardTo']))
+        finally:
+            close_spools(original_message)
+
+    status = 'forwarded' if all(result['status'] == 'forwarded' for result in forwards) else 'failed'
+    return {'messageId': message_id, 'status': status, 'forwards': forwards}
+
+def process_record(record):
+    """SESイベントのレコードを1件処理
+    すべての受信者アドレスについて転送先を解決し、転送先ごとに転送メールを送信する。
+    S3からのメールデータ取得とパースは1回のみ行い、パース結果を各転送先で共有する。
+    SESの受信判定（spamVerdict など）は S3 から取得する前に受信判定ポリシー（VERDICT_POLICY）で評価し、
+    drop となった受信者は転送しない。
+    * Input Value: SESイベントのレコード
+    * Output Value: 処理結果（辞書型）
+    """
+    # SESイベントからメール情報を取得
+    ses_notification = record['ses']
+    receipt = ses_notification['receipt']
+    mail = ses_notification['mail']
+
+    # S3から取得する前に、SESの受信判定でポリシーが drop となる受信者を除外
+    screened = screen_recipients(receipt['recipients'], receipt)
+    recipients = [recipient for recipient, (action, _) in screened.items() if action != 'drop']
+    if len(recipients) < len(screened):
+        dropped = [recipient for recipient in screened if recipient not in recipients]
+        logger.info(f"受信判定ポリシーにより転送しません: {mail['messageId']}: {', '.join(dropped)}")
+        record_metric('VerdictDropCount', len(dropped))
+        if not recipients:
+            return {'messageId': mail['messageId'], 'status': 'dropped', 'reason': 'Dropped by verdict policy'}
+
+    # すべての受信者アドレスについて転送先を確認
+    targets = resolve_forward_targets(recipients, get_routing_table())
+    if not targets:
+        return {'messageId': mail['messageId'], 'status': 'skipped', 'reason': 'No forward address configured'}
+
+    # 転送先ごとに、まとめた受信者のうち最も影響の大きいマークを付与する
+    verdicts = {}
+    for forward_to, forward_recipients in targets.items():
+        marks = [screened[recipient] for recipient in forward_recipients if screened[recipient][0] != 'forward']
+        if marks:
+            action = max((mark[0] for mark in marks), key=VERDICT_ACTIONS.index)
+            verdicts[forward_to] = (action, sorted({reason for mark in marks for reason in mark[1]}))
+            record_metric('VerdictTagCount', 1)
+
+    # S3からメールデータを取得（送信が必要な転送先がある場合のみ）
+    bucket = os.environ.get('S3_BUCKET')
+    key = f'{os.environ.get('S3_PATH')}/{mail['messageId']}'
+    return deliver_forwards(mail['messageId'], targets, lambda: load_original_message(bucket, key), verdicts)
+
+RECIPIENT_HEADER_KEYS = ['X-Original-To', 'Delivered-To', 'To', 'Cc']
+
+def get_recipients_from_headers(message):
+    """保存されたメールのヘッダーから受信者アドレスを取得
+    S3 の通知には SES の受信者情報が含まれないため、X-Original-To / Delivered-To / To / Cc から受信者を推定する。
+    Bcc で受信したメールなど、ヘッダーに受信者が現れない場合は転送できない。
+    * Input Value: メールメッセージ
+    * Output Value: 受信者アドレスのリスト
+    """
+    from email.utils import getaddresses
+
+    values = []
+    for header_key in RECIPIENT_HEADER_KEYS:
+        values.extend(decode_email_header(value) for value in message.get_all(header_key, []))
+    return [address for _, address in getaddresses(values) if address]
+
+def process_s3_object(bucket, key):
+    """S3 に保存されたメールを1件処理
+    メールを取得してヘッダーから受信者を推定し、転送先ごとに転送メールを送信する。
+    キーの末尾（SES のメッセージID）を冪等性ストアのキーとして使用するため、SES イベントによる処理と重複して送信しない。
+    * Input Value: バケット名、キー
+    * Output Value: 処理結果（辞書型）
+    """
+    message_id = key.rpartition('/')[2]
+    original_message = load_original_message(bucket, key)
+    try:
+        targets = resolve_forward_targets(get_recipients_from_headers(original_message), get_routing_table())
+        if not targets:
+            return {'messageId': message_id, 'status': 'skipped', 'reason': 'No forward address configured'}
+        return deliver_forwards(message_id, targets, lambda: original_message)
+    finally:
+        close_spools(original_message)
+
+def parse_s3_notification(body):
+    """SQS メッセージ本文の S3 イベント通知から、S3_PATH 配下に作成されたオブジェクトを取得
+    * Input Value: SQS メッセージ本文（JSON 文字列）
+    * Output Value: (バケット名, キー) のリスト
+    """
+    from urllib.parse import unquote_plus
+
+    prefix = f'{os.environ.get('S3_PATH')}/'
+    objects = []
+    # s3:TestEvent など Records を含まない通知は無視する
+    for s3_record in json.loads(body).get('Records', []):
+        if not s3_record.get('eventName', '').startswith('ObjectCreated:'):
+            continue
+        key = unquote_plus(s3_record['s3']['object']['key'])
+        if key.startswith(prefix):
+            objects.append((s3_record['s3']['bucket']['name'], key))
+    return objects
+
+def process_sqs_record(record):
+    """SQS メッセージを1件処理（含まれるすべての S3 オブジェクトを処理）
+    * Input Value: SQS メッセージのレコード
+    * Output Value: S3 オブジェクトごとの処理結果のリスト
+    """
+    return [process_s3_object(bucket, key) for bucket, key in parse_s3_notification(record['body'])]
+
+# プロファイルの取得中かどうか（profiled の実行中のみ True）
+_profiling = False
+
+def select_for_profiling(event):
+    """呼び出しのプロファイルを取得するかを判定
+    PROFILE_MESSAGE_IDS / PROFILE_RECIPIENTS（カンマ区切り）に一致するメールを含む呼び出しは必ず取得し、
+    それ以外は PROFILE_ENABLED が true の場合に PROFILE_SAMPLE_RATE（既定値 1.0）の割合で取得する。
+    いずれの環境変数も設定されていない場合は、イベントを参照せずに False を返す。
+    * Input Value: Lambdaイベント（SES イベント または SQS イベント）
+    * Output Value: プロファイルを取得する場合は True
+    """
+    enabled = os.environ.get('PROFILE_ENABLED', 'false').lower() == 'true'
+    forced_message_ids = os.environ.get('PROFILE_MESSAGE_IDS', '')
+    forced_recipients = os.environ.get('PROFILE_RECIPIENTS', '')
+    if not (enabled or forced_message_ids or forced_recipients):
+        return False
+
+    message_ids = {value.strip() for value in forced_message_ids.split(',') if value.strip()}
+    recipients = {value.strip().lower() for value in forced_recipients.split(',') if value.strip()}
+    for record in event.get('Records', []):
+        if 'ses' in record:
+            if record['ses']['mail'].get('messageId') in message_ids:
+                return True
+            if recipients.intersection(r.lower() for r in record['ses']['receipt'].get('recipients', [])):
+                return True
+        elif message_ids and 'body' in record:
+            try:
+                keys = [key for _, key in parse_s3_notification(record['body'])]
+            except (ValueError, KeyError, AttributeError):
+                continue
+            if any(key.rpartition('/')[2] in message_ids for key in keys):
+                return True
+
+    if enabled:
+        import random
+        return random.random() < float(os.environ.get('PROFILE_SAMPLE_RATE', '1.0'))
+    return False
+
+def write_profile_report(profiler, snapshot, peak, name):
+    """プロファイルの取得結果をファイルに書き出す
+    cProfile の結果を pstats 形式で、tracemalloc のピークメモリと確保量の多い行を
+    テキスト形式で PROFILE_OUTPUT_DIR（既定値は /tmp）に書き出す。
+    PROFILE_S3_URI（s3://bucket/prefix）が設定されている場合は S3 にもアップロードする。
+    * Input Value: cProfile.Profile、tracemalloc のスナップショット、ピークメモリ（バイト）、ファイル名
+    * Output Value: 書き出したファイルのパスのリスト
+    """
+    import tracemalloc
+
+    output_dir = os.environ.get('PROFILE_OUTPUT_DIR') or tempfile.gettempdir()
+    stats_path = os.path.join(output_dir, f'{name}.pstats')
+    profiler.dump_stats(stats_path)
+
+    allocations_path = os.path.join(output_dir, f'{name}-allocations.txt')
+    snapshot = snapshot.filter_traces([
+        tracemalloc.Filter(False, tracemalloc.__file__),
+        tracemalloc.Filter(False, '<frozen importlib._bootstrap*>'),
+    ])
+    top = int(os.environ.get('PROFILE_TOP_ALLOCATIONS', '25'))
+    with open(allocations_path, 'w', encoding='utf-8') as f:
+        f.write(f'peak: {peak} bytes\n')
+        for statistic in snapshot.statistics('lineno')[:top]:
+            f.write(f'{statistic}\n')
+
+    paths = [stats_path, allocations_path]
+    uri = os.environ.get('PROFILE_S3_URI')
+    if uri:
+        bucket, _, prefix = uri[len('s3://'):].partition('/')
+        for path in paths:
+            key = '/'.join(part for part in (prefix.strip('/'), os.path.basename(path)) if part)
+            with open(path, 'rb') as f:
+                get_s3_client().put_object(Bucket=bucket, Key=key, Body=f)
+    logger.info(f"プロファイルを出力しました: {', '.join(paths)}")
+    return paths
+
+@contextmanager
+def profiled(event, context):
+    """with 文で囲んだ処理のプロファイル（cProfile / tracemalloc）を取得
+    select_for_profiling で対象となった呼び出しのみ取得し、それ以外は何もしない。
+    結果の書き出しに失敗しても、呼び出しの処理結果には影響させない。
+    * Input Value: Lambdaイベント、Lambdaコンテキスト
+    """
+    global _profiling
+    if not select_for_profiling(event):
+        yield
+        return
+
+    import cProfile
+    import tracemalloc
+
+    profiler = cProfile.Profile()
+    try:
+        profiler.enable()
+    except ValueError as e:
+        # 別のプロファイラが有効な場合は取得しない
+        logger.warning(f"プロファイルを取得できません: {str(e)}")
+        yield
+        return
+    started_tracing = not tracemalloc.is_tracing()
+    if started_tracing:
+        tracemalloc.start()
+    _profiling = True
+    try:
+        yield
+    finally:
+        profiler.disable()
+        _profiling = False
+        snapshot = tracemalloc.take_snapshot()
+        peak = tracemalloc.get_traced_memory()[1]
+        if started_tracing:
+            tracemalloc.stop()
+        name = f"profile-{time.strftime('%Y%m%dT%H%M%S')}-{getattr(context, 'aws_request_id', None) or os.getpid()}"
+        try:
+            write_profile_report(profiler, snapshot, peak, name)
+        except Exception as e:
+            logger.error(f"プロファイルの出力に失敗: {str(e)}")
+
 def lambda_handler(event, context):
     """Lambda関数のメインハンドラー
-    SESイベントを処理し、転送先設定から転送判定と転送先アドレスの設定を行う。
-    S3からメールデータを取得し、SESでメールを転送する。
-    * Input Value: Lambdaイベント
+    SESイベントの全レコードをスレッドプールで並行処理する（最大並列数は環境変数 MAX_WORKERS）。
+    レコード単位で発生したエラーでは処理を中断せず、処理結果としてレコードごとに記録する。
+    METRICS_ENABLED が false でない場合は、各ステージの処理時間などを EMF 形式のメトリクスとして出力する。
+    一時的なエラーで転送に失敗したレコードがある場合は、全レコードの処理後に ForwardingFailedError
+    （context の残り時間が足りず持ち越しただけの場合は DeadlineExceededError）を送出する。
+    リトライしても成功しない失敗のみの場合は送出せず、retryable が False の失敗としてレスポンスに記録する。
+    * Input Value: Lambdaイベント、Lambdaコンテキスト
     * Output Value: Lambdaレスポンス（JSON形式）
     """
+    global _current_metrics, _current_deadline
+    if os.environ.get('METRICS_ENABLED', 'true').lower() == 'true':
+        _current_metrics = InvocationMetrics({'RequestId': getattr(context, 'aws_request_id', None)})
+    _current_deadline = Deadline(context)
     try:
-        for record in event['Records']:
-            # SESイベントからメール情報を取得
-            ses_notification = record['ses']
-            receipt = ses_notification['receipt']
-            mail = ses_notification['mail']
-
-            # メールの受信者アドレスを取得
-            original_recipient = receipt['recipients'][0]
-
-            # 転送先設定を確認
-            forwards = get_email_forwards()
-            if original_recipient not in forwards:
-                logger.warning(f"転送先が設定されていないアドレス: {original_recipient}")
-                return {
-                    'statusCode': 200,
-                    'body': json.dumps('No forward address configured')
-                }
-            forward_to = forwards[original_recipient]
-
-            # S3からメールデータを取得
-            bucket = os.environ.get('S3_BUCKET')
-            key = f'{os.environ.get('S3_PATH')}/{mail['messageId']}'
-            email_data = get_message_from_s3(bucket, key)
+        with profiled(event, context):
+            response = _handle_ses_event(event)
+    finally:
+        if _current_metrics is not None:
+            _current_metrics.emit()
+            _current_metrics = None
+        _current_deadline = None
 
-            # オリジナルメールをパース
-            original_message = email.message_from_string(email_data)
+    # 一時的なエラーで失敗したレコードがある場合のみ例外を送出し、非同期呼び出しのリトライで処理させる
+    # （送信済みの転送先は冪等性ストアによりリトライ時に再送信しない）
+    retryable = [result for result in response['results'] if is_retryable_result(result)]
+    if retryable:
+        message_ids = ', '.join(str(result['messageId']) for result in retryable)
+        if all(is_deferred_result(result) for result in retryable):
+            raise DeadlineExceededError(f"残り時間が足りないため転送を持ち越しました: {message_ids}", response)
+        raise ForwardingFailedError(f"転送に失敗したメールがあります: {message_ids}", response)
+    return response
 
-            # 転送用メールを作成
-            forwarded_message = create_forwarded_message(original_message, original_recipient, forward_to)
+def get_retryable_forwards(result):
+    """レコードの処理結果から、一時的なエラーで失敗した転送先を取得"""
+    return [forward for forward in result.get('forwards', []) if forward['status'] == 'failed' and forward.get('retryable')]
 
-            # # 送信時にカンマで分割してリスト化
-            # forward_to_list = [addr.strip() for addr in forward_to.split(',')]
+def is_retryable_result(result):
+    """失敗したレコードが、リトライで成功する可能性があるかを判定"""
+    return result['status'] == 'failed' and bool(result.get('retryable') or get_retryable_forwards(result))
 
-            # SESでメールを送信
-            response = ses_client.send_raw_email(
-                Source=forwarded_message['From'],
-                # create_forwarded_message 関数で、MIMEヘッダ 'To' に指定されているので、重複指定を避ける
-                # MIMEヘッダでは指定していないアドレスを送信先に含める場合には、Destinations にリストで指定する
-                # Destinations=forward_to_list,
-                RawMessage={'Data': forwarded_message.as_string()}
-            )
+def is_deferred_result(result):
+    """一時的なエラーで失敗した転送先がすべて残り時間不足による持ち越しかを判定"""
+    retryable = get_retryable_forwards(result)
+    return not result.get('retryable') and bool(retryable) and all(forward.get('deferred') for forward in retryable)
 
-            logger.info(f"メール転送成功: {response['MessageId']}")
-            return {
-                'statusCode': 200,
-                'body': json.dumps('Email forwarded successfully')
-            }
+def sqs_handler(event, context):
+    """SQS のバッチを処理する Lambda ハンドラー
+    S3 の ObjectCreated 通知を受け取り、S3_PATH 配下に保存されたメールを転送する。
+    メッセージはスレッドプールで並行処理し（最大並列数は環境変数 MAX_WORKERS）、
+    転送に失敗したメッセージのみを batchItemFailures として返して SQS から再配信させる。
+    * Input Value: SQS イベント
+    * Output Value: 部分的なバッチ失敗のレスポンス（batchItemFailures）
+    """
+    global _current_metrics, _current_deadline
+    if os.environ.get('METRICS_ENABLED', 'true').lower() == 'true':
+        _current_metrics = InvocationMetrics({'RequestId': getattr(context, 'aws_request_id', None)})
+    _current_deadline = Deadline(context)
+    try:
+        with profiled(event, context):
+            return _handle_sqs_event(event)
+    finally:
+        if _current_metrics is not None:
+            _current_metrics.emit()
+            _current_metrics = None
+        _current_deadline = None
 
-    except Exception as e:
-        logger.error(f"メール転送中にエラーが発生: {str(e)}")
-        raise
\ No newline at end of file
+def _handle_sqs_event(event):
+    """SQS のバッチを処理してレスポンスを作成（sqs_handler の本体）"""
+    records = event['Records']
+    failures = []
+    for record, (results, error) in zip(records, map_concurrently(process_sqs_record, records)):
+        if error is None and all(result['status'] != 'failed' for result in results):
+            continue
+        if error is not None:
+            logger.error(f"SQS メッセージの処理中にエラーが発生: {record['messageId']}: {str(error)}")
+        failures.append({'itemIdentifier': record['messageId']})
+    return {'batchItemFailures': failures}
+
+def _handle_ses_event(event):
+    """SESイベントの全レコードを処理してレスポンスを作成（lambda_handler の本体）"""
+    records = event['Records']
+    results = []
+    for record, (result, error) in zip(records, map_concurrently(process_record, records)):
+        if error is not None:
+            logger.error(f"メール転送中にエラーが発生: {str(error)}")
+            message_id = record.get('ses', {}).get('mail', {}).get('messageId')
+            result = {'messageId': message_id, 'status': 'failed', 'error': str(error),
+                      'retryable': is_retryable_error(error)}
+        results.append(result)
+
+    failed = sum(1 for result in results if result['status'] == 'failed')
+    forwarded = sum(1 for result in results if result['status'] == 'forwarded')
+    if failed == 0:
+        status_code = 200
+        body = 'Email forwarded successfully' if forwarded else 'No forward address configured'
+    elif failed == len(results):
+        status_code = 500
+        body = 'Failed to forward email'
+    else:
+        status_code = 207
+        body = 'Some emails failed to forward'
+
+    return {
+        'statusCode': status_code,
+        'body': json.dumps(body),
+        'results': results
+    }
@@ -26,7 +26,8 @@ class BaseAwsMockTest(unittest.TestCase):
             "to@example.com": "forward-to@example.com",
             "to2@example.com": "forward-to1@example.com,forward-to2@example.com",
             "cc@example.com": "forward-cc1@example.com,forward-cc2@example.com",
-            "bcc@example.com": "forward-bcc@example.com"
+            "bcc@example.com": "forward-bcc@example.com",
+            "alias@example.com": "Forward-To@example.com"
         }
 
         # --- 環境変数をセット ---
@@ -44,6 +45,10 @@ class BaseAwsMockTest(unittest.TestCase):
         self.mock = mock_aws()
         self.mock.start()
 
+        # 前のテストで記録された送信済みの転送をクリア
+        import lambda_function
+        lambda_function._idempotency_store = None
+
         # --- モックされた S3クライアントを使ってバケット作成 ---
         s3_client = boto3.client("s3")
         s3_client.create_bucket(
@@ -284,6 +289,125 @@ class TestLambdaFunction(BaseAwsMockTest):
         self.assertIn(os.environ["SENDER_EMAIL"], message.source)
         self.assertEqual(message.destinations, self.mail_forwards["cc@example.com"].split(','))
 
+    def test_lambda_handler_multiple_records(self):
+        """複数レコードがすべて処理され、レコードごとに結果が返ること"""
+
+        def ses_record(message_id, recipient):
+            return {
+                "eventSource": "aws:ses",
+                "eventVersion": "1.0",
+                "ses": {
+                    "mail": {"messageId": message_id},
+                    "receipt": {"recipients": [recipient]}
+                }
+            }
+
+        # 転送先未設定・S3に存在しないメール・正常なメールを混在させる
+        event = {
+            "Records": [
+                ses_record("mail-to-one-forward", "unknown@example.com"),
+                ses_record("mail-not-found", "to@example.com"),
+                ses_record("mail-to-one-forward", "to@example.com"),
+                ses_record("mail-to-two-forward", "to2@example.com"),
+            ]
+        }
+
+        from lambda_function import lambda_handler
+        # S3 に存在しないメールはリトライしても成功しないため、例外を送出せずに再試行不可の失敗として返す
+        response = lambda_handler(event, None)
+        self.assertEqual(response['statusCode'], 207)
+        self.assertEqual(
+            [result['status'] for result in response['results']],
+            ['skipped', 'failed', 'forwarded', 'forwarded']
+        )
+        self.assertEqual(response['results'][1]['messageId'], "mail-not-found")
+        self.assertIs(response['results'][1]['retryable'], False)
+
+        backend = ses_backends[DEFAULT_ACCOUNT_ID][os.environ["AWS_DEFAULT_REGION"]]
+        self.assertEqual(len(backend.sent_messages), 2, "失敗したレコード以外はすべて送信されること")
+
+    def test_retryable_errors(self):
+        """一時的なエラーのみを再試行可能とし、その場合のみ例外を送出してリトライさせること"""
+        import smtplib
+        from unittest import mock
+        from botocore.exceptions import ClientError, EndpointConnectionError
+        import lambda_function
+
+        def client_error(code, status):
+            return ClientError({"Error": {"Code": code}, "ResponseMetadata": {"HTTPStatusCode": status}}, "Operation")
+
+        for error in (client_error("Throttling", 400), client_error("InternalFailure", 500),
+                      client_error("SlowDown", 503), EndpointConnectionError(endpoint_url="https://s3"),
+                      smtplib.SMTPDataError(451, b"try again"), smtplib.SMTPServerDisconnected("closed"),
+                      smtplib.SMTPRecipientsRefused({"a@example.com": (450, b"busy")})):
+            self.assertTrue(lambda_function.is_retryable_error(error), error)
+        for error in (client_error("NoSuchKey", 404), client_error("MessageRejected", 400),
+                      lambda_function.MessageTooLargeError(2, 1), smtplib.SMTPDataError(554, b"rejected"),
+                      smtplib.SMTPRecipientsRefused({"a@example.com": (450, b"busy"), "b@example.com": (550, b"no")}),
+                      ValueError("broken")):
+            self.assertFalse(lambda_function.is_retryable_error(error), error)
+
+        event = {"Records": [{
+            "eventSource": "aws:ses",
+            "eventVersion": "1.0",
+            "ses": {"mail": {"messageId": "mail-to-one-forward"}, "receipt": {"recipients": ["to@example.com"]}}
+        }]}
+        with mock.patch.object(lambda_function, "send_raw_message", side_effect=client_error("MessageRejected", 400)):
+            response = lambda_function.lambda_handler(event, None)
+        self.assertEqual(response["statusCode"], 500)
+        with mock.patch.object(lambda_function, "send_raw_message", side_effect=client_error("Throttling", 400)):
+            with self.assertRaises(lambda_function.ForwardingFailedError) as raised:
+                lambda_function.lambda_handler(event, None)
+        self.assertNotIsInstance(raised.exception, lambda_function.DeadlineExceededError)
+        self.assertIs(raised.exception.response["results"][0]["forwards"][0]["retryable"], True)
+
+    def test_lambda_handler_multiple_recipients(self):
+        """すべての受信者が転送され、同じ転送先はまとめて1通になること"""
+        event = {
+            "Records": [{
+                "eventSource": "aws:ses",
+                "eventVersion": "1.0",
+                "ses": {
+                    "mail": {"messageId": "mail-to-cc-bcc"},
+                    "receipt": {
+                        "recipients": [
+                            "to@example.com",
+                            "cc@example.com",
+                            "alias@example.com",
+                            "unknown@example.com"
+                        ]
+                    }
+                }
+            }]
+        }
+
+        from unittest import mock
+        import lambda_function
+        with mock.patch.object(
+            lambda_function, "get_raw_message_from_s3", wraps=lambda_function.get_raw_message_from_s3
+        ) as get_raw:
+            response = lambda_function.lambda_handler(event, None)
+        self.assertEqual(response['statusCode'], 200)
+        self.assertEqual(get_raw.call_count, 1, "S3からの取得は1回のみであること")
+
+        forwards = response['results'][0]['forwards']
+        self.assertEqual(
+            [(forward['forwardTo'], forward['recipients']) for forward in forwards],
+            [
+                (self.mail_forwards["to@example.com"], ["to@example.com", "alias@example.com"]),
+                (self.mail_forwards["cc@example.com"], ["cc@example.com"]),
+            ]
+        )
+
+        backend = ses_backends[DEFAULT_ACCOUNT_ID][os.environ["AWS_DEFAULT_REGION"]]
+        self.assertEqual(
+            sorted(tuple(message.destinations) for message in backend.sent_messages),
+            sorted([
+                tuple(self.mail_forwards["to@example.com"].split(',')),
+                tuple(self.mail_forwards["cc@example.com"].split(',')),
+            ])
+        )
+
 class TestCreateForwardedMessage(BaseAwsMockTest):
 
     def setUp(self):
@@ -445,5 +569,1638 @@ class TestCreateForwardedMessage(BaseAwsMockTest):
         self.assertIn("Fw: Unsupported Test", forwarded_message["Subject"])
         self.assertIn("forwarded@example.com", forwarded_message["To"])
 
+class TestIngestMode(BaseAwsMockTest):
+
+    def setUp(self):
+        """Shift_JIS の8bit本文と生のUTF-8ヘッダーを含むメールをS3に配置"""
+        super().setUp()
+        self.key = f'{os.environ["S3_PATH"]}/mail-sjis-8bit'
+        raw = (
+            "From: 送信者 <from@example.com>\n"
+            "To: to@example.com\n"
+            "Subject: 件名テスト\n"
+            "MIME-Version: 1.0\n"
+            "Content-Type: text/plain; charset=\"Shift_JIS\"\n"
+            "Content-Transfer-Encoding: 8bit\n"
+            "\n"
+        ).encode('utf-8') + "シフトJISの本文です".encode('shift_jis') + b"\n"
+        boto3.client("s3").put_object(Bucket=os.environ['S3_BUCKET'], Key=self.key, Body=raw)
+
+    def tearDown(self):
+        os.environ.pop("INGEST_MODE", None)
+        super().tearDown()
+
+    def test_bytes_ingest_skips_chardet(self):
+        """バイト列取り込みではメール全体の文字コード判定を行わないこと"""
+        from unittest import mock
+        from lambda_function import load_original_message, create_forwarded_message
+        with mock.patch("chardet.detect", side_effect=AssertionError("chardet must not be called")):
+            original_message = load_original_message(os.environ['S3_BUCKET'], self.key)
+
+        # 本文はパートで宣言された charset でデコードされる
+        self.assertEqual(
+            original_message.get_payload(decode=True).decode(original_message.get_content_charset()),
+            "シフトJISの本文です\n"
+        )
+
+        # 生の8bitヘッダーも文字列として転送メールに反映される
+        forwarded_message = create_forwarded_message(original_message, "to@example.com", "forward-to@example.com")
+        from lambda_function import decode_email_header
+        self.assertEqual(decode_email_header(forwarded_message["Subject"]), "Fw: 件名テスト")
+        body_part = forwarded_message.get_payload()[1]
+        self.assertIn("シフトJISの本文です", body_part.get_payload(decode=True).decode(body_part.get_content_charset()))
+
+    def test_string_ingest_fallback(self):
+        """INGEST_MODE=string で従来の文字列取り込みが使えること"""
+        os.environ["INGEST_MODE"] = "string"
+        from lambda_function import load_original_message
+        original_message = load_original_message(os.environ['S3_BUCKET'], self.key)
+        self.assertEqual(original_message["To"], "to@example.com")
+
+class TestForwardMode(BaseAwsMockTest):
+
+    def setUp(self):
+        """バイナリ添付と8bit本文を含むメールを用意"""
+        super().setUp()
+        self.raw = (
+            "From: sender@example.com\n"
+            "To: to@example.com\n"
+            "Cc: cc@example.com\n"
+            "Subject: Passthrough Test\n"
+            "Message-ID: <passthrough@example.com>\n"
+            "DKIM-Signature: v=1; a=rsa-sha256; d=example.com; b=abc\n"
+            "MIME-Version: 1.0\n"
+            "Content-Type: multipart/mixed; boundary=\"BOUNDARY\"\n"
+            "\n"
+            "--BOUNDARY\n"
+            "Content-Type: text/plain; charset=\"UTF-8\"\n"
+            "Content-Transfer-Encoding: 8bit\n"
+            "\n"
+            "本文です\n"
+            "--BOUNDARY\n"
+            "Content-Type: application/octet-stream; name=\"data.bin\"\n"
+            "Content-Disposition: attachment; filename=\"data.bin\"\n"
+            "Content-Transfer-Encoding: base64\n"
+            "\n"
+            "AAECA//+/f8=\n"
+            "--BOUNDARY--\n"
+        ).encode('utf-8')
+        self.key = f'{os.environ["S3_PATH"]}/mail-passthrough'
+        boto3.client("s3").put_object(Bucket=os.environ['S3_BUCKET'], Key=self.key, Body=self.raw)
+
+    def tearDown(self):
+        os.environ.pop("FORWARD_MODE", None)
+        os.environ.pop("INGEST_MODE", None)
+        super().tearDown()
+
+    def test_passthrough_keeps_body_bytes(self):
+        """パススルー転送では本文がバイト単位で維持され、ヘッダーのみ書き換わること"""
+        from email import message_from_bytes
+        from lambda_function import create_passthrough_message
+        original_message = message_from_bytes(self.raw)
+        forwarded_message = create_passthrough_message(original_message, "to@example.com", "forward-to@example.com")
+
+        forwarded_bytes = forwarded_message.as_bytes()
+        self.assertEqual(forwarded_bytes.split(b"\n\n", 1)[1], self.raw.split(b"\n\n", 1)[1])
+        self.assertEqual(forwarded_message["To"], "forward-to@example.com")
+        self.assertEqual(forwarded_message["Subject"], "Fw: Passthrough Test")
+        self.assertEqual(forwarded_message["X-Original-Cc"], "cc@example.com")
+        self.assertIsNone(forwarded_message["Cc"])
+        self.assertIsNone(forwarded_message["DKIM-Signature"])
+        self.assertIsNone(forwarded_message["Message-ID"])
+
+    def test_passthrough_single_part_8bit(self):
+        """シングルパートの 8bit 本文も、パススルー転送ではバイト単位で維持されること"""
+        from email import message_from_bytes
+        from lambda_function import create_passthrough_message, serialized_message
+        raw = ("From: sender@example.com\r\n"
+               "To: to@example.com\r\n"
+               "Subject: 件名テスト\r\n"
+               "MIME-Version: 1.0\r\n"
+               "Content-Type: text/plain; charset=utf-8\r\n"
+               "Content-Transfer-Encoding: 8bit\r\n"
+               "\r\n"
+               "日本語の本文です\r\n2行目\r\n").encode("utf-8")
+        forwarded_message = create_passthrough_message(message_from_bytes(raw), "to@example.com", "forward-to@example.com")
+        with serialized_message(forwarded_message) as (data, _):
+            self.assertEqual(bytes(data).split(b"\n\n", 1)[1], "日本語の本文です\n2行目\n".encode("utf-8"))
+
+    def test_string_ingest_keeps_8bit_body(self):
+        """INGEST_MODE=string でも、passthrough / attach で 8bit 本文をオリジナルのバイト列で転送できること"""
+        from lambda_function import load_original_message, build_forwarded_message, serialized_message
+        from email import message_from_bytes
+        os.environ["INGEST_MODE"] = "string"
+        for mode in ("passthrough", "attach", "rebuild"):
+            with self.subTest(mode=mode):
+                original_message = load_original_message(os.environ['S3_BUCKET'], self.key)
+                forwarded_message = build_forwarded_message(
+                    original_message, "to@example.com", "forward-to@example.com", mode=mode)
+                with serialized_message(forwarded_message) as (data, _):
+                    output = bytes(data)
+                if mode == "rebuild":
+                    body_part = message_from_bytes(output).get_payload()[1].get_payload()[0]
+                    self.assertEqual(body_part.get_payload(decode=True).decode("utf-8"), "本文です")
+                else:
+                    self.assertIn("本文です\n".encode("utf-8"), output)
+
+    def test_attach_mode_wraps_original(self):
+        """attach モードではオリジナルメールが message/rfc822 として添付されること"""
+        from email import message_from_bytes
+        from lambda_function import build_forwarded_message
+        original_message = message_from_bytes(self.raw)
+        forwarded_message = build_forwarded_message(original_message, "to@example.com", "forward-to@example.com", mode="attach")
+
+        parts = forwarded_message.get_payload()
+        self.assertEqual(len(parts), 2)
+        self.assertEqual(parts[1].get_content_type(), "message/rfc822")
+        self.assertIs(parts[1].get_payload(0), original_message)
+
+    def test_lambda_handler_passthrough(self):
+        """FORWARD_MODE=passthrough で転送先のみに送信されること"""
+        os.environ["FORWARD_MODE"] = "passthrough"
+        event = {
+            "Records": [{
+                "eventSource": "aws:ses",
+                "eventVersion": "1.0",
+                "ses": {
+                    "mail": {"messageId": "mail-passthrough"},
+                    "receipt": {"recipients": ["to@example.com"]}
+                }
+            }]
+        }
+
+        from lambda_function import lambda_handler
+        response = lambda_handler(event, None)
+        self.assertEqual(response['statusCode'], 200)
+
+        backend = ses_backends[DEFAULT_ACCOUNT_ID][os.environ["AWS_DEFAULT_REGION"]]
+        self.assertEqual(len(backend.sent_messages), 1)
+        self.assertEqual(backend.sent_messages[0].destinations, ["forward-to@example.com"])
+
+class TestRoutingTable(BaseAwsMockTest):
+
+    def setUp(self):
+        super().setUp()
+        import lambda_function
+        lambda_function._routing_cache.clear()
+
+    def tearDown(self):
+        import lambda_function
+        lambda_function._routing_cache.clear()
+        for name in ("MAIL_FORWARDS_S3_URI", "MAIL_FORWARDS_TTL", "STRIP_PLUS_ADDRESS"):
+            os.environ.pop(name, None)
+        super().tearDown()
+
+    def test_resolve_rules(self):
+        """完全一致・サブアドレス・ドメイン・正規表現の各ルールで転送先が解決されること"""
+        from lambda_function import compile_routing_table, resolve_forward
+        table = compile_routing_table({
+            "Info@example.com": "info@forward.example.com",
+            "*@example.com": "catchall@forward.example.com",
+            "/[/": "invalid@forward.example.com",
+        })
+
+        self.assertEqual(resolve_forward(table, "info@EXAMPLE.com"), "info@forward.example.com")
+        self.assertEqual(resolve_forward(table, "info+news@example.com"), "info@forward.example.com")
+        self.assertEqual(resolve_forward(table, "someone@example.com"), "catchall@forward.example.com")
+        self.assertIsNone(resolve_forward(table, "someone@other.example.com"))
+
+        # 正規表現は記述順に評価される
+        table = compile_routing_table({
+            "/^sales-[0-9]+@example\\.com$/": "sales@forward.example.com",
+            "/^sales-.*@example\\.com$/": "sales-other@forward.example.com",
+        })
+        self.assertEqual(resolve_forward(table, "sales-1@example.com"), "sales@forward.example.com")
+        self.assertEqual(resolve_forward(table, "sales-x@example.com"), "sales-other@forward.example.com")
+
+        os.environ["STRIP_PLUS_ADDRESS"] = "false"
+        table = compile_routing_table({"info@example.com": "info@forward.example.com"})
+        self.assertIsNone(resolve_forward(table, "info+news@example.com"))
+
+    def test_routing_table_is_cached(self):
+        """環境変数が変わらない限り、コンパイル済みのテーブルが再利用されること"""
+        from lambda_function import get_routing_table
+        self.assertIs(get_routing_table(), get_routing_table())
+
+    def test_routing_table_from_s3(self):
+        """S3の転送設定を ETag による条件付きGETで更新すること"""
+        s3_client = boto3.client("s3")
+        s3_client.put_object(
+            Bucket=os.environ['S3_BUCKET'], Key="config/forwards.json",
+            Body=json.dumps({"*@example.com": "s3-forward@example.com"})
+        )
+        os.environ["MAIL_FORWARDS_S3_URI"] = f"s3://{os.environ['S3_BUCKET']}/config/forwards.json"
+        os.environ["MAIL_FORWARDS_TTL"] = "0"
+
+        from unittest import mock
+        import lambda_function
+        table = lambda_function.get_routing_table()
+        self.assertEqual(lambda_function.resolve_forward(table, "any@example.com"), "s3-forward@example.com")
+
+        # 変更がなければ条件付きGETで304となり、同じテーブルが使われる
+        with mock.patch.object(
+            lambda_function.get_s3_client(), "get_object", wraps=lambda_function.get_s3_client().get_object
+        ) as get_object:
+            self.assertIs(lambda_function.get_routing_table(), table)
+        self.assertIn("IfNoneMatch", get_object.call_args.kwargs)
+
+        # 設定が更新されたら再取得される
+        s3_client.put_object(
+            Bucket=os.environ['S3_BUCKET'], Key="config/forwards.json",
+            Body=json.dumps({"*@example.com": "updated@example.com"})
+        )
+        table = lambda_function.get_routing_table()
+        self.assertEqual(lambda_function.resolve_forward(table, "any@example.com"), "updated@example.com")
+
+    def test_routing_table_s3_failure_falls_back_to_env(self):
+        """S3の転送設定が取得できない場合は環境変数 MAIL_FORWARDS を使用すること"""
+        os.environ["MAIL_FORWARDS_S3_URI"] = f"s3://{os.environ['S3_BUCKET']}/config/missing.json"
+        from lambda_function import get_routing_table, resolve_forward
+        self.assertEqual(resolve_forward(get_routing_table(), "to@example.com"), self.mail_forwards["to@example.com"])
+
+class TestColdStart(unittest.TestCase):
+
+    def test_heavy_modules_are_not_imported_at_load(self):
+        """モジュールの読み込み時に boto3・chardet・email.mime を読み込まないこと"""
+        import subprocess
+        import sys
+        code = (
+            "import sys, lambda_function; "
+            "print([name for name in ('boto3', 'chardet', 'email.mime.text') if name in sys.modules])"
+        )
+        output = subprocess.run(
+            [sys.executable, "-c", code], check=True, capture_output=True, text=True,
+            cwd=os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+        ).stdout
+        self.assertEqual(output.strip(), "[]")
+
+class TestSendThrottling(BaseAwsMockTest):
+
+    def tearDown(self):
+        for name in ("SES_MAX_SEND_RATE", "SES_SEND_BURST"):
+            os.environ.pop(name, None)
+        super().tearDown()
+
+    def test_token_bucket_limits_rate(self):
+        """トークンが不足した場合は補充されるまで待機すること"""
+        import time
+        from lambda_function import TokenBucket
+        bucket = TokenBucket(rate=50, capacity=1)
+        started = time.monotonic()
+        for _ in range(6):
+            bucket.acquire()
+        # 最初の1件はバーストで即時、残り5件は 1/50 秒ずつ待機する
+        self.assertGreaterEqual(time.monotonic() - started, 0.09)
+
+    def test_token_bucket_large_request(self):
+        """バースト上限を超える要求は後続の取得を待機させること"""
+        from lambda_function import TokenBucket
+        bucket = TokenBucket(rate=100, capacity=2)
+        self.assertEqual(bucket.acquire(5), 0.0)
+        self.assertGreater(bucket.acquire(1), 0.0)
+
+    def test_ses_client_uses_adaptive_retries(self):
+        """SESクライアントが adaptive リトライで生成されること"""
+        from lambda_function import get_ses_client
+        config = get_ses_client().meta.config
+        self.assertEqual(config.retries["mode"], "adaptive")
+        self.assertTrue(config.tcp_keepalive)
+
+    def test_send_rate_limiter_from_env(self):
+        """SES_MAX_SEND_RATE が設定された場合のみレート制限が有効になること"""
+        from lambda_function import get_send_rate_limiter
+        self.assertIsNone(get_send_rate_limiter())
+
+        os.environ["SES_MAX_SEND_RATE"] = "14"
+        limiter = get_send_rate_limiter()
+        self.assertEqual((limiter.rate, limiter.capacity), (14.0, 14.0))
+        self.assertIs(get_send_rate_limiter(), limiter)
+
+        os.environ["SES_SEND_BURST"] = "28"
+        self.assertEqual(get_send_rate_limiter().capacity, 28.0)
+
+class TestMessageSizeLimit(BaseAwsMockTest):
+
+    def setUp(self):
+        """大きさの異なる2つの添付ファイルを持つメールを用意"""
+        super().setUp()
+        from email.mime.application import MIMEApplication
+        self.original_message = MIMEMultipart()
+        self.original_message["Subject"] = "Size Test"
+        self.original_message["From"] = "sender@example.com"
+        self.original_message["To"] = "to@example.com"
+        self.original_message.attach(MIMEText("本文です", "plain", "utf-8"))
+        for filename, size in (("large.bin", 20000), ("small.bin", 1000)):
+            attachment = MIMEApplication(os.urandom(size))
+            attachment.add_header("Content-Disposition", "attachment", filename=filename)
+            self.original_message.attach(attachment)
+        os.environ["MAX_MESSAGE_SIZE"] = "10000"
+
+    def tearDown(self):
+        for name in ("MAX_MESSAGE_SIZE", "OVERSIZE_POLICY", "FORWARD_MODE"):
+            os.environ.pop(name, None)
+        super().tearDown()
+
+    def test_oversize_raises(self):
+        """サイズ上限を超えた場合は作成を打ち切って例外を送出すること"""
+        from unittest import mock
+        import lambda_function
+        with mock.patch.object(
+            lambda_function, "decode_single_part", wraps=lambda_function.decode_single_part
+        ) as decode_single_part, mock.patch.object(
+            lambda_function, "transcode_part", wraps=lambda_function.transcode_part
+        ) as transcode_part:
+            with self.assertRaises(lambda_function.MessageTooLargeError):
+                lambda_function.create_forwarded_message(self.original_message, "to@example.com", "forward-to@example.com")
+        # 本文・large.bin の処理で打ち切られ、後続の small.bin は処理しない
+        self.assertEqual(decode_single_part.call_count, 2)
+        # large.bin は上限の残りに収まらないため、デコードせずに打ち切る
+        self.assertEqual(transcode_part.call_count, 1)
+
+    def test_oversize_deferred_parts_are_not_transcoded(self):
+        """ワーカープロセスで処理するパートも、上限の残りに収まらない場合はデコードせずに打ち切ること"""
+        from unittest import mock
+        import lambda_function
+        parent = MIMEMultipart()
+        deferred = []
+        for index in range(2):
+            part = MIMEText("本文" * 3000, "plain", "utf-8")
+            parent.attach(part)
+            deferred.append((parent, index, part))
+        context = lambda_function.BuildContext(max_size=10000)
+        with mock.patch.object(lambda_function, "get_decode_pool") as get_decode_pool, \
+                mock.patch.object(lambda_function, "transcode_part") as transcode_part:
+            with self.assertRaises(lambda_function.MessageTooLargeError):
+                lambda_function.transcode_deferred_parts(deferred, context)
+        get_decode_pool.assert_not_called()
+        transcode_part.assert_not_called()
+
+    def test_oversize_drops_largest_attachment(self):
+        """OVERSIZE_POLICY=drop_attachments では大きい添付ファイルを省略し、本文に一覧を記載すること"""
+        os.environ["OVERSIZE_POLICY"] = "drop_attachments"
+        from lambda_function import create_forwarded_message
+        forwarded_message = create_forwarded_message(self.original_message, "to@example.com", "forward-to@example.com")
+
+        data = forwarded_message.as_bytes()
+        self.assertLessEqual(len(data), 10000)
+        filenames = [part.get_filename() for part in forwarded_message.walk() if part.get_filename()]
+        self.assertEqual(filenames, ["small.bin"])
+        info_text = forwarded_message.get_payload(0).get_payload(decode=True).decode()
+        self.assertIn("large.bin", info_text)
+
+    def test_passthrough_oversize_falls_back_to_rebuild(self):
+        """passthrough でサイズ超過した場合は rebuild で添付ファイルを省略して作成すること"""
+        os.environ["OVERSIZE_POLICY"] = "drop_attachments"
+        from lambda_function import build_forwarded_message
+        forwarded_message = build_forwarded_message(
+            self.original_message, "to@example.com", "forward-to@example.com", mode="passthrough"
+        )
+        self.assertIn("large.bin", forwarded_message.get_payload(0).get_payload(decode=True).decode())
+
+    def test_lambda_handler_reports_oversize(self):
+        """サイズ超過のメールは送信せず、失敗として報告すること"""
+        boto3.client("s3").put_object(
+            Bucket=os.environ['S3_BUCKET'], Key=f'{os.environ["S3_PATH"]}/mail-oversize',
+            Body=self.original_message.as_bytes()
+        )
+        event = {
+            "Records": [{
+                "eventSource": "aws:ses",
+                "eventVersion": "1.0",
+                "ses": {
+                    "mail": {"messageId": "mail-oversize"},
+                    "receipt": {"recipients": ["to@example.com"]}
+                }
+            }]
+        }
+        from lambda_function import lambda_handler
+        # サイズ超過はリトライしても成功しないため、例外を送出せず（非同期呼び出しのリトライをさせず）に返す
+        response = lambda_handler(event, None)
+        self.assertEqual(response['statusCode'], 500)
+        self.assertIn("上限", response['results'][0]['forwards'][0]['error'])
+        self.assertIs(response['results'][0]['forwards'][0]['retryable'], False)
+
+        backend = ses_backends[DEFAULT_ACCOUNT_ID][os.environ["AWS_DEFAULT_REGION"]]
+        self.assertEqual(len(backend.sent_messages), 0)
+
+class TestAttachmentOffload(BaseAwsMockTest):
+
+    def tearDown(self):
+        for name in ("ATTACHMENT_OFFLOAD_THRESHOLD", "ATTACHMENT_OFFLOAD_PREFIX"):
+            os.environ.pop(name, None)
+        super().tearDown()
+
+    def test_large_attachment_is_offloaded(self):
+        """閾値を超える添付ファイルはS3へ退避され、署名付きURLに置き換わること"""
+        from email.mime.application import MIMEApplication
+        os.environ["ATTACHMENT_OFFLOAD_THRESHOLD"] = "1000"
+        os.environ["ATTACHMENT_OFFLOAD_PREFIX"] = "offload"
+        large_data = os.urandom(5000)
+
+        original_message = MIMEMultipart()
+        original_message["Subject"] = "Offload Test"
+        original_message["From"] = "sender@example.com"
+        original_message["To"] = "to@example.com"
+        original_message.attach(MIMEText("本文です", "plain", "utf-8"))
+        for filename, data in (("large.pdf", large_data), ("small.pdf", b"small")):
+            attachment = MIMEApplication(data, "pdf")
+            attachment.add_header("Content-Disposition", "attachment", filename=filename)
+            original_message.attach(attachment)
+
+        from lambda_function import create_forwarded_message
+        forwarded_message = create_forwarded_message(original_message, "to@example.com", "forward-to@example.com")
+
+        # 退避した添付ファイルは S3 に元のバイト列のまま保存される
+        s3_client = boto3.client("s3")
+        objects = s3_client.list_objects_v2(Bucket=os.environ["S3_BUCKET"], Prefix="offload/")["Contents"]
+        self.assertEqual(len(objects), 1)
+        stored = s3_client.get_object(Bucket=os.environ["S3_BUCKET"], Key=objects[0]["Key"])
+        self.assertEqual(stored["Body"].read(), large_data)
+        self.assertEqual(stored["ContentType"], "application/pdf")
+
+        # 転送メールには小さい添付ファイルと、署名付きURLを記載したパートが含まれる
+        filenames = [part.get_filename() for part in forwarded_message.walk() if part.get_filename()]
+        self.assertEqual(filenames, ["small.pdf"])
+        stub_text = forwarded_message.get_payload(1).get_payload(1).get_payload(decode=True).decode()
+        self.assertIn(objects[0]["Key"], stub_text)
+        self.assertIn("large.pdf", stub_text)
+
+        # 同じ添付ファイルは再アップロードしない
+        from unittest import mock
+        import lambda_function
+        with mock.patch.object(lambda_function.get_s3_client(), "put_object") as put_object:
+            create_forwarded_message(original_message, "to@example.com", "forward-to2@example.com")
+        put_object.assert_not_called()
+
+class TestSerializedMessage(BaseAwsMockTest):
+
+    def tearDown(self):
+        os.environ.pop("SPOOL_MAX_MEMORY", None)
+        super().tearDown()
+
+    def test_small_message_stays_in_memory(self):
+        """小さいメールはメモリ上のバイト列として出力されること"""
+        from lambda_function import serialized_message
+        message = MIMEText("small message")
+        with serialized_message(message) as (data, size):
+            self.assertIsInstance(data, bytes)
+            self.assertEqual(data, message.as_bytes())
+            self.assertEqual(size, len(data))
+
+    def test_large_message_spills_to_file(self):
+        """SPOOL_MAX_MEMORY を超えるメールはファイルに退避し、mmap として出力されること"""
+        import mmap
+        os.environ["SPOOL_MAX_MEMORY"] = "100"
+        from lambda_function import serialized_message
+        message = MIMEText("large message " * 100)
+        with serialized_message(message) as (data, size):
+            self.assertIsInstance(data, mmap.mmap)
+            self.assertEqual(data[:], message.as_bytes())
+            self.assertEqual(size, len(data))
+
+    def test_lambda_handler_with_spooled_message(self):
+        """ファイルに退避したメールをそのままSESへ送信できること"""
+        os.environ["SPOOL_MAX_MEMORY"] = "100"
+        event = {
+            "Records": [{
+                "eventSource": "aws:ses",
+                "eventVersion": "1.0",
+                "ses": {
+                    "mail": {"messageId": "mail-to-one-forward"},
+                    "receipt": {"recipients": ["to@example.com"]}
+                }
+            }]
+        }
+        from lambda_function import lambda_handler
+        response = lambda_handler(event, None)
+        self.assertEqual(response['statusCode'], 200)
+
+        backend = ses_backends[DEFAULT_ACCOUNT_ID][os.environ["AWS_DEFAULT_REGION"]]
+        self.assertEqual(len(backend.sent_messages), 1)
+        self.assertIn("Subject: Fw: =?UTF-8?B?44Gm44GZ44Go?=", backend.sent_messages[0].raw_data)
+
+class TestMetrics(BaseAwsMockTest):
+
+    def setUp(self):
+        super().setUp()
+        self.event = {
+            "Records": [{
+                "eventSource": "aws:ses",
+                "eventVersion": "1.0",
+                "ses": {
+                    "mail": {"messageId": "mail-to-one-forward"},
+                    "receipt": {"recipients": ["to@example.com"]}
+                }
+            }]
+        }
+
+    def tearDown(self):
+        os.environ.pop("METRICS_ENABLED", None)
+        super().tearDown()
+
+    def run_handler(self):
+        """ハンドラーを実行し、標準出力に書き出された内容を返す"""
+        import io
+        from contextlib import redirect_stdout
+        from lambda_function import lambda_handler
+        output = io.StringIO()
+        with redirect_stdout(output):
+            response = lambda_handler(self.event, None)
+        self.assertEqual(response['statusCode'], 200)
+        return output.getvalue()
+
+    def test_emf_metrics_emitted(self):
+        """各ステージのメトリクスが EMF 形式で出力されること"""
+        document = json.loads(self.run_handler().strip().splitlines()[-1])
+        metric_names = [metric["Name"] for metric in document["_aws"]["CloudWatchMetrics"][0]["Metrics"]]
+        for name in ("S3FetchLatency", "ObjectBytes", "ParseTime", "PartCount",
+                     "BuildTime", "OutputBytes", "SESLatency"):
+            self.assertIn(name, metric_names)
+            self.assertIn(name, document)
+        self.assertEqual(document["PartCount"], 5)
+        self.assertGreater(document["OutputBytes"], 0)
+
+    def test_metrics_disabled(self):
+        """METRICS_ENABLED=false の場合はメトリクスを出力しないこと"""
+        os.environ["METRICS_ENABLED"] = "false"
+        self.assertEqual(self.run_handler(), "")
+
+    def test_throttling_is_counted(self):
+        """Throttling によるリトライがメトリクスとして数えられること"""
+        import lambda_function
+        metrics = lambda_function.InvocationMetrics()
+        lambda_function._current_metrics = metrics
+        try:
+            lambda_function.count_throttling(response=(None, {"Error": {"Code": "Throttling"}}))
+            lambda_function.count_throttling(response=(None, {"Error": {"Code": "MessageRejected"}}))
+            lambda_function.count_throttling(response=None)
+        finally:
+            lambda_function._current_metrics = None
+        self.assertEqual(metrics.to_emf()["SESThrottleCount"], 1)
+
+class TestCharsetResolver(BaseAwsMockTest):
+
+    def setUp(self):
+        super().setUp()
+        import lambda_function
+        lambda_function._charset_cache.clear()
+
+    def tearDown(self):
+        os.environ.pop("CHARSET_SAMPLE_BYTES", None)
+        super().tearDown()
+
+    def build_undeclared_message(self, body):
+        """charset を宣言していないテキストパートを持つメールを作成"""
+        from email import message_from_bytes
+        raw = (b"From: sender@legacy.example.jp\r\n"
+               b"To: to@example.com\r\n"
+               b"Subject: undeclared\r\n"
+               b"MIME-Version: 1.0\r\n"
+               b"Content-Type: text/plain\r\n"
+               b"Content-Transfer-Encoding: 8bit\r\n\r\n" + body)
+        return message_from_bytes(raw)
+
+    def forwarded_text(self, original_message):
+        """転送メールのオリジナル本文パートをデコードして返す"""
+        from lambda_function import create_forwarded_message
+        forwarded = create_forwarded_message(original_message, "to@example.com", "forward@example.com")
+        part = forwarded.get_payload()[1]
+        return part.get_payload(decode=True).decode(part.get_content_charset())
+
+    def test_undeclared_charsets_are_detected(self):
+        """charset 宣言のない Shift_JIS / ISO-2022-JP / UTF-8 の本文が正しく転送されること"""
+        text = "日本語の本文です。文字化けしないことを確認します。" * 5
+        for encoding in ("shift_jis", "iso-2022-jp", "utf-8"):
+            with self.subTest(encoding=encoding):
+                message = self.build_undeclared_message(text.encode(encoding))
+                self.assertEqual(self.forwarded_text(message), text)
+
+    def test_detection_uses_bounded_sample_and_domain_cache(self):
+        """chardet には先頭の一部のみを渡し、同じ送信者ドメインでは判定結果を再利用すること"""
+        import chardet
+        from unittest import mock
+        from lambda_function import resolve_charset
+        os.environ["CHARSET_SAMPLE_BYTES"] = "1024"
+        payload = ("日本語の本文です。" * 2000).encode("shift_jis")
+        with mock.patch("chardet.detect", wraps=chardet.detect) as detect:
+            self.assertEqual(resolve_charset(payload, "legacy.example.jp"), "cp932")
+            self.assertEqual(resolve_charset(payload, "legacy.example.jp"), "cp932")
+        self.assertEqual(detect.call_count, 1)
+        self.assertEqual(len(detect.call_args.args[0]), 1024)
+
+class TestIdempotency(BaseAwsMockTest):
+
+    def setUp(self):
+        super().setUp()
+        self.event = {
+            "Records": [{
+                "eventSource": "aws:ses",
+                "eventVersion": "1.0",
+                "ses": {
+                    "mail": {"messageId": "mail-to-two-forward"},
+                    "receipt": {"recipients": ["to@example.com", "to2@example.com"]}
+                }
+            }]
+        }
+
+    def tearDown(self):
+        for name in ("IDEMPOTENCY_TABLE", "IDEMPOTENCY_CACHE_SIZE"):
+            os.environ.pop(name, None)
+        super().tearDown()
+
+    def assert_retry_is_short_circuited(self):
+        """リトライ時に S3 からの取得と SES への送信を行わないこと"""
+        from unittest import mock
+        import lambda_function
+        from lambda_function import lambda_handler
+        first = lambda_handler(self.event, None)
+        self.assertEqual(first["statusCode"], 200)
+        sent_ids = {f["forwardTo"]: f["sesMessageId"] for f in first["results"][0]["forwards"]}
+
+        with mock.patch.object(lambda_function, "load_original_message") as load, \
+                mock.patch.object(lambda_function, "send_raw_message") as send:
+            retry = lambda_handler(self.event, None)
+        load.assert_not_called()
+        send.assert_not_called()
+        self.assertEqual(retry["statusCode"], 200)
+        for result in retry["results"][0]["forwards"]:
+            self.assertTrue(result["duplicate"])
+            self.assertEqual(result["sesMessageId"], sent_ids[result["forwardTo"]])
+
+    def test_memory_store(self):
+        """ウォームコンテナ内の LRU で送信済みの転送をスキップすること"""
+        self.assert_retry_is_short_circuited()
+
+    def test_dynamodb_store(self):
+        """DynamoDB のテーブルで送信済みの転送をスキップすること"""
+        import lambda_function
+        os.environ["IDEMPOTENCY_TABLE"] = "forward-idempotency"
+        boto3.client("dynamodb").create_table(
+            TableName="forward-idempotency",
+            KeySchema=[{"AttributeName": "idempotencyKey", "KeyType": "HASH"}],
+            AttributeDefinitions=[{"AttributeName": "idempotencyKey", "AttributeType": "S"}],
+            BillingMode="PAY_PER_REQUEST"
+        )
+        self.assert_retry_is_short_circuited()
+
+        # 別のコンテナ（ローカルの LRU が空）でもテーブルの記録によりスキップされること
+        lambda_function._idempotency_store = None
+        store = lambda_function.get_idempotency_store()
+        key = lambda_function.get_idempotency_key("mail-to-two-forward", "forward-to@example.com")
+        self.assertIsNone(store.local_cache.get(key))
+        self.assertIsNotNone(store.get(key))
+
+    def test_partial_failure_resends_only_failed_target(self):
+        """送信に失敗した転送先のみリトライ時に再送信すること"""
+        from unittest import mock
+        import lambda_function
+        from lambda_function import lambda_handler
+        from botocore.exceptions import ClientError
+        original = lambda_function.send_raw_message
+
+        def fail_for_second(source, data, recipient_count=1, destinations=None):
+            if b"forward-to2@example.com" in bytes(data):
+                raise ClientError({"Error": {"Code": "Throttling", "Message": "Maximum sending rate exceeded."}},
+                                  "SendRawEmail")
+            return original(source, data, recipient_count, destinations)
+
+        with mock.patch.object(lambda_function, "send_raw_message", side_effect=fail_for_second):
+            with self.assertRaises(lambda_function.ForwardingFailedError) as raised:
+                lambda_handler(self.event, None)
+        self.assertNotIsInstance(raised.exception, lambda_function.DeadlineExceededError)
+        with mock.patch.object(lambda_function, "send_raw_message", wraps=original) as send:
+            self.assertEqual(lambda_handler(self.event, None)["statusCode"], 200)
+        self.assertEqual(send.call_count, 1)
+
+class TestSqsHandler(BaseAwsMockTest):
+
+    def sqs_record(self, message_id, key, event_name="ObjectCreated:Put"):
+        """S3 の ObjectCreated 通知を本文に持つ SQS メッセージを作成"""
+        notification = {"Records": [{
+            "eventSource": "aws:s3",
+            "eventName": event_name,
+            "s3": {"bucket": {"name": os.environ["S3_BUCKET"]}, "object": {"key": key}}
+        }]}
+        return {"messageId": message_id, "body": json.dumps(notification)}
+
+    def test_sqs_batch(self):
+        """ヘッダーから受信者を推定して転送し、失敗したメッセージのみ batchItemFailures に返すこと"""
+        from lambda_function import sqs_handler
+        event = {"Records": [
+            self.sqs_record("m1", "test/mail-to-cc-bcc"),
+            self.sqs_record("m2", "other/mail-to-one-forward"),
+            self.sqs_record("m3", "test/mail-to-one-forward", event_name="ObjectRemoved:Delete"),
+            self.sqs_record("m4", "test/missing-object"),
+            {"messageId": "m5", "body": json.dumps({"Event": "s3:TestEvent"})},
+        ]}
+        response = sqs_handler(event, None)
+        self.assertEqual(response, {"batchItemFailures": [{"itemIdentifier": "m4"}]})
+
+        # To と Cc の転送先にのみ転送され、Bcc ヘッダーは受信者として扱わないこと
+        backend = ses_backends[DEFAULT_ACCOUNT_ID][os.environ["AWS_DEFAULT_REGION"]]
+        self.assertEqual(len(backend.sent_messages), 2)
+        destinations = sorted(", ".join(message.destinations) for message in backend.sent_messages)
+        self.assertEqual(destinations, ["forward-cc1@example.com, forward-cc2@example.com", "forward-to@example.com"])
+
+    def test_duplicate_with_ses_event(self):
+        """SES イベントで転送済みのメールは SQS 経由では再送信しないこと"""
+        from lambda_function import lambda_handler, sqs_handler
+        lambda_handler({"Records": [{
+            "eventSource": "aws:ses",
+            "ses": {"mail": {"messageId": "mail-to-one-forward"}, "receipt": {"recipients": ["to@example.com"]}}
+        }]}, None)
+        response = sqs_handler({"Records": [self.sqs_record("m1", "test/mail-to-one-forward")]}, None)
+        self.assertEqual(response, {"batchItemFailures": []})
+        backend = ses_backends[DEFAULT_ACCOUNT_ID][os.environ["AWS_DEFAULT_REGION"]]
+        self.assertEqual(len(backend.sent_messages), 1)
+
+class TestMimeBudget(BaseAwsMockTest):
+
+    def tearDown(self):
+        for name in ("MIME_MAX_DEPTH", "MIME_MAX_PARTS", "MIME_MAX_TOTAL_BYTES", "MIME_MAX_PART_BYTES", "INGEST_MODE"):
+            os.environ.pop(name, None)
+        super().tearDown()
+
+    def nested_message(self, depth):
+        """指定した深さまで multipart をネストしたメールを作成"""
+        root = current = MIMEMultipart()
+        for _ in range(depth):
+            child = MIMEMultipart()
+            current.attach(child)
+            current = child
+        current.attach(MIMEText("最深部の本文", "plain", "utf-8"))
+        return root
+
+    def nested_raw(self, depth):
+        """指定した深さまで multipart をネストしたメールをバイト列で作成（作成時の再帰を避けるため直接組み立てる）"""
+        lines = ["From: sender@example.com", "To: to@example.com", "Subject: Deep", "MIME-Version: 1.0"]
+        for level in range(depth + 1):
+            lines += [f'Content-Type: multipart/mixed; boundary="B{level}"', "", f"--B{level}"]
+        lines += ['Content-Type: text/plain; charset="utf-8"', "", "deepest body"]
+        for level in reversed(range(depth + 1)):
+            lines.append(f"--B{level}--")
+        return "\n".join(lines).encode("ascii")
+
+    def decode(self, message):
+        """decode_parts で組み直したパートを返す"""
+        from lambda_function import decode_parts, BuildContext
+        parent = MIMEMultipart()
+        decode_parts(parent, message, BuildContext())
+        return parent.get_payload()[0]
+
+    def test_deep_nesting_without_recursion(self):
+        """深くネストしたメールをパースして転送メールを作成・出力してもスタックあふれを起こさないこと"""
+        from email import message_from_bytes
+        from lambda_function import create_forwarded_message, serialized_message
+        original = message_from_bytes(self.nested_raw(400))
+        forwarded = create_forwarded_message(original, "to@example.com", "forward-to@example.com")
+        with serialized_message(forwarded) as (data, size):
+            output = message_from_bytes(bytes(data))
+
+        # MIME_MAX_DEPTH（既定値 20）を超えたサブツリーは省略した旨のテキストパートに置き換わる
+        depth = 0
+        part = output.get_payload()[1]
+        while part.is_multipart():
+            part = part.get_payload()[0]
+            depth += 1
+        self.assertEqual(depth, 21)
+        self.assertEqual(part.get_content_type(), "text/plain")
+        self.assertIn("Omitted MIME Part (MIME_MAX_DEPTH exceeded)", part.get_payload())
+        self.assertIn("Parts: 381", part.get_payload())
+
+    def test_parse_recursion_fallback(self):
+        """パーサーの再帰上限を超える深さのメールはヘッダーのみをパースし、本文をそのまま転送すること"""
+        import sys
+        from lambda_function import load_original_message, create_forwarded_message, serialized_message
+        raw = self.nested_raw(sys.getrecursionlimit() + 100)
+        key = f'{os.environ["S3_PATH"]}/mail-deep'
+        boto3.client("s3").put_object(Bucket=os.environ['S3_BUCKET'], Key=key, Body=raw)
+        for mode in ("bytes", "string", "stream"):
+            with self.subTest(mode=mode):
+                os.environ["INGEST_MODE"] = mode
+                original = load_original_message(os.environ['S3_BUCKET'], key)
+                self.assertFalse(original.is_multipart())
+                self.assertEqual(original["Subject"], "Deep")
+                forwarded = create_forwarded_message(original, "to@example.com", "forward-to@example.com")
+                with serialized_message(forwarded) as (data, size):
+                    self.assertIn(b"deepest body", bytes(data))
+                    self.assertIn(b"--B0--", bytes(data))
+
+    def test_depth_budget(self):
+        """MIME_MAX_DEPTH を超えたパートはデコードせずに添付し、サブツリーは省略した旨のテキストパートに置き換えること"""
+        os.environ["MIME_MAX_DEPTH"] = "3"
+        part = self.decode(self.nested_message(10))
+        for _ in range(4):
+            part = part.get_payload()[0]
+        self.assertFalse(part.is_multipart())
+        self.assertIn("Content-Type: multipart/mixed", part.get_payload())
+
+        # 深さを超えたシングルパートはオリジナルのパートをそのまま添付する
+        os.environ["MIME_MAX_DEPTH"] = "1"
+        original = self.nested_message(1)
+        part = self.decode(original).get_payload()[0].get_payload()[0]
+        self.assertIs(part, original.get_payload()[0].get_payload()[0])
+
+    def test_embedded_message_depth(self):
+        """添付されたメールの内部のネストが MIME_MAX_DEPTH を超える場合もテキストパートに置き換えること"""
+        os.environ["MIME_MAX_DEPTH"] = "5"
+        original = MIMEMultipart()
+        original.attach(MIMEMessage(self.nested_message(10)))
+        part = self.decode(original).get_payload()[0]
+        self.assertEqual(part.get_content_type(), "text/plain")
+        self.assertIn("Content-Type: message/rfc822", part.get_payload())
+
+    def test_parts_and_size_budgets(self):
+        """パート数・パートごとのサイズの上限を超えたパートはデコードせずにそのまま添付すること"""
+        original = MIMEMultipart()
+        for index in range(6):
+            original.attach(MIMEText(f"本文{index}" * (100 if index == 1 else 1), "plain", "utf-8"))
+        os.environ["MIME_MAX_PARTS"] = "5"
+        os.environ["MIME_MAX_PART_BYTES"] = "500"
+        from unittest import mock
+        import lambda_function
+        with mock.patch.object(
+            lambda_function, "decode_single_part", wraps=lambda_function.decode_single_part
+        ) as decode_single_part:
+            parts = self.decode(original).get_payload()
+        original_parts = original.get_payload()
+        # 全体を含めて 5 パートまでデコードし、2 番目はサイズ超過、5 番目以降はパート数超過
+        self.assertEqual([call.args[1] for call in decode_single_part.call_args_list],
+                         [original_parts[0], original_parts[2], original_parts[3]])
+        self.assertEqual(len(parts), 6)
+        for index in (1, 4, 5):
+            self.assertIs(parts[index], original_parts[index])
+
+class FakeLambdaContext:
+    """残り時間を指定できる Lambda コンテキスト"""
+
+    def __init__(self, remaining_millis):
+        self.aws_request_id = "test-request"
+        self.remaining_millis = remaining_millis
+
+    def get_remaining_time_in_millis(self):
+        return self.remaining_millis
+
+class TestDeadline(BaseAwsMockTest):
+
+    def setUp(self):
+        super().setUp()
+        import lambda_function
+        lambda_function._stage_costs.clear()
+        lambda_function._stage_costs.update({
+            "load": 0.1, "build:rebuild": 10.0, "build:passthrough": 0.1, "build:attach": 0.1, "send": 0.1
+        })
+        self.event = {
+            "Records": [{
+                "eventSource": "aws:ses",
+                "eventVersion": "1.0",
+                "ses": {
+                    "mail": {"messageId": "mail-to-one-forward"},
+                    "receipt": {"recipients": ["to@example.com"]}
+                }
+            }]
+        }
+
+    def tearDown(self):
+        import lambda_function
+        lambda_function._stage_costs.clear()
+        super().tearDown()
+
+    def test_switch_to_passthrough(self):
+        """rebuild の推定処理時間が残り時間を超える場合は passthrough で転送すること"""
+        from unittest import mock
+        import lambda_function
+        with mock.patch.object(
+            lambda_function, "send_forwarded_message", wraps=lambda_function.send_forwarded_message
+        ) as send:
+            response = lambda_function.lambda_handler(self.event, FakeLambdaContext(3000))
+        self.assertEqual(response["statusCode"], 200)
+        self.assertEqual(send.call_args.args[3], "passthrough")
+
+        # 時間が十分にある場合は設定どおり rebuild で転送すること
+        self.assertEqual(lambda_function.plan_forward_mode(lambda_function.Deadline(FakeLambdaContext(60000))), "rebuild")
+
+    def test_defer_when_out_of_time(self):
+        """残り時間が足りない場合は S3 から取得せずに再試行可能な失敗とすること"""
+        from unittest import mock
+        import lambda_function
+        with mock.patch.object(lambda_function, "load_original_message") as load:
+            with self.assertRaises(lambda_function.DeadlineExceededError):
+                lambda_function.lambda_handler(self.event, FakeLambdaContext(1200))
+        load.assert_not_called()
+
+        # SQS の場合は batchItemFailures として返し、SQS から再配信させること
+        sqs_event = {"Records": [{"messageId": "m1", "body": json.dumps({"Records": [{
+            "eventName": "ObjectCreated:Put",
+            "s3": {"bucket": {"name": os.environ["S3_BUCKET"]}, "object": {"key": "test/mail-to-one-forward"}}
+        }]})}]}
+        response = lambda_function.sqs_handler(sqs_event, FakeLambdaContext(1200))
+        self.assertEqual(response, {"batchItemFailures": [{"itemIdentifier": "m1"}]})
+        backend = ses_backends[DEFAULT_ACCOUNT_ID][os.environ["AWS_DEFAULT_REGION"]]
+        self.assertEqual(len(backend.sent_messages), 0)
+
+    def test_stage_cost_learning(self):
+        """処理時間の推定値が計測値に追従し、増加には速く追従すること"""
+        from lambda_function import observe_stage_cost, estimate_stage_cost
+        observe_stage_cost("send", 1.1)
+        self.assertAlmostEqual(estimate_stage_cost("send"), 0.6)
+        observe_stage_cost("send", 0.1)
+        self.assertAlmostEqual(estimate_stage_cost("send"), 0.5)
+
+class TestDestinationChunks(BaseAwsMockTest):
+
+    def setUp(self):
+        super().setUp()
+        os.environ["SES_MAX_RECIPIENTS"] = "2"
+        self.forward_to = ", ".join(f"list{index}@example.com" for index in range(5)) + ", LIST0@example.com"
+        self.original_message = MIMEText("本文です", "plain", "utf-8")
+        self.original_message["From"] = "sender@example.com"
+        self.original_message["To"] = "list@example.com"
+        self.original_message["Subject"] = "Chunk Test"
+
+    def tearDown(self):
+        os.environ.pop("SES_MAX_RECIPIENTS", None)
+        super().tearDown()
+
+    def deliver(self):
+        from lambda_function import deliver_forwards
+        return deliver_forwards("chunk-test", {self.forward_to: ["list@example.com"]}, lambda: self.original_message)
+
+    def test_chunked_send(self):
+        """転送先を SES_MAX_RECIPIENTS 件ずつに分割し、1回作成した転送メールを送信先のみ変えて送信すること"""
+        from unittest import mock
+        import lambda_function
+        with mock.patch.object(
+            lambda_function, "build_forwarded_message", wraps=lambda_function.build_forwarded_message
+        ) as build, mock.patch.object(
+            lambda_function, "send_raw_message", wraps=lambda_function.send_raw_message
+        ) as send:
+            result = self.deliver()
+        self.assertEqual(result["status"], "forwarded")
+        self.assertEqual(build.call_count, 1)
+        self.assertEqual([call.kwargs["destinations"] for call in send.call_args_list], [
+            ["list0@example.com", "list1@example.com"],
+            ["list2@example.com", "list3@example.com"],
+            ["list4@example.com"],
+        ])
+        self.assertEqual(len({id(call.args[1]) for call in send.call_args_list}), 1)
+        self.assertEqual(len(result["forwards"][0]["chunks"]), 3)
+
+    def test_retry_only_failed_chunk(self):
+        """送信に失敗したチャンクのみ結果を失敗とし、リトライ時は失敗したチャンクのみを送信すること"""
+        from unittest import mock
+        import lambda_function
+        original = lambda_function.send_raw_message
+
+        def fail_second_chunk(source, data, recipient_count=1, destinations=None):
+            if destinations and destinations[0] == "list2@example.com":
+                raise RuntimeError("Throttling")
+            return original(source, data, recipient_count, destinations)
+
+        with mock.patch.object(lambda_function, "send_raw_message", side_effect=fail_second_chunk):
+            result = self.deliver()
+        forward = result["forwards"][0]
+        self.assertEqual(result["status"], "failed")
+        self.assertEqual([chunk["status"] for chunk in forward["chunks"]], ["forwarded", "failed", "forwarded"])
+
+        with mock.patch.object(lambda_function, "send_raw_message", wraps=original) as send:
+            result = self.deliver()
+        self.assertEqual(result["status"], "forwarded")
+        self.assertEqual([call.kwargs["destinations"] for call in send.call_args_list],
+                         [["list2@example.com", "list3@example.com"]])
+
+class TestVerdictPolicy(BaseAwsMockTest):
+
+    def setUp(self):
+        super().setUp()
+        os.environ["VERDICT_POLICY"] = json.dumps({
+            "*": {"virusVerdict": {"FAIL": "drop"}, "spamVerdict": {"FAIL": "tag"}},
+            "cc@example.com": {"spamVerdict": {"FAIL": "drop"}},
+            "*@example.com": {"dmarcVerdict": {"FAIL": "flag"}, "virusVerdict": {"FAIL": "drop"}},
+        })
+
+    def tearDown(self):
+        os.environ.pop("VERDICT_POLICY", None)
+        super().tearDown()
+
+    def event(self, recipients, **verdicts):
+        receipt = {"recipients": recipients}
+        receipt.update({name: {"status": status} for name, status in verdicts.items()})
+        return {"Records": [{
+            "eventSource": "aws:ses",
+            "eventVersion": "1.0",
+            "ses": {"mail": {"messageId": "mail-to-cc-bcc"}, "receipt": receipt}
+        }]}
+
+    def test_drop_before_fetch(self):
+        """drop となった場合は S3 から取得せずに処理を終えること"""
+        from unittest import mock
+        import lambda_function
+        with mock.patch.object(lambda_function, "load_original_message") as load:
+            response = lambda_function.lambda_handler(
+                self.event(["to@example.com", "other@example.org"], virusVerdict="FAIL"), None)
+        load.assert_not_called()
+        self.assertEqual(response["statusCode"], 200)
+        self.assertEqual(response["results"][0]["status"], "dropped")
+
+    def test_per_route_actions(self):
+        """受信者ごとのルールに従い、転送しない・マークを付与して転送すること"""
+        from unittest import mock
+        import lambda_function
+        with mock.patch.object(
+            lambda_function, "serialized_message", wraps=lambda_function.serialized_message
+        ) as serialized:
+            response = lambda_function.lambda_handler(
+                self.event(["to@example.com", "cc@example.com"], spamVerdict="FAIL", dmarcVerdict="FAIL"), None)
+        self.assertEqual(response["statusCode"], 200)
+        # cc@example.com は spam で drop、to@example.com はドメインのルールで flag のみ
+        self.assertEqual([forward["forwardTo"] for forward in response["results"][0]["forwards"]],
+                         ["forward-to@example.com"])
+        message = serialized.call_args.args[0]
+        self.assertEqual(message["X-Forward-Verdict"], "flag; dmarcVerdict=FAIL")
+        self.assertTrue(str(message["Subject"]).startswith("Fw: "))
+
+        # どのルールにも一致しない受信者は '*' のルールで件名にマークを付与
+        from lambda_function import evaluate_verdicts, apply_verdict_tag
+        verdict = evaluate_verdicts({"spamVerdict": {"FAIL": "tag"}}, {"spamVerdict": {"status": "FAIL"}})
+        tagged = MIMEText("本文")
+        tagged["Subject"] = "Fw: hello"
+        apply_verdict_tag(tagged, verdict)
+        self.assertEqual(tagged["Subject"], "[SUSPECTED SPAM] Fw: hello")
+        self.assertEqual(tagged["X-Forward-Verdict"], "tag; spamVerdict=FAIL")
+
+class TestProfiling(BaseAwsMockTest):
+
+    def setUp(self):
+        super().setUp()
+        import tempfile
+        self.temporary_directory = tempfile.TemporaryDirectory()
+        os.environ["PROFILE_OUTPUT_DIR"] = self.temporary_directory.name
+        self.event = {
+            "Records": [{
+                "eventSource": "aws:ses",
+                "eventVersion": "1.0",
+                "ses": {
+                    "mail": {"messageId": "mail-to-one-forward"},
+                    "receipt": {"recipients": ["to@example.com"]}
+                }
+            }]
+        }
+
+    def tearDown(self):
+        for name in ("PROFILE_OUTPUT_DIR", "PROFILE_ENABLED", "PROFILE_SAMPLE_RATE",
+                     "PROFILE_MESSAGE_IDS", "PROFILE_RECIPIENTS", "PROFILE_S3_URI"):
+            os.environ.pop(name, None)
+        self.temporary_directory.cleanup()
+        super().tearDown()
+
+    def output_files(self):
+        return sorted(os.listdir(self.temporary_directory.name))
+
+    def test_forced_by_message_id(self):
+        """PROFILE_MESSAGE_IDS に一致するメールは pstats と確保量の多い行を出力すること"""
+        import pstats
+        from lambda_function import lambda_handler
+        os.environ["PROFILE_MESSAGE_IDS"] = "other-message, mail-to-one-forward"
+        response = lambda_handler(self.event, None)
+        self.assertEqual(response["statusCode"], 200)
+
+        files = self.output_files()
+        self.assertEqual(len(files), 2)
+        stats_file = next(name for name in files if name.endswith(".pstats"))
+        stats = pstats.Stats(os.path.join(self.temporary_directory.name, stats_file))
+        self.assertIn("decode_parts", {function for _, _, function in stats.stats})
+        allocations_file = next(name for name in files if name.endswith("-allocations.txt"))
+        with open(os.path.join(self.temporary_directory.name, allocations_file), encoding="utf-8") as f:
+            self.assertTrue(f.readline().startswith("peak: "))
+
+    def test_not_selected(self):
+        """対象外の呼び出しや、サンプリングで選ばれなかった呼び出しは何も出力しないこと"""
+        from lambda_function import lambda_handler, select_for_profiling
+        self.assertFalse(select_for_profiling(self.event))
+        os.environ["PROFILE_RECIPIENTS"] = "someone@example.com"
+        os.environ["PROFILE_ENABLED"] = "true"
+        os.environ["PROFILE_SAMPLE_RATE"] = "0"
+        lambda_handler(self.event, None)
+        self.assertEqual(self.output_files(), [])
+
+        os.environ["PROFILE_RECIPIENTS"] = "TO@example.com"
+        self.assertTrue(select_for_profiling(self.event))
+
+    def test_upload_to_s3(self):
+        """PROFILE_S3_URI が設定されている場合は S3 にアップロードすること"""
+        from lambda_function import lambda_handler
+        os.environ["PROFILE_ENABLED"] = "true"
+        os.environ["PROFILE_S3_URI"] = f"s3://{os.environ['S3_BUCKET']}/diagnostics/"
+        lambda_handler(self.event, None)
+        response = boto3.client("s3").list_objects_v2(Bucket=os.environ["S3_BUCKET"], Prefix="diagnostics/")
+        keys = sorted(obj["Key"] for obj in response.get("Contents", []))
+        self.assertEqual(keys, [f"diagnostics/{name}" for name in self.output_files()])
+
+class TestTransferEncoding(BaseAwsMockTest):
+
+    def tearDown(self):
+        os.environ.pop("ALLOW_8BIT_TRANSFER", None)
+        super().tearDown()
+
+    def forward_and_reparse(self, raw):
+        """転送メールを作成し、出力したバイト列をパースし直してオリジナル部分のパートを返す"""
+        from email import message_from_bytes
+        from lambda_function import create_forwarded_message, serialized_message
+        forwarded = create_forwarded_message(message_from_bytes(raw), "to@example.com", "forward@example.com")
+        with serialized_message(forwarded) as (data, _):
+            reparsed = message_from_bytes(bytes(data))
+        return reparsed.get_payload()[1]
+
+    def test_unchanged_parts_keep_original_encoding(self):
+        """内容が変わらないパートはオリジナルのエンコードのまま、バイナリの添付ファイルも変更せずに転送すること"""
+        import base64
+        import quopri
+        binary = os.urandom(3000)
+        body = "Hello, this is mostly ASCII text. こんにちは\n".encode("utf-8") * 50
+        raw = (b"From: sender@example.com\r\n"
+               b"Subject: Encoding Test\r\n"
+               b"MIME-Version: 1.0\r\n"
+               b"Content-Type: multipart/mixed; boundary=\"b1\"\r\n\r\n"
+               b"--b1\r\n"
+               b"Content-Type: text/plain; charset=utf-8\r\n"
+               b"Content-Transfer-Encoding: quoted-printable\r\n\r\n"
+               + quopri.encodestring(body) +
+               b"\r\n--b1\r\n"
+               b"Content-Type: application/pdf\r\n"
+               b"Content-Transfer-Encoding: base64\r\n\r\n"
+               + base64.encodebytes(binary) +
+               b"\r\n--b1--\r\n")
+        text_part, pdf_part = self.forward_and_reparse(raw).get_payload()
+
+        self.assertEqual(text_part["Content-Transfer-Encoding"], "quoted-printable")
+        self.assertEqual(text_part.get_all("Content-Type"), ["text/plain; charset=utf-8"])
+        self.assertEqual(text_part.get_payload(decode=True).replace(b"\r\n", b"\n"), body)
+        self.assertEqual(pdf_part.get_content_type(), "application/pdf")
+        self.assertEqual(pdf_part.get_payload(decode=True), binary)
+
+    def test_kept_binary_part_is_not_decoded(self):
+        """送信できるエンコードのテキスト以外のパートは、ペイロードをデコードせずにそのまま添付すること"""
+        import base64
+        from email.message import Message
+        from unittest import mock
+        from lambda_function import transcode_part
+        get_payload = Message.get_payload
+        decoded = []
+
+        def tracking_get_payload(message, i=None, decode=False):
+            decoded.append(decode)
+            return get_payload(message, i, decode)
+
+        payload = base64.encodebytes(os.urandom(3000)).decode("ascii")
+        with mock.patch.object(Message, "get_payload", tracking_get_payload):
+            self.assertEqual(
+                transcode_part([("Content-Type", "application/pdf"), ("Content-Transfer-Encoding", "base64")], payload),
+                ("keep", None))
+            self.assertNotIn(True, decoded)
+            # 送信できないエンコードのパートはデコードして作り直す
+            plan = transcode_part([("Content-Type", "application/octet-stream"),
+                                   ("Content-Transfer-Encoding", "binary")], "\0binary\n")
+        self.assertEqual(plan[:3], ("rebuild", None, "base64"))
+        self.assertIn(True, decoded)
+
+    def test_rebuilt_part_uses_smallest_encoding(self):
+        """デコードできない文字を含むパートは UTF-8 に変換し、サイズが最小のエンコードで作り直すこと"""
+        raw = (b"From: sender@example.com\r\n"
+               b"Subject: broken\r\n"
+               b"MIME-Version: 1.0\r\n"
+               b"Content-Type: text/plain; charset=utf-8; format=flowed\r\n"
+               b"Content-Transfer-Encoding: binary\r\n\r\n"
+               b"Plain ASCII line\r\nbroken byte: \xff end\r\n")
+        part = self.forward_and_reparse(raw)
+        self.assertEqual(part["Content-Transfer-Encoding"], "quoted-printable")
+        self.assertEqual(part.get_all("Content-Type"), ['text/plain; charset="utf-8"; format="flowed"'])
+        self.assertEqual(part.get_payload(decode=True).decode("utf-8").replace("\r\n", "\n"),
+                         "Plain ASCII line\nbroken byte: \ufffd end\n")
+
+    def test_choose_transfer_encoding(self):
+        """内容に応じて 7bit / 8bit / quoted-printable / base64 を選択すること"""
+        from lambda_function import choose_transfer_encoding
+        self.assertEqual(choose_transfer_encoding(b"ascii only\n"), "7bit")
+        self.assertEqual(choose_transfer_encoding(b"x" * 2000), "quoted-printable")
+        self.assertEqual(choose_transfer_encoding("Mostly ASCII with one é\n".encode("utf-8")), "quoted-printable")
+        self.assertEqual(choose_transfer_encoding(("日本語の本文" * 20).encode("utf-8")), "base64")
+        os.environ["ALLOW_8BIT_TRANSFER"] = "true"
+        self.assertEqual(choose_transfer_encoding("日本語\n".encode("utf-8")), "8bit")
+        self.assertEqual(choose_transfer_encoding("日本語\n".encode("utf-8"), is_text=False), "base64")
+
+class TestStreamingIngest(BaseAwsMockTest):
+
+    def setUp(self):
+        super().setUp()
+        import base64
+        self.attachments = [os.urandom(512 * 1024), os.urandom(768 * 1024)]
+        raw = (b"From: sender@example.com\r\n"
+               b"To: to@example.com\r\n"
+               b"Subject: Streaming Test\r\n"
+               b"MIME-Version: 1.0\r\n"
+               b"Content-Type: multipart/mixed; boundary=\"b1\"\r\n\r\n"
+               b"--b1\r\n"
+               b"Content-Type: text/plain; charset=utf-8\r\n"
+               b"Content-Transfer-Encoding: 8bit\r\n\r\n"
+               + "本文です\r\n".encode("utf-8"))
+        for index, data in enumerate(self.attachments):
+            raw += (f"\r\n--b1\r\n"
+                    f"Content-Type: application/octet-stream\r\n"
+                    f"Content-Disposition: attachment; filename=\"data{index}.bin\"\r\n"
+                    f"Content-Transfer-Encoding: base64\r\n\r\n").encode("ascii") + base64.encodebytes(data)
+        self.raw = raw + b"\r\n--b1--\r\n"
+        self.key = f'{os.environ["S3_PATH"]}/mail-streaming'
+        boto3.client("s3").put_object(Bucket=os.environ['S3_BUCKET'], Key=self.key, Body=self.raw)
+        os.environ["INGEST_MODE"] = "stream"
+        os.environ["INGEST_CHUNK_SIZE"] = "8192"
+        os.environ["INGEST_SPOOL_THRESHOLD"] = str(64 * 1024)
+
+    def tearDown(self):
+        for name in ("INGEST_MODE", "INGEST_CHUNK_SIZE", "INGEST_SPOOL_THRESHOLD", "INGEST_MEMORY_BUDGET"):
+            os.environ.pop(name, None)
+        super().tearDown()
+
+    def test_large_parts_are_spooled(self):
+        """閾値を超える本文は一時ファイルへ退避し、バイト列でパースした場合と同じ内容になること"""
+        from email import message_from_bytes
+        from lambda_function import load_original_message
+        from lambda_function import close_spools
+        message = load_original_message(os.environ['S3_BUCKET'], self.key)
+        self.addCleanup(close_spools, message)
+        expected = message_from_bytes(self.raw)
+
+        text_part, *attachment_parts = message.get_payload()
+        self.assertIsNone(text_part.payload_size())
+        for part, data in zip(attachment_parts, self.attachments):
+            self.assertGreater(part.payload_size(), 64 * 1024)
+            self.assertEqual(part.get_payload(decode=True), data)
+        self.assertEqual(message.as_bytes(), expected.as_bytes())
+
+    def test_memory_budget(self):
+        """メモリ上の本文が予算を超える場合は、閾値以下の本文も一時ファイルへ退避すること"""
+        from lambda_function import load_original_message
+        os.environ["INGEST_SPOOL_THRESHOLD"] = str(4 * 1024 * 1024)
+        os.environ["INGEST_MEMORY_BUDGET"] = str(800 * 1024)
+        from lambda_function import close_spools
+        message = load_original_message(os.environ['S3_BUCKET'], self.key)
+        self.addCleanup(close_spools, message)
+        text_part, first, second = message.get_payload()
+        self.assertIsNone(text_part.payload_size())
+        self.assertIsNone(first.payload_size())
+        self.assertIsNotNone(second.payload_size())
+        self.assertEqual(second.get_payload(decode=True), self.attachments[1])
+
+    def test_peak_memory_is_bounded(self):
+        """取り込み中のメモリ使用量のピークがメールのサイズではなく予算で抑えられること"""
+        import tracemalloc
+        from unittest import mock
+        import lambda_function
+
+        class ChunkedBody:
+            """メール全体をメモリ上に置かずにチャンクを返す StreamingBody の代わり"""
+            def __init__(self, raw):
+                self.raw = raw
+
+            def iter_chunks(self, chunk_size):
+                for offset in range(0, len(self.raw), chunk_size):
+                    yield self.raw[offset:offset + chunk_size]
+
+        s3_client = mock.Mock()
+        s3_client.get_object.return_value = {"Body": ChunkedBody(self.raw)}
+        with mock.patch.object(lambda_function, "get_s3_client", return_value=s3_client):
+            tracemalloc.start()
+            try:
+                message = lambda_function.stream_message_from_s3(os.environ['S3_BUCKET'], self.key)
+                peak = tracemalloc.get_traced_memory()[1]
+            finally:
+                tracemalloc.stop()
+        self.addCleanup(lambda_function.close_spools, message)
+        self.assertLess(peak, len(self.raw) // 4)
+        self.assertEqual(message.get_payload()[2].get_payload(decode=True), self.attachments[1])
+
+    def test_forward_streamed_message(self):
+        """ストリーミングで取り込んだメールを転送できること"""
+        from lambda_function import lambda_handler
+        event = {
+            "Records": [{
+                "eventSource": "aws:ses",
+                "eventVersion": "1.0",
+                "ses": {
+                    "mail": {"messageId": "mail-streaming"},
+                    "receipt": {"recipients": ["to@example.com"]}
+                }
+            }]
+        }
+        from unittest import mock
+        import lambda_function
+        loaded = []
+
+        def load_original_message(bucket, key):
+            loaded.append(lambda_function.stream_message_from_s3(bucket, key))
+            return loaded[-1]
+
+        with mock.patch.object(lambda_function, "load_original_message", side_effect=load_original_message):
+            response = lambda_handler(event, None)
+        self.assertEqual(response["statusCode"], 200)
+        backend = ses_backends[DEFAULT_ACCOUNT_ID][os.environ["AWS_DEFAULT_REGION"]]
+        self.assertEqual(len(backend.sent_messages), 1)
+
+        # 送信を終えた後は、本文を退避した一時ファイルを閉じる
+        spools = [part._spool for part in loaded[0].get_payload()[1:]]
+        self.assertTrue(spools)
+        self.assertTrue(all(spool is not None and spool.closed for spool in spools))
+
+    def test_s3_object_closes_spools(self):
+        """S3 のオブジェクトを処理した後は、転送先がない場合も一時ファイルを閉じること"""
+        from unittest import mock
+        import lambda_function
+        with mock.patch.object(lambda_function, "close_spools", wraps=lambda_function.close_spools) as close_spools:
+            result = lambda_function.process_s3_object(os.environ['S3_BUCKET'], self.key)
+            self.assertEqual(result["status"], "forwarded")
+            boto3.client("s3").put_object(Bucket=os.environ['S3_BUCKET'], Key=self.key,
+                                          Body=self.raw.replace(b"To: to@example.com", b"To: unknown@example.com"))
+            result = lambda_function.process_s3_object(os.environ['S3_BUCKET'], self.key)
+            self.assertEqual(result["status"], "skipped")
+        messages = [call.args[0] for call in close_spools.call_args_list]
+        self.assertEqual(len({id(message) for message in messages}), 2)
+        for message in messages:
+            self.assertTrue(all(part._spool.closed for part in message.get_payload()[1:]))
+
+class LocalSmtpServer:
+    """テスト用のローカルSMTPサーバー
+    接続ごとにスレッドで応答し、受け取ったメールと接続数・認証回数を記録する。
+    """
+
+    def __init__(self, pipelining=True, username="user", password="secret"):
+        import socketserver
+        import threading
+        self.pipelining = pipelining
+        self.credentials = (username, password)
+        self.messages = []
+        self.connections = 0
+        self.logins = 0
+        self.sockets = []
+        self.lock = threading.Lock()
+        server = self
+
+        class Handler(socketserver.StreamRequestHandler):
+            def handle(self):
+                with server.lock:
+                    server.connections += 1
+                    server.sockets.append(self.request)
+                server.session(self.rfile, self.wfile)
+
+        self.server = socketserver.ThreadingTCPServer(("127.0.0.1", 0), Handler)
+        self.server.daemon_threads = True
+        self.port = self.server.server_address[1]
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+
+    def session(self, rfile, wfile):
+        import base64
+
+        def reply(line):
+            wfile.write(f"{line}\r\n".encode("ascii"))
+            wfile.flush()
+
+        reply("220 localhost ESMTP")
+        mail_from, recipients = None, []
+        for raw in rfile:
+            command = raw.decode("ascii").rstrip("\r\n")
+            verb = command.split(" ", 1)[0].upper()
+            if verb == "EHLO":
+                extensions = ["SIZE 10485760", "AUTH PLAIN"] + (["PIPELINING"] if self.pipelining else [])
+                for extension in ["localhost"] + extensions[:-1]:
+                    reply(f"250-{extension}")
+                reply(f"250 {extensions[-1]}")
+            elif verb == "AUTH":
+                _, username, password = base64.b64decode(command.split()[2]).decode().split("\0")
+                if (username, password) == self.credentials:
+                    with self.lock:
+                        self.logins += 1
+                    reply("235 Authentication successful")
+                else:
+                    reply("535 Authentication failed")
+            elif verb == "MAIL":
+                mail_from, recipients = command[10:].split(">")[0].lstrip("<"), []
+                reply("250 Ok")
+            elif verb == "RCPT":
+                address = command[8:].strip("<>")
+                if address.startswith("reject"):
+                    reply("550 Mailbox unavailable")
+                else:
+                    recipients.append(address)
+                    reply("250 Ok")
+            elif verb == "DATA":
+                reply("354 End data with <CR><LF>.<CR><LF>")
+                lines = []
+                for line in rfile:
+                    if line == b".\r\n":
+                        break
+                    lines.append(line[1:] if line.startswith(b"..") else line)
+                with self.lock:
+                    self.messages.append((mail_from, recipients, b"".join(lines)))
+                    message_id = f"local-{len(self.messages)}"
+                reply(f"250 Ok {message_id}")
+            elif verb == "RSET":
+                mail_from, recipients = None, []
+                reply("250 Ok")
+            elif verb == "QUIT":
+                reply("221 Bye")
+                return
+            else:
+                reply("250 Ok")
+
+    def drop_connections(self):
+        """サーバー側から接続を切断する（アイドル中の接続がタイムアウトした状況を再現）"""
+        import socket
+        with self.lock:
+            sockets, self.sockets = self.sockets, []
+        for sock in sockets:
+            try:
+                sock.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+class TestSmtpTransport(BaseAwsMockTest):
+
+    def setUp(self):
+        super().setUp()
+        self.server = LocalSmtpServer()
+        self.configure(self.server)
+
+    def tearDown(self):
+        import lambda_function
+        if lambda_function._send_transport is not None:
+            lambda_function._send_transport[1].close()
+            lambda_function._send_transport = None
+        self.server.close()
+        for name in ("SEND_TRANSPORT", "SMTP_HOST", "SMTP_PORT", "SMTP_SECURITY", "SMTP_USERNAME",
+                     "SMTP_PASSWORD", "SMTP_MAX_MESSAGES_PER_CONNECTION"):
+            os.environ.pop(name, None)
+        super().tearDown()
+
+    def configure(self, server):
+        os.environ["SEND_TRANSPORT"] = "smtp"
+        os.environ["SMTP_HOST"] = "127.0.0.1"
+        os.environ["SMTP_PORT"] = str(server.port)
+        os.environ["SMTP_SECURITY"] = "none"
+        os.environ["SMTP_USERNAME"] = "user"
+        os.environ["SMTP_PASSWORD"] = "secret"
+
+    def send(self, to="forward-to@example.com", destinations=None):
+        from lambda_function import send_raw_message
+        data = (f"From: no-reply@example.com\nTo: {to}\nSubject: SMTP\n\n"
+                f"line1\n.leading dot\n").encode("ascii")
+        return send_raw_message("no-reply@example.com", data, destinations=destinations)
+
+    def test_reuse_authenticated_connection(self):
+        """認証済みの接続を再利用して複数のメールを送信し、ヘッダーの宛先へ CRLF で送ること"""
+        from lambda_function import get_send_transport, SmtpTransport
+        self.assertIsInstance(get_send_transport(), SmtpTransport)
+        responses = [self.send() for _ in range(3)]
+
+        self.assertEqual([response["MessageId"] for response in responses], ["local-1", "local-2", "local-3"])
+        self.assertEqual((self.server.connections, self.server.logins), (1, 1))
+        mail_from, recipients, data = self.server.messages[0]
+        self.assertEqual(mail_from, "no-reply@example.com")
+        self.assertEqual(recipients, ["forward-to@example.com"])
+        self.assertEqual(data, b"From: no-reply@example.com\r\nTo: forward-to@example.com\r\nSubject: SMTP\r\n\r\n"
+                               b"line1\r\n.leading dot\r\n")
+
+    def test_reconnect_and_connection_limit(self):
+        """切断された接続は再接続して送り直し、送信数の上限に達した接続は作り直すこと"""
+        self.send()
+        self.server.drop_connections()
+        self.assertEqual(self.send()["MessageId"], "local-2")
+        self.assertEqual(self.server.connections, 2)
+
+        os.environ["SMTP_MAX_MESSAGES_PER_CONNECTION"] = "2"
+        for _ in range(3):
+            self.send()
+        self.assertEqual(self.server.connections, 4)
+
+    def test_without_pipelining_and_refused_recipients(self):
+        """PIPELINING に対応していないサーバーにも送信でき、拒否された送信先以外には届けること"""
+        import smtplib
+        self.server.close()
+        self.server = LocalSmtpServer(pipelining=False)
+        self.configure(self.server)
+
+        self.send(destinations=["reject@example.com", "ok@example.com"])
+        self.assertEqual(self.server.messages[0][1], ["ok@example.com"])
+        with self.assertRaises(smtplib.SMTPRecipientsRefused):
+            self.send(destinations=["reject@example.com"])
+        # 拒否された後も同じ接続で送信を続けられる
+        self.send()
+        self.assertEqual(self.server.connections, 1)
+
+    def test_forward_via_smtp(self):
+        """SMTP で転送し、サーバーの応答を送信済みのメッセージIDとして記録すること"""
+        from lambda_function import lambda_handler
+        event = {
+            "Records": [{
+                "eventSource": "aws:ses",
+                "eventVersion": "1.0",
+                "ses": {
+                    "mail": {"messageId": "mail-to-one-forward"},
+                    "receipt": {"recipients": ["to@example.com"]}
+                }
+            }]
+        }
+        response = lambda_handler(event, None)
+        self.assertEqual(response["statusCode"], 200)
+        self.assertEqual(response["results"][0]["forwards"][0]["sesMessageId"], "local-1")
+        self.assertEqual(self.server.messages[0][1], ["forward-to@example.com"])
+        backend = ses_backends[DEFAULT_ACCOUNT_ID][os.environ["AWS_DEFAULT_REGION"]]
+        self.assertEqual(len(backend.sent_messages), 0)
+
+class TestParallelDecode(BaseAwsMockTest):
+
+    def setUp(self):
+        super().setUp()
+        import base64
+        self.binary = os.urandom(64 * 1024)
+        self.raw = (b"From: sender@example.com\r\n"
+                    b"Subject: Parallel\r\n"
+                    b"MIME-Version: 1.0\r\n"
+                    b"Content-Type: multipart/mixed; boundary=\"b1\"\r\n\r\n"
+                    b"--b1\r\n"
+                    b"Content-Type: text/plain; charset=utf-8\r\n\r\n"
+                    b"short body\r\n"
+                    b"--b1\r\n"
+                    b"Content-Type: text/plain; charset=utf-8\r\n"
+                    b"Content-Transfer-Encoding: 8bit\r\n\r\n"
+                    + "本文 broken \xff\r\n".encode("utf-8").replace(b"\xc3\xbf", b"\xff") * 500 +
+                    b"--b1\r\n"
+                    b"Content-Type: application/octet-stream; name=\"data.bin\"\r\n"
+                    b"Content-Transfer-Encoding: base64\r\n\r\n"
+                    + base64.encodebytes(self.binary) +
+                    b"--b1\r\n"
+                    b"Content-Type: application/pdf; name=\"doc.pdf\"\r\n"
+                    b"Content-Transfer-Encoding: binary\r\n\r\n"
+                    + self.binary.replace(b"\r", b"").replace(b"\n", b"") +
+                    b"\r\n--b1--\r\n")
+        os.environ["PARALLEL_DECODE_THRESHOLD"] = "1024"
+
+    def tearDown(self):
+        from lambda_function import close_decode_pool
+        close_decode_pool()
+        os.environ.pop("DECODE_WORKERS", None)
+        os.environ.pop("PARALLEL_DECODE_THRESHOLD", None)
+        super().tearDown()
+
+    def forward(self, workers):
+        """DECODE_WORKERS を指定して転送メールを作成し、オリジナル部分のシングルパートをバイト列で返す"""
+        from email import message_from_bytes
+        from lambda_function import create_forwarded_message
+        os.environ["DECODE_WORKERS"] = str(workers)
+        forwarded = create_forwarded_message(message_from_bytes(self.raw), "to@example.com", "forward@example.com")
+        return [part.as_bytes() for part in forwarded.get_payload()[1].walk() if not part.is_multipart()]
+
+    def test_same_result_as_inline(self):
+        """ワーカープロセスで処理した結果が、元の順序でこのプロセスで処理した場合と一致すること"""
+        import lambda_function
+        expected = self.forward(0)
+        self.assertIsNone(lambda_function._decode_pool)
+
+        self.assertEqual(self.forward(2), expected)
+        pool = lambda_function._decode_pool
+        self.assertEqual(len(pool.workers), 2)
+        self.assertTrue(all(process.is_alive() for process, _ in pool.workers))
+        # ウォームコンテナでは同じワーカーを再利用する
+        self.assertEqual(self.forward(2), expected)
+        self.assertIs(lambda_function._decode_pool, pool)
+
+    def test_kept_parts_are_not_deferred(self):
+        """送信できるエンコードのテキスト以外のパートは、大きくてもワーカープロセスに渡さないこと"""
+        from unittest import mock
+        import lambda_function
+        expected = self.forward(0)
+        with mock.patch.object(
+            lambda_function.DecodeWorkerPool, "map", autospec=True, side_effect=lambda_function.DecodeWorkerPool.map
+        ) as pool_map:
+            self.assertEqual(self.forward(2), expected)
+        tasks = pool_map.call_args.args[1]
+        # 作り直しが必要なテキストと binary のパートのみを渡し、base64 の添付ファイルは渡さない
+        self.assertEqual([value for headers, _, _ in tasks for key, value in headers if key.lower() == "content-type"],
+                         ["text/plain; charset=utf-8", 'application/pdf; name="doc.pdf"'])
+
+    def test_fallback_when_worker_dies(self):
+        """ワーカープロセスが異常終了した場合は、このプロセスで処理し直すこと"""
+        import lambda_function
+        expected = self.forward(0)
+        os.environ["DECODE_WORKERS"] = "2"
+        for process, _ in lambda_function.get_decode_pool().workers:
+            process.kill()
+            process.join()
+        self.assertEqual(self.forward(2), expected)
+        self.assertIsNone(lambda_function._decode_pool)
+
 if __name__ == '__main__':
-    unittest.main()
\ No newline at end of file
+    unittest.main()
@@ -0,0 +1,67 @@
+import unittest
+import os
+import sys
+import json
+import tempfile
+from datetime import datetime, timedelta, timezone
+from moto.ses.models import ses_backends
+from moto.core import DEFAULT_ACCOUNT_ID
+
+from test_lambda_function import BaseAwsMockTest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "tools"))
+
+import replay  # noqa: E402
+
+class TestReplay(BaseAwsMockTest):
+
+    def setUp(self):
+        super().setUp()
+        self.temporary_directory = tempfile.TemporaryDirectory()
+        self.checkpoint = os.path.join(self.temporary_directory.name, "checkpoint.json")
+        self.output = os.path.join(self.temporary_directory.name, "report.json")
+
+    def tearDown(self):
+        self.temporary_directory.cleanup()
+        os.environ.pop("SES_MAX_SEND_RATE", None)
+        super().tearDown()
+
+    def run_replay(self, *args):
+        """再転送ツールを実行し、結果の JSON を返す"""
+        exit_code = replay.main(["--prefix", "test/", "--output", self.output, *args])
+        self.assertEqual(exit_code, 0)
+        with open(self.output, encoding="utf-8") as f:
+            return json.load(f)
+
+    def sent_messages(self):
+        backend = ses_backends[DEFAULT_ACCOUNT_ID][os.environ["AWS_DEFAULT_REGION"]]
+        return backend.sent_messages
+
+    def test_replay_and_resume(self):
+        """プレフィックス配下のメールを再転送し、チェックポイントから再開した場合は続きのみ処理すること"""
+        report = self.run_replay("--checkpoint", self.checkpoint, "--limit", "2", "--rate", "100")
+        self.assertEqual(report["processed"], 2)
+        self.assertEqual(report["lastKey"], "test/mail-to-one-forward")
+        # mail-to-cc-bcc は To と Cc の転送先へ、mail-to-one-forward は To の転送先へ転送
+        self.assertEqual(len(self.sent_messages()), 3)
+
+        report = self.run_replay("--checkpoint", self.checkpoint)
+        self.assertEqual(report["processed"], 1)
+        self.assertEqual(report["total"], {"processed": 3, "forwarded": 3, "skipped": 0, "failed": 0})
+        self.assertEqual(len(self.sent_messages()), 4)
+        self.assertIn("messagesPerSecond", report)
+
+    def test_filters(self):
+        """受信者アドレスと最終更新日時で対象を絞り込めること"""
+        report = self.run_replay("--recipient", "CC@example.com")
+        self.assertEqual(report["total"]["forwarded"], 1)
+        self.assertEqual(report["total"]["skipped"], 2)
+        self.assertEqual([message.destinations for message in self.sent_messages()],
+                         [["forward-cc1@example.com", "forward-cc2@example.com"]])
+
+        tomorrow = (datetime.now(timezone.utc) + timedelta(days=1)).isoformat()
+        report = self.run_replay("--since", tomorrow)
+        self.assertEqual(report["processed"], 0)
+
+if __name__ == '__main__':
+    unittest.main()
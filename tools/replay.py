@@ -0,0 +1,191 @@
+"""S3 に保存されたメールの再転送ツール
+障害などで転送できなかったメールを、S3 のプレフィックス配下から一括で再転送する。
+list_objects_v2 でキーの順に一覧を取得し、オブジェクトの取得とパースを先読みで並行して行い、
+Lambda 関数と同じ転送処理（lambda_function.deliver_forwards）でキーの順に送信する。
+- 受信者は保存されたメールのヘッダー（X-Original-To / Delivered-To / To / Cc）から推定する
+- --since / --until で S3 オブジェクトの最終更新日時、--recipient で受信者アドレスを絞り込める
+- --rate で SES への送信レート（1 秒あたりの受信者数）の上限を指定できる
+- --checkpoint で指定したファイルに処理済みのキーを記録し、再実行時は続きから処理する
+環境変数（MAIL_FORWARDS / SENDER_EMAIL / FORWARD_MODE / IDEMPOTENCY_TABLE など）は Lambda 関数と同じものを使用する。
+
+使用例:
+    python tools/replay.py --bucket mail-bucket --prefix inbox/ --since 2025-01-10T00:00:00+09:00 \\
+        --rate 10 --checkpoint replay.json
+"""
+import argparse
+import json
+import os
+import sys
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT_DIR)
+
+import lambda_function  # noqa: E402
+
+# 進捗をログに出力する間隔（件数）
+PROGRESS_INTERVAL = 100
+
+def parse_time(value):
+    """ISO 8601 形式の日時を解析（タイムゾーンの指定がない場合は UTC とみなす）"""
+    parsed = datetime.fromisoformat(value)
+    return parsed if parsed.tzinfo else parsed.replace(tzinfo=timezone.utc)
+
+def load_checkpoint(path):
+    """チェックポイントファイルを読み込む（存在しない場合は初期状態）"""
+    state = {'lastKey': None, 'processed': 0, 'forwarded': 0, 'skipped': 0, 'failed': 0, 'failedKeys': []}
+    if path and os.path.exists(path):
+        with open(path, encoding='utf-8') as f:
+            state.update(json.load(f))
+    return state
+
+def save_checkpoint(path, state):
+    """チェックポイントファイルを書き込む（中断されても壊れないよう一時ファイルから置き換える）"""
+    if not path:
+        return
+    temporary_path = f'{path}.tmp'
+    with open(temporary_path, 'w', encoding='utf-8') as f:
+        json.dump(state, f, ensure_ascii=False, indent=2)
+    os.replace(temporary_path, path)
+
+def iter_object_keys(bucket, prefix, start_after=None, since=None, until=None):
+    """プレフィックス配下のオブジェクトのキーをキーの順に取得
+    * Input Value: バケット名、プレフィックス、このキーより後から取得、最終更新日時の範囲
+    * Output Value: キーのイテレーター
+    """
+    params = {'Bucket': bucket, 'Prefix': prefix}
+    if start_after:
+        params['StartAfter'] = start_after
+    paginator = lambda_function.get_s3_client().get_paginator('list_objects_v2')
+    for page in paginator.paginate(**params):
+        for obj in page.get('Contents', []):
+            if since and obj['LastModified'] < since:
+                continue
+            if until and obj['LastModified'] >= until:
+                continue
+            yield obj['Key']
+
+def prefetch(func, items, window):
+    """items の各要素について func を最大 window 件先読みして並行実行し、items の順に結果を返す
+    * Input Value: 実行する関数、入力のイテレーター、先読みする件数
+    * Output Value: (入力, 結果, 例外) のイテレーター
+    """
+    with ThreadPoolExecutor(max_workers=window) as executor:
+        pending = deque()
+        items = iter(items)
+        for item in items:
+            pending.append((item, executor.submit(func, item)))
+            if len(pending) >= window:
+                break
+        while pending:
+            item, future = pending.popleft()
+            next_item = next(items, None)
+            if next_item is not None:
+                pending.append((next_item, executor.submit(func, next_item)))
+            try:
+                yield item, future.result(), None
+            except Exception as e:
+                yield item, None, e
+
+def forward_stored_message(key, original_message, recipients_filter=None):
+    """S3 に保存されたメールを転送先ごとに転送
+    * Input Value: キー、パース済みのメール、転送対象とする受信者アドレス（省略時はすべて）
+    * Output Value: 処理結果（辞書型）
+    """
+    message_id = key.rpartition('/')[2]
+    recipients = lambda_function.get_recipients_from_headers(original_message)
+    if recipients_filter:
+        recipients = [recipient for recipient in recipients if recipient.lower() in recipients_filter]
+    targets = lambda_function.resolve_forward_targets(recipients, lambda_function.get_routing_table())
+    if not targets:
+        return {'messageId': message_id, 'status': 'skipped', 'reason': 'No forward address configured'}
+    return lambda_function.deliver_forwards(message_id, targets, lambda: original_message)
+
+def replay(bucket, prefix, since=None, until=None, recipients=None, checkpoint=None, window=8, limit=None):
+    """プレフィックス配下のメールを再転送
+    * Input Value: バケット名、プレフィックス、最終更新日時の範囲、受信者アドレス、チェックポイントファイル、
+      先読みする件数、最大処理件数
+    * Output Value: 処理結果の集計（辞書型）
+    """
+    state = load_checkpoint(checkpoint)
+    recipients_filter = {recipient.lower() for recipient in recipients} if recipients else None
+    keys = iter_object_keys(bucket, prefix, state['lastKey'], since, until)
+
+    processed = 0
+    start = time.perf_counter()
+    for key, original_message, error in prefetch(
+            lambda key: lambda_function.load_original_message(bucket, key), keys, window):
+        if error is None:
+            try:
+                result = forward_stored_message(key, original_message, recipients_filter)
+            except Exception as e:
+                error = e
+            finally:
+                lambda_function.close_spools(original_message)
+        if error is not None:
+            lambda_function.logger.error(f"メールの再転送中にエラーが発生: {key}: {str(error)}")
+            result = {'status': 'failed'}
+        if result['status'] == 'failed':
+            state['failedKeys'].append(key)
+        state[result['status']] += 1
+        state['processed'] += 1
+        state['lastKey'] = key
+        save_checkpoint(checkpoint, state)
+
+        processed += 1
+        if processed % PROGRESS_INTERVAL == 0:
+            lambda_function.logger.info(f"{processed} 件処理（{processed / (time.perf_counter() - start):.1f} 件/秒）")
+        if limit and processed >= limit:
+            break
+
+    elapsed = time.perf_counter() - start
+    return {
+        'processed': processed,
+        'elapsedSeconds': round(elapsed, 3),
+        'messagesPerSecond': round(processed / elapsed, 2) if elapsed > 0 else 0.0,
+        'total': {name: state[name] for name in ('processed', 'forwarded', 'skipped', 'failed')},
+        'failedKeys': state['failedKeys'],
+        'lastKey': state['lastKey'],
+    }
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="S3 に保存されたメールを一括で再転送する")
+    parser.add_argument("--bucket", default=os.environ.get("S3_BUCKET"), help="メールが保存されたバケット（省略時は S3_BUCKET）")
+    parser.add_argument("--prefix", default=None, help="対象のプレフィックス（省略時は S3_PATH/）")
+    parser.add_argument("--since", type=parse_time, help="この日時以降に保存されたメールのみ対象とする（ISO 8601）")
+    parser.add_argument("--until", type=parse_time, help="この日時より前に保存されたメールのみ対象とする（ISO 8601）")
+    parser.add_argument("--recipient", action="append", help="この受信者アドレス宛てのメールのみ転送する（複数指定可）")
+    parser.add_argument("--rate", type=float, help="SES への送信レートの上限（1 秒あたりの受信者数）")
+    parser.add_argument("--prefetch", type=int, default=8, help="並行して先読みするメールの件数")
+    parser.add_argument("--checkpoint", help="進捗を記録するファイル（存在する場合は続きから処理する）")
+    parser.add_argument("--limit", type=int, help="処理する最大件数")
+    parser.add_argument("--output", help="結果の JSON を書き出すファイル（省略時は標準出力）")
+    args = parser.parse_args(argv)
+    if not args.bucket:
+        parser.error("--bucket または環境変数 S3_BUCKET を指定してください")
+    if args.prefix is None:
+        args.prefix = f"{os.environ.get('S3_PATH', '')}/".lstrip("/")
+    return args
+
+def main(argv=None):
+    args = parse_args(argv)
+    if args.rate:
+        # Lambda 関数と同じトークンバケットで送信レートを制限する
+        os.environ["SES_MAX_SEND_RATE"] = str(args.rate)
+        lambda_function._send_rate_limiter = None
+
+    report = replay(args.bucket, args.prefix, args.since, args.until, args.recipient,
+                    args.checkpoint, max(args.prefetch, 1), args.limit)
+    output = json.dumps(report, ensure_ascii=False, indent=2)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            f.write(output + "\n")
+    else:
+        print(output)
+    return 1 if report['failedKeys'] else 0
+
+if __name__ == "__main__":
+    sys.exit(main())